@@ -22,6 +22,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the rest of the stack
+    'hospital.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -30,6 +32,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # After authentication, so a staff session can switch profiling on
+    'hospital.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -157,6 +161,47 @@ REST_FRAMEWORK = {
     }
 }
 
+# List endpoint pagination (see hospital/pagination.py)
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+# Compatibility switch: clients that send neither ?cursor= nor ?page_size= still
+# get the full list as a bare array. Turn off once the frontend pages everything.
+API_UNPAGINATED_LISTS = True
+
+# Per-route request metrics, scraped by staff from /api/metrics/ (see hospital/metrics.py)
+METRICS_ENABLED = True
+
+# Staff-triggered request profiling (X-Profile header, see hospital/profiling.py)
+PROFILING_ENABLED = True
+PROFILE_DIR = BASE_DIR / 'profiles'
+PROFILE_KEEP = 200
+PROFILE_CAPTURE_PARAMS = False  # query parameters hold patient data; only turn on where reports stay private
+
+# check_reminders catches up on reminders missed within this window (e.g. after downtime)
+REMINDER_LOOKBACK_MINUTES = 24 * 60
+# /api/reminders/occurrences/ expands recurring reminders over at most this many days,
+# returning no more than REMINDER_OCCURRENCE_LIMIT occurrences
+REMINDER_OCCURRENCE_MAX_DAYS = 92
+REMINDER_OCCURRENCE_LIMIT = 2000
+
+# Server-sent reminder events (/api/reminders/stream/, hospital/events.py); needs an ASGI server
+REMINDER_STREAM_POLL_SECONDS = 1          # one events query per process per interval, while anyone is connected
+REMINDER_STREAM_HEARTBEAT_SECONDS = 15
+REMINDER_STREAM_MAX_SECONDS = 30 * 60     # then the client reconnects, re-authenticating
+REMINDER_STREAM_QUEUE_SIZE = 100          # per connection; a slower client drops its oldest events
+REMINDER_STREAM_GAP_SECONDS = 30          # how long an id committed out of order is waited for
+REMINDER_EVENT_RETENTION_MINUTES = 24 * 60
+
+# Email outbox (hospital/outbox.py): send_outbox / check_reminders drain it
+OUTBOX_WORKERS = 4                    # concurrent SMTP connections
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 6               # then the message is dead-lettered
+OUTBOX_BACKOFF_SECONDS = 30           # doubled after every failed attempt...
+OUTBOX_BACKOFF_MAX_SECONDS = 3600     # ...up to this
+OUTBOX_LEASE_SECONDS = 300            # a claimed message is retried if not reported back by then
+OUTBOX_RECIPIENT_LIMIT = 100          # messages per recipient per window; 0 disables
+OUTBOX_RECIPIENT_WINDOW_SECONDS = 3600
+
 # Email settings
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
@@ -168,6 +213,50 @@ EMAIL_HOST_PASSWORD = 'your_app_password'
 # File upload settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
+# upload_record streams files to disk in pieces this size (see hospital/uploads.py)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Resumable uploads (hospital/resumable.py): chunks are kept here until finalize
+UPLOAD_SESSION_DIR = BASE_DIR / 'upload_sessions'
+UPLOAD_SESSION_CHUNK_SIZE = 1024 * 1024    # must stay under DATA_UPLOAD_MAX_MEMORY_SIZE
+UPLOAD_SESSION_TTL_HOURS = 24             # then expire_upload_sessions removes the chunks
+# Record downloads (hospital/delivery.py): 'python' sends from Django (sendfile through the
+# WSGI server's file wrapper, Range/If-Range, 304s); 'x-accel-redirect' hands the file to
+# nginx, 'x-sendfile' to Apache/lighttpd, after the access check
+FILE_DELIVERY = 'python'
+# For nginx: location /protected-media/ { internal; alias <MEDIA_ROOT>/; }
+FILE_DELIVERY_ACCEL_PREFIX = '/protected-media/'
+# Serve downloads, share links and previews from native async views; turn on when running
+# under ASGI (uvicorn/daphne), where the sync views would hold a thread per download
+ASYNC_FILE_VIEWS = False
+FILE_STREAM_CHUNK_SIZE = 256 * 1024   # read per await by the async views
+# Record thumbnails and previews (hospital/derivatives.py), rendered after upload in a
+# process pool; PDFs too when pypdfium2 is installed. build_derivatives backfills them
+DERIVATIVE_WORKERS = 2                # 0 leaves them all to build_derivatives
+DERIVATIVE_PREVIEW_SIZE = 1280        # longest side, in pixels
+DERIVATIVE_THUMBNAIL_SIZE = 256
+DERIVATIVE_QUALITY = 80               # JPEG quality
+DERIVATIVE_CACHE_MAX_MB = 2048        # the least recently previewed are evicted beyond this
+# Recompressing uploaded JPEG/PNG images, and dropping their EXIF data, before they are
+# stored (hospital/ingest.py); compact_records does the same for files already stored
+INGEST_WORKERS = 2                    # process pool size; 0 stores uploads as sent
+INGEST_JPEG_QUALITY = 85
+INGEST_MAX_DIMENSION = 3000           # longest side in pixels; larger images are scaled down, 0 never
+INGEST_PNG_PHOTOS_TO_JPEG = True      # photographic PNGs (no transparency, many colours) become JPEGs
+INGEST_MIN_SAVING = 0.05              # below this the re-encode is dropped and only metadata is stripped
+INGEST_TIMEOUT_SECONDS = 20           # then the upload is stored as sent
+# Hard-deleting soft-deleted records and their files (hospital/purge.py, purge_records)
+PURGE_RETENTION_DAYS = 30             # kept this long after deletion
+PURGE_BATCH_SIZE = 200                # records deleted per transaction
+PURGE_PAUSE_SECONDS = 0.5             # between batches, leaving the database and disk to live traffic
+# collect_orphan_files leaves files younger than this alone, as an upload may be about to reference them
+ORPHAN_FILE_GRACE_HOURS = 24
+# Cold storage tier (hospital/archive.py): archive_records packs files whose newest record is
+# older than ARCHIVE_AFTER_DAYS into compressed segments, still served by the same views;
+# rehydrate_records brings them back
+ARCHIVE_ROOT = BASE_DIR / 'archive'
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_SEGMENT_MB = 1024             # a segment is sealed and a new one started past this
+ARCHIVE_COMPRESSION_LEVEL = 6         # zlib level; entries that barely shrink are stored as they are
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
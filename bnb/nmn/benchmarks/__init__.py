@@ -0,0 +1,23 @@
+"""
+Load benchmarks for the hospital API.
+
+Run from the project directory (next to manage.py)::
+
+    python -m benchmarks --prepare --output bench.json
+    python -m benchmarks --scenario doctor_dashboard --baseline bench.json
+    python -m benchmarks --target http://127.0.0.1:8000 --server-pid 4242
+
+No baseline is shipped: latencies depend on the machine and database, so a
+baseline is only comparable with runs on the same ones. Record one before
+the change being measured (the first command above), then compare the runs
+after it with ``--baseline``, keeping the same options. The report's
+``meta`` records the target, database, seed and request counts, and a
+comparison warns when those differ.
+
+Scenarios work on a dataset created by ``manage.py seed_hospital --prefix bench``
+(``--prepare`` creates it when missing). By default requests go through the
+Django test client in this process, so per-request SQL counts are available and
+DRF throttling is turned off. Pointing ``--target`` at a running server measures
+the full stack; the throttle rates in settings then apply, so raise them for
+that run.
+"""
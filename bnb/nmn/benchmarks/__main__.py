@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+import sys
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Load-benchmark the hospital API')
+    parser.add_argument('--target', default='in-process', help="'in-process' or the base URL of a running server")
+    parser.add_argument('--scenario', action='append', dest='scenarios', help='Scenario to run (repeatable; default: all)')
+    parser.add_argument('--list', action='store_true', help='List scenarios and exit')
+    parser.add_argument('--requests', type=int, default=200, help='Timed requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='Concurrent clients')
+    parser.add_argument('--warmup', type=int, default=10, help='Untimed requests before each scenario')
+    parser.add_argument('--seed', type=int, default=1, help='Seeds both the dataset and the request mix')
+    parser.add_argument('--prefix', default='bench', help='Username prefix of the seeded dataset')
+    parser.add_argument('--password', default='Seed-Pass-2025', help='Password of the seeded users')
+    parser.add_argument('--prepare', action='store_true', help='Seed the dataset first if it does not exist')
+    parser.add_argument('--doctors', type=int, default=50, help='Doctors to seed with --prepare')
+    parser.add_argument('--patients', type=int, default=1000, help='Patients to seed with --prepare')
+    parser.add_argument('--server-pid', type=int, help='Report peak RSS of this server process instead of our own')
+    parser.add_argument('--output', help='Write the JSON report here (default: stdout)')
+    parser.add_argument('--baseline', help='JSON report to compare against; exits 1 on any regression')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative change before a metric regresses')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    import django
+    django.setup()
+
+    from .report import compare, format_comparison, mismatched_meta
+    from .runner import Bench, run
+    from .scenarios import SCENARIOS
+
+    if args.list:
+        for name, scenario in SCENARIOS.items():
+            print(f'{name:<20} {scenario.description}')
+        return 0
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenario(s): {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    bench = Bench(target=args.target, prefix=args.prefix, password=args.password, seed=args.seed)
+    if args.prepare and bench.prepare(args.doctors, args.patients):
+        print(f'Seeded dataset {args.prefix!r}', file=sys.stderr)
+    if not bench.users().exists():
+        print(f"No users prefixed '{args.prefix}-'; run with --prepare or seed_hospital --prefix {args.prefix}", file=sys.stderr)
+        return 2
+
+    report = run(bench, names, args.requests, args.concurrency, args.warmup, args.server_pid)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatched = mismatched_meta(report, baseline)
+        if mismatched:
+            print(f"Warning: baseline was run with different {', '.join(mismatched)}", file=sys.stderr)
+        rows = compare(report, baseline, args.tolerance)
+        print(format_comparison(rows), file=sys.stderr)
+        if any(row['verdict'] == 'regressed' for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
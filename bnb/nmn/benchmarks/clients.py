@@ -0,0 +1,114 @@
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import json
+import os
+import resource
+import sys
+import uuid
+
+
+class Reply:
+    __slots__ = ('status', 'body', 'queries')
+
+    def __init__(self, status, body, queries=None):
+        self.status = status
+        self.body = body
+        self.queries = queries
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class InProcessClient:
+    """Calls the app through django.test.Client, counting the SQL each request runs."""
+
+    def __init__(self):
+        from django.test import Client
+        self.client = Client(HTTP_HOST='localhost')
+
+    def request(self, method, path, data=None, files=None, token=None):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.db import connection
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'} if token else {}
+        count = [0]
+
+        def counter(execute, sql, params, many, context):
+            count[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(counter):
+            call = getattr(self.client, method.lower())
+            if files:
+                payload = dict(data or {})
+                for field, (name, content, content_type) in files.items():
+                    payload[field] = SimpleUploadedFile(name, content, content_type=content_type)
+                response = call(path, payload, **headers)
+            elif data is not None:
+                response = call(path, json.dumps(data), content_type='application/json', **headers)
+            else:
+                response = call(path, **headers)
+            # Drain streamed files inside the wrapper so lazy reads are timed too
+            body = b''.join(response.streaming_content) if response.streaming else response.content
+            if hasattr(response, 'close'):
+                response.close()
+        return Reply(response.status_code, body, count[0])
+
+    def close(self):
+        from django.db import connection
+        connection.close()
+
+
+class HttpClient:
+    """Calls a running server over HTTP. Query counts are not visible from here."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, data=None, files=None, token=None):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        body = None
+        if files:
+            body, content_type = encode_multipart(data or {}, files)
+            headers['Content-Type'] = content_type
+        elif data is not None:
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+        request = Request(self.base_url + path, data=body, headers=headers, method=method.upper())
+        try:
+            with urlopen(request, timeout=60) as response:
+                return Reply(response.status, response.read())
+        except HTTPError as e:
+            return Reply(e.code, e.read())
+
+    def close(self):
+        pass
+
+
+def encode_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    lines = []
+    for name, value in fields.items():
+        lines.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content, content_type) in files.items():
+        lines.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + content + b'\r\n'
+        )
+    lines.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(lines), f'multipart/form-data; boundary={boundary}'
+
+
+def peak_rss_bytes(pid=None):
+    """Peak resident set size of this process, or of ``pid`` (Linux only)."""
+    if pid is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is bytes on macOS and kilobytes elsewhere
+        return peak if sys.platform == 'darwin' else peak * 1024
+    status_path = f'/proc/{pid}/status'
+    if not os.path.exists(status_path):
+        return None
+    with open(status_path) as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return None
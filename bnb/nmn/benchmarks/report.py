@@ -0,0 +1,99 @@
+from collections import Counter
+import math
+
+# metric path, True when a higher value is worse
+COMPARED_METRICS = [
+    (('latency_ms', 'p50'), True),
+    (('latency_ms', 'p95'), True),
+    (('latency_ms', 'p99'), True),
+    (('throughput_rps',), False),
+    (('queries_per_request', 'mean'), True),
+    (('peak_rss_mb',), True),
+]
+
+
+# Runs that differ in any of these are not comparable
+COMPARABLE_META = ('target', 'database', 'requests', 'concurrency')
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(samples, wall_seconds):
+    """Turn ``(seconds, status, queries)`` samples into the per-scenario report entry."""
+    latencies = sorted(sample[0] * 1000 for sample in samples)
+    statuses = Counter(sample[1] for sample in samples)
+    queries = [sample[2] for sample in samples if sample[2] is not None]
+    return {
+        'requests': len(samples),
+        'errors': sum(n for code, n in statuses.items() if code >= 400),
+        'status_codes': {str(code): n for code, n in sorted(statuses.items())},
+        'latency_ms': {
+            'p50': _round(percentile(latencies, 50)),
+            'p95': _round(percentile(latencies, 95)),
+            'p99': _round(percentile(latencies, 99)),
+            'mean': _round(sum(latencies) / len(latencies)) if latencies else None,
+            'max': _round(latencies[-1]) if latencies else None,
+        },
+        'throughput_rps': _round(len(samples) / wall_seconds) if wall_seconds else None,
+        'queries_per_request': {
+            'mean': _round(sum(queries) / len(queries)),
+            'max': max(queries),
+        } if queries else None,
+    }
+
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+
+def _lookup(entry, path):
+    for key in path:
+        if not isinstance(entry, dict):
+            return None
+        entry = entry.get(key)
+    return entry
+
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    Compare every scenario present in both reports. A metric regresses when it
+    moves the wrong way by more than ``tolerance`` (a fraction of the baseline);
+    new errors where the baseline had none always regress.
+    """
+    rows = []
+    for name, current in report['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        for path, higher_is_worse in COMPARED_METRICS:
+            before, after = _lookup(previous, path), _lookup(current, path)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before if before else (0.0 if after == before else math.inf)
+            worse = change if higher_is_worse else -change
+            verdict = 'regressed' if worse > tolerance else 'improved' if worse < -tolerance else 'unchanged'
+            rows.append({'scenario': name, 'metric': '.'.join(path), 'baseline': before, 'current': after,
+                         'change': round(change, 4) if math.isfinite(change) else None, 'verdict': verdict})
+        if current['errors'] and not previous.get('errors'):
+            rows.append({'scenario': name, 'metric': 'errors', 'baseline': previous.get('errors', 0),
+                         'current': current['errors'], 'change': None, 'verdict': 'regressed'})
+    return rows
+
+
+def mismatched_meta(report, baseline):
+    meta, previous = report.get('meta', {}), baseline.get('meta', {})
+    return [key for key in COMPARABLE_META if meta.get(key) != previous.get(key)]
+
+
+def format_comparison(rows):
+    lines = [f"{'scenario':<20} {'metric':<26} {'baseline':>10} {'current':>10} {'change':>8}  verdict"]
+    for row in rows:
+        change = f"{row['change']:+.1%}" if row['change'] is not None else 'n/a'
+        lines.append(f"{row['scenario']:<20} {row['metric']:<26} {row['baseline']:>10} {row['current']:>10} {change:>8}  {row['verdict']}")
+    return '\n'.join(lines)
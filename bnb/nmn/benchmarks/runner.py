@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management import call_command
+from django.test.utils import override_settings
+from hospital.models import User
+from io import StringIO
+from rest_framework_simplejwt.tokens import RefreshToken
+import django
+import platform
+import random
+import threading
+import time
+
+from .clients import HttpClient, InProcessClient, peak_rss_bytes
+from .report import summarize
+from .scenarios import SCENARIOS
+
+IN_PROCESS = 'in-process'
+
+
+class Bench:
+    """What scenarios see of the run: the dataset, credentials and a client factory."""
+
+    def __init__(self, target=IN_PROCESS, prefix='bench', password='Seed-Pass-2025', seed=1):
+        self.target = target
+        self.prefix = prefix
+        self.password = password
+        self.seed = seed
+        self._tokens = {}
+
+    @property
+    def in_process(self):
+        return self.target == IN_PROCESS
+
+    def client(self):
+        return InProcessClient() if self.in_process else HttpClient(self.target)
+
+    def users(self, user_type=None):
+        users = User.objects.filter(username__startswith=f'{self.prefix}-')
+        return users.filter(user_type=user_type) if user_type else users
+
+    def token(self, user):
+        # Minted directly: sign-in cost belongs to login_storm, not to every scenario's setup
+        if user.pk not in self._tokens:
+            self._tokens[user.pk] = str(RefreshToken.for_user(user).access_token)
+        return self._tokens[user.pk]
+
+    def prepare(self, doctors, patients):
+        """Seed the benchmark dataset unless it is already there."""
+        if self.users().exists():
+            return False
+        call_command('seed_hospital', prefix=self.prefix, seed=self.seed, password=self.password,
+                     doctors=doctors, patients=patients, stdout=StringIO())
+        return True
+
+
+def in_process_settings():
+    """
+    Run as production would, minus the rate limiter and the SMTP server: the
+    dummy cache gives DRF's throttles no history, so every request is allowed.
+    """
+    return override_settings(
+        DEBUG=False,
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+        EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    )
+
+
+def run_scenario(bench, scenario, requests, concurrency=1, warmup=0, server_pid=None):
+    scenario.setup(bench)
+    concurrency = max(1, min(concurrency, scenario.max_concurrency or concurrency))
+    samples = []
+    tickets = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        client = bench.client()
+        rng = random.Random(f'{bench.seed}:{scenario.name}:{worker_id}')
+        try:
+            while True:
+                with lock:
+                    if next(tickets, None) is None:
+                        return
+                call = scenario.next_call(rng)
+                started = time.perf_counter()
+                reply = scenario.perform(client, call)
+                elapsed = time.perf_counter() - started
+                samples.append((elapsed, reply.status, reply.queries))
+        finally:
+            if concurrency > 1:
+                client.close()
+
+    try:
+        if warmup:
+            client, rng = bench.client(), random.Random(f'{bench.seed}:{scenario.name}:warmup')
+            for _ in range(warmup):
+                scenario.perform(client, scenario.next_call(rng))
+        started = time.perf_counter()
+        if concurrency == 1:
+            # Same thread as the caller, so a test's transaction stays visible
+            worker(0)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                for future in [pool.submit(worker, i) for i in range(concurrency)]:
+                    future.result()
+        wall = time.perf_counter() - started
+    finally:
+        scenario.teardown(bench)
+
+    result = summarize(samples, wall)
+    result['concurrency'] = concurrency
+    result.update(scenario.metrics())
+    if bench.in_process or scenario.runs_locally:
+        rss = peak_rss_bytes()
+    else:
+        rss = peak_rss_bytes(server_pid) if server_pid else None
+    result['peak_rss_mb'] = round(rss / (1024 * 1024), 1) if rss else None
+    return result
+
+
+def run(bench, names, requests, concurrency=1, warmup=0, server_pid=None):
+    report = {
+        'meta': {
+            'target': bench.target,
+            'prefix': bench.prefix,
+            'seed': bench.seed,
+            'requests': requests,
+            'concurrency': concurrency,
+            'warmup': warmup,
+            'database': settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1],
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'scenarios': {},
+    }
+    with in_process_settings():
+        for name in names:
+            scenario = SCENARIOS[name]()
+            report['scenarios'][name] = run_scenario(bench, scenario, requests, concurrency, warmup, server_pid)
+    return report
@@ -0,0 +1,236 @@
+from asgiref.sync import async_to_sync
+from datetime import timedelta
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient
+from django.test.utils import override_settings
+from django.urls import include, path
+from django.utils import timezone
+from hospital import urls as hospital_urls
+from hospital.management.commands.seed_hospital import small_jpeg
+from hospital.models import OutboundEmail, Record, Reminder, ReminderEvent, SharedLink
+from io import StringIO
+import asyncio
+import os
+import random
+import threading
+
+from .clients import Reply
+
+UPLOAD_MARKER = 'benchmark upload'
+REMINDER_MARKER = 'benchmark reminder'
+
+
+class Scenario:
+    """
+    One named workload. ``next_call`` picks the next request (untimed);
+    ``perform`` sends it and is what the runner times.
+    """
+    name = ''
+    description = ''
+    max_concurrency = None
+    runs_locally = False
+
+    def setup(self, bench):
+        pass
+
+    def next_call(self, rng):
+        raise NotImplementedError
+
+    def perform(self, client, call):
+        return client.request(**call)
+
+    def teardown(self, bench):
+        pass
+
+    def metrics(self):
+        """Extra figures for this scenario's report entry."""
+        return {}
+
+
+class LoginStorm(Scenario):
+    name = 'login_storm'
+    description = 'POST /api/login/ for a spread of patients and doctors'
+
+    def setup(self, bench):
+        self.usernames = list(bench.users().order_by('id').values_list('username', flat=True)[:500])
+        self.password = bench.password
+
+    def next_call(self, rng):
+        return {'method': 'post', 'path': '/api/login/',
+                'data': {'username': rng.choice(self.usernames), 'password': self.password}}
+
+
+class DoctorDashboard(Scenario):
+    name = 'doctor_dashboard'
+    description = 'Doctors paging their patients and records, opening a patient and previewing a record'
+
+    def setup(self, bench):
+        doctors = list(bench.users('doctor').filter(patients__isnull=False).distinct().order_by('id')[:50])
+        self.sessions = []
+        for doctor in doctors:
+            patient_ids = list(doctor.patients.order_by('id').values_list('id', flat=True)[:50])
+            record_ids = list(Record.objects.filter(doctor=doctor, is_deleted=False).order_by('-id').values_list('id', flat=True)[:50])
+            self.sessions.append((bench.token(doctor), patient_ids, record_ids))
+
+    def next_call(self, rng):
+        token, patient_ids, record_ids = rng.choice(self.sessions)
+        pages = ['/api/patients/?page_size=50', '/api/records/?page_size=50']
+        if patient_ids:
+            pages.append(f'/api/patient/{rng.choice(patient_ids)}/records/?page_size=50')
+        if record_ids:
+            pages.append(f'/api/records/{rng.choice(record_ids)}/preview/')
+        return {'method': 'get', 'path': rng.choice(pages), 'token': token}
+
+
+class UploadBurst(Scenario):
+    name = 'upload_burst'
+    description = 'Patients on an unlimited package uploading small JPEG prescriptions'
+
+    def setup(self, bench):
+        patients = (bench.users('patient').filter(package__max_uploads__lt=0, package__max_storage_mb=0, assigned_doctors__isnull=False)
+                    .distinct().order_by('id')[:50])
+        self.sessions = []
+        for patient in patients:
+            doctor_id = patient.assigned_doctors.order_by('id').values_list('id', flat=True).first()
+            self.sessions.append((bench.token(patient), patient.id, doctor_id))
+        rng = random.Random(bench.seed)
+        self.payloads = [small_jpeg(rng) for _ in range(16)]
+
+    def next_call(self, rng):
+        token, patient_id, doctor_id = rng.choice(self.sessions)
+        return {'method': 'post', 'path': '/api/records/upload/', 'token': token,
+                'data': {'patient': patient_id, 'doctor': doctor_id, 'description': UPLOAD_MARKER},
+                'files': {'prescription': ('scan.jpg', rng.choice(self.payloads), 'image/jpeg')}}
+
+    def teardown(self, bench):
+        # Delete through the model: the signals release ledger usage and drop blobs no other record uses
+        for record in Record.objects.filter(patient__in=bench.users('patient'), description=UPLOAD_MARKER):
+            record.delete()
+
+
+class SharedLinkBurst(Scenario):
+    name = 'shared_link_burst'
+    description = 'Anonymous downloads through share links'
+
+    def setup(self, bench):
+        links = SharedLink.objects.filter(record__patient__in=bench.users('patient'), record__is_deleted=False).order_by('id')[:200]
+        self.tokens = list(links.values_list('token', flat=True))
+        # Seeded links may have lapsed since the dataset was generated
+        SharedLink.objects.filter(token__in=self.tokens).update(expires_at=timezone.now() + timedelta(days=1))
+
+    def next_call(self, rng):
+        return {'method': 'get', 'path': f'/api/share/{rng.choice(self.tokens)}/'}
+
+
+class ReminderDispatch(Scenario):
+    """
+    Times ``check_reminders --enqueue-only`` over a fresh batch of due
+    reminders: claiming them and writing the outbox, without sending. It
+    always runs in this process against the configured database, whatever
+    the target.
+    """
+    name = 'reminder_dispatch'
+    description = 'check_reminders --enqueue-only over a batch of due reminders'
+    max_concurrency = 1
+    runs_locally = True
+    batch = 50
+
+    def setup(self, bench):
+        self.doctor_ids = list(bench.users('doctor').filter(package__can_set_reminders=True).values_list('id', flat=True)[:200])
+        self.patient_ids = list(bench.users('patient').filter(package__can_set_reminders=True).values_list('id', flat=True)[:500])
+
+    def next_call(self, rng):
+        due = timezone.now() - timedelta(seconds=30)
+        reminders = []
+        for _ in range(self.batch):
+            if rng.random() < 0.5:
+                reminders.append(Reminder(title=REMINDER_MARKER, date=due, next_fire_at=due, doctor_id=rng.choice(self.doctor_ids)))
+            else:
+                reminders.append(Reminder(title=REMINDER_MARKER, date=due, next_fire_at=due, patient_id=rng.choice(self.patient_ids)))
+        Reminder.objects.bulk_create(reminders)
+        return {}
+
+    def perform(self, client, call):
+        count = [0]
+
+        def counter(execute, sql, params, many, context):
+            count[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(counter):
+            call_command('check_reminders', enqueue_only=True, stdout=StringIO())
+        return Reply(200, b'', count[0])
+
+    def teardown(self, bench):
+        Reminder.objects.filter(title=REMINDER_MARKER).delete()
+        ReminderEvent.objects.filter(title=REMINDER_MARKER).delete()
+        OutboundEmail.objects.filter(kind__startswith='reminder', body__contains=REMINDER_MARKER).delete()
+
+
+class AsyncFileURLConf:
+    """The API routed as it is with ASYNC_FILE_VIEWS on."""
+    urlpatterns = [path('api/', include(hospital_urls.file_routes(async_views=True) + hospital_urls.urlpatterns))]
+
+
+class AsgiDownloadBurst(SharedLinkBurst):
+    """
+    Each call is a burst of slow clients downloading through the async file
+    views at once, four times as many as the default executor has threads,
+    driven on an event loop in this process. Reports the peak number of
+    downloads in flight together and of live threads while they were.
+    """
+    name = 'asgi_download_burst'
+    description = 'Slow clients downloading shared records at once through the async file views'
+    max_concurrency = 1
+    runs_locally = True
+    chunk_size = 256
+    chunk_delay = 0.005
+
+    def setup(self, bench):
+        super().setup(bench)
+        self.burst = 4 * min(32, (os.cpu_count() or 1) + 4)
+        self.peak_in_flight = self.peak_threads = 0
+
+    def next_call(self, rng):
+        return {'paths': [f'/api/share/{rng.choice(self.tokens)}/' for _ in range(self.burst)]}
+
+    def perform(self, client, call):
+        count = [0]
+
+        def counter(execute, sql, params, many, context):
+            count[0] += 1
+            return execute(sql, params, many, context)
+
+        # async_to_sync runs the views' ORM calls back on this thread, inside the wrapper
+        with override_settings(ROOT_URLCONF=AsyncFileURLConf, FILE_STREAM_CHUNK_SIZE=self.chunk_size), \
+                connection.execute_wrapper(counter):
+            statuses = async_to_sync(self.download_all)(call['paths'])
+        return Reply(max(statuses), b'', count[0])
+
+    async def download_all(self, paths):
+        client = AsyncClient(HTTP_HOST='localhost')
+        in_flight = [0]
+
+        async def download(path):
+            response = await client.get(path)
+            in_flight[0] += 1
+            self.peak_in_flight = max(self.peak_in_flight, in_flight[0])
+            try:
+                if response.streaming:
+                    async for _ in response.streaming_content:
+                        self.peak_threads = max(self.peak_threads, threading.active_count())
+                        # A slow client: the view must wait for it before reading more
+                        await asyncio.sleep(self.chunk_delay)
+            finally:
+                in_flight[0] -= 1
+            return response.status_code
+
+        return await asyncio.gather(*(download(path) for path in paths))
+
+    def metrics(self):
+        return {'burst': self.burst, 'peak_in_flight': self.peak_in_flight, 'peak_threads': self.peak_threads}
+
+
+SCENARIOS = {scenario.name: scenario for scenario in (LoginStorm, DoctorDashboard, UploadBurst, SharedLinkBurst, ReminderDispatch,
+                                                      AsgiDownloadBurst)}
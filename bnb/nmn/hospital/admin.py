@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django import forms
-from .models import User, Package, Record, Reminder
+from .models import User, Package, Record, Reminder, UsageLedger, OutboundEmail
 
 class UserAdmin(admin.ModelAdmin):
     list_display = ('username', 'email', 'user_type', 'phone_number', 'is_active')
@@ -32,4 +32,11 @@ class UserAdmin(admin.ModelAdmin):
 admin.site.register(User, UserAdmin)
 admin.site.register(Package)
 admin.site.register(Record)
-admin.site.register(Reminder)
\ No newline at end of file
+admin.site.register(Reminder)
+admin.site.register(UsageLedger)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('recipient', 'subject', 'kind', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status', 'kind')
+    search_fields = ('recipient', 'subject')
+
+admin.site.register(OutboundEmail, OutboundEmailAdmin)
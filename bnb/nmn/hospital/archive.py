@@ -0,0 +1,304 @@
+"""
+The cold storage tier for record files.
+
+Most records are read in the weeks after upload and hardly ever after.
+``archive_records`` moves the blobs whose newest record is older than
+ARCHIVE_AFTER_DAYS out of MEDIA_ROOT and into segment files under
+ARCHIVE_ROOT. Each blob is appended as one entry, zlib-compressed when that
+saves at least MIN_SAVING (scans and photos mostly do not), and its Blob row
+becomes the offset index: segment, offset and length. A segment is sealed
+once it reaches ARCHIVE_SEGMENT_MB.
+
+Reads map the segment with mmap, so an entry comes straight from the page
+cache with no read() call per chunk, and only the pages touched are loaded.
+An uncompressed entry is sliced as it is; a compressed one is inflated as it
+is read, so a Range request into it decompresses from the start of the
+entry. hospital/delivery.py serves archived records through ``reader``,
+and nothing else needs to know which tier a file is in. A new upload of
+archived content shares the entry (see Record.save).
+
+``rehydrate`` writes a blob back to MEDIA_ROOT (rehydrate_records). Its
+entry is then dead space in the segment; ``render_metrics`` reports that
+along with the files and bytes in each tier.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q, Sum
+from django.utils import timezone
+from . import metrics
+from .models import ArchiveSegment, Blob, Record
+from .storage import blob_storage
+import builtins
+import hashlib
+import io
+import logging
+import mmap
+import os
+import threading
+import uuid
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Compressed entries must save this much, or they are stored as they are and sliced directly
+MIN_SAVING = 0.02
+CHUNK_SIZE = 256 * 1024
+
+_lock = threading.Lock()
+_maps = {}
+
+
+def root():
+    return str(getattr(settings, 'ARCHIVE_ROOT', os.path.join(settings.BASE_DIR, 'archive')))
+
+
+def after_days():
+    return getattr(settings, 'ARCHIVE_AFTER_DAYS', 90)
+
+
+def segment_max_bytes():
+    return getattr(settings, 'ARCHIVE_SEGMENT_MB', 1024) * 1024 * 1024
+
+
+def compression_level():
+    return getattr(settings, 'ARCHIVE_COMPRESSION_LEVEL', 6)
+
+
+def segment_path(segment):
+    return os.path.join(root(), segment.name)
+
+
+def candidates(cutoff):
+    """Hot blobs whose newest record, deleted or not, was uploaded before ``cutoff``."""
+    return (Blob.objects.filter(segment__isnull=True)
+            .annotate(newest=Max('records__upload_date')).filter(newest__lt=cutoff))
+
+
+def pack(path, level):
+    """
+    The entry to store for the file at ``path``: (data, compressed). Runs in
+    a thread pool; zlib releases the GIL while it compresses.
+    """
+    with builtins.open(path, 'rb') as f:
+        data = f.read()
+    packed = zlib.compress(data, level)
+    if len(packed) <= len(data) * (1 - MIN_SAVING):
+        return packed, True
+    return data, False
+
+
+def _new_segment():
+    return ArchiveSegment.objects.create(name=f'{timezone.now():%Y%m%d}-{uuid.uuid4().hex[:12]}.seg')
+
+
+def _open_segment():
+    return ArchiveSegment.objects.select_for_update().filter(sealed=False).order_by('id').first() or _new_segment()
+
+
+def store(packed, cutoff):
+    """
+    Append ``packed`` [(blob, data, compressed)] to the open segment and
+    point the blobs at their entries, in one transaction; the hot files are
+    removed once it commits. Blobs taken up by a newer record since they
+    were packed stay hot. Returns the blobs archived.
+    """
+    if not packed:
+        return []
+    with transaction.atomic():
+        # The segment row lock keeps a second archive_records from appending to the same file
+        segment = _open_segment()
+        ids = [blob.pk for blob, _, _ in packed]
+        eligible = set(Blob.objects.select_for_update().filter(pk__in=ids, segment__isnull=True).values_list('pk', flat=True))
+        eligible -= set(Record.objects.filter(blob_id__in=ids, upload_date__gte=cutoff).values_list('blob_id', flat=True))
+        archived = []
+        now = timezone.now()
+        os.makedirs(root(), exist_ok=True)
+        f = builtins.open(segment_path(segment), 'ab+')
+        try:
+            # Drops whatever an interrupted run appended but never committed
+            f.truncate(segment.size)
+            for blob, data, compressed in packed:
+                if blob.pk not in eligible:
+                    continue
+                if segment.size and segment.size + len(data) > segment_max_bytes():
+                    _seal(f, segment)
+                    f.close()
+                    segment = _new_segment()
+                    f = builtins.open(segment_path(segment), 'ab+')
+                f.write(data)
+                blob.segment, blob.segment_offset, blob.segment_length = segment, segment.size, len(data)
+                blob.compressed, blob.archived_at = compressed, now
+                segment.size += len(data)
+                archived.append(blob)
+            _seal(f, segment, sealed=segment.size >= segment_max_bytes())
+        finally:
+            f.close()
+        Blob.objects.bulk_update(archived, ['segment', 'segment_offset', 'segment_length', 'compressed', 'archived_at'])
+        transaction.on_commit(lambda: _remove_hot([blob.pk for blob in archived]))
+    return archived
+
+
+def _seal(f, segment, sealed=True):
+    # On disk before the rows pointing into it are committed
+    f.flush()
+    os.fsync(f.fileno())
+    segment.sealed = sealed
+    ArchiveSegment.objects.filter(pk=segment.pk).update(size=segment.size, sealed=sealed)
+
+
+def _remove_hot(blob_ids):
+    # Only those still archived: rehydrate_records may have brought one back already
+    for name in Blob.objects.filter(pk__in=blob_ids, segment__isnull=False).values_list('name', flat=True):
+        try:
+            blob_storage.delete(name)
+        except OSError as e:
+            logger.error(f"Could not delete archived blob file {name}: {e}")
+
+
+def _map(path, end):
+    """A read-only mmap of the segment at ``path`` covering ``end`` bytes, shared by every reader in the process."""
+    with _lock:
+        mapped = _maps.get(path)
+        if mapped is None or len(mapped) < end:
+            # Segments only grow, so a mapping is replaced once entries are appended past it
+            with builtins.open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _maps[path] = mapped
+        return mapped
+
+
+class Entry:
+    """
+    A read-only file object over one archived blob. Seeking is lazy, so
+    FileResponse measuring the length costs nothing; the inflating happens
+    on read.
+    """
+
+    def __init__(self, mapped, offset, length, size, compressed):
+        self.mapped = mapped
+        self.offset = offset
+        self.length = length
+        self.size = size
+        self.compressed = compressed
+        self.position = 0
+        # For compressed entries: bytes inflated so far, and input fed to do it
+        self._inflater = None
+        self._inflated = 0
+        self._consumed = 0
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        if size <= 0:
+            return b''
+        if not self.compressed:
+            start = self.offset + self.position
+            data = self.mapped[start:start + size]
+        else:
+            if self._inflater is None or self.position < self._inflated:
+                self._inflater, self._inflated, self._consumed = zlib.decompressobj(), 0, 0
+            while self._inflated < self.position:
+                if not self._inflate(min(CHUNK_SIZE, self.position - self._inflated)):
+                    break
+            data = self._inflate(size)
+        self.position += len(data)
+        return data
+
+    def _inflate(self, size):
+        parts, got = [], 0
+        while got < size:
+            source = self._inflater.unconsumed_tail
+            if not source:
+                if self._consumed >= self.length:
+                    break
+                end = min(self._consumed + CHUNK_SIZE, self.length)
+                source = self.mapped[self.offset + self._consumed:self.offset + end]
+                self._consumed = end
+            data = self._inflater.decompress(source, size - got)
+            parts.append(data)
+            got += len(data)
+        self._inflated += got
+        return b''.join(parts)
+
+    def close(self):
+        # The mapping is shared; it stays open for the next reader
+        pass
+
+
+def reader(blob):
+    """A file object over an archived blob's content. Raises FileNotFoundError if its segment is gone."""
+    end = blob.segment_offset + blob.segment_length
+    return Entry(_map(segment_path(blob.segment), end), blob.segment_offset, blob.segment_length, blob.size, blob.compressed)
+
+
+def rehydrate(blob):
+    """
+    Write an archived blob back to MEDIA_ROOT and point it there. Its
+    content is checked against the digest first. Returns False if it was not
+    archived.
+    """
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().select_related('segment').filter(pk=blob.pk, segment__isnull=False).first()
+        if blob is None:
+            return False
+        path = blob_storage.path(blob.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f'{path}.{uuid.uuid4().hex}.partial'
+        entry = reader(blob)
+        sha = hashlib.sha256()
+        try:
+            with builtins.open(partial, 'wb') as f:
+                while True:
+                    chunk = entry.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    f.write(chunk)
+            if sha.hexdigest() != blob.sha256:
+                raise ValueError(f'Archived content of blob {blob.sha256} does not match its digest')
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        Blob.objects.filter(pk=blob.pk).update(segment=None, segment_offset=None, segment_length=None,
+                                               compressed=False, archived_at=None)
+    return True
+
+
+def render_metrics():
+    """Files and bytes per tier, and archive segment usage, for /api/metrics/."""
+    blobs = Blob.objects.aggregate(
+        hot_files=Count('id', filter=Q(segment__isnull=True)),
+        hot_bytes=Sum('size', filter=Q(segment__isnull=True)),
+        archive_files=Count('id', filter=Q(segment__isnull=False)),
+        archive_bytes=Sum('size', filter=Q(segment__isnull=False)),
+        archive_stored=Sum('segment_length'),
+    )
+    segments = ArchiveSegment.objects.aggregate(count=Count('id'), bytes=Sum('size'))
+    hot_bytes = blobs['hot_bytes'] or 0
+    segment_bytes = segments['bytes'] or 0
+    return (
+        metrics.render_gauge('storage_files', 'Distinct stored files, by tier.',
+                             [({'tier': 'hot'}, blobs['hot_files']), ({'tier': 'archive'}, blobs['archive_files'])])
+        + metrics.render_gauge('storage_bytes', 'Size of the stored files as uploaded, by tier.',
+                               [({'tier': 'hot'}, hot_bytes), ({'tier': 'archive'}, blobs['archive_bytes'] or 0)])
+        + metrics.render_gauge('storage_disk_bytes', 'Disk used by each tier, archive segments counted whole.',
+                               [({'tier': 'hot'}, hot_bytes), ({'tier': 'archive'}, segment_bytes)])
+        + metrics.render_gauge('archive_segments', 'Archive segment files.', [({}, segments['count'])])
+        + metrics.render_gauge('archive_dead_bytes', 'Segment bytes no blob points at any more (rehydrated or purged).',
+                               [({}, segment_bytes - (blobs['archive_stored'] or 0))])
+    )
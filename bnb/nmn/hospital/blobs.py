@@ -0,0 +1,114 @@
+"""
+Reference counting for content-addressed record files (hospital/storage.py).
+
+Record.save() takes a reference through Blob.acquire(). Soft-deleting a
+record gives it back with ``release`` but leaves the file, since the record
+still points at it; a hard delete (purge, admin, user cascade) calls
+``forget``, which removes the blob and its file once no record of any kind
+points at it any more.
+"""
+from contextlib import contextmanager
+from django.db import transaction
+from django.db.models import F
+from . import derivatives
+from .models import Blob, Record
+from .storage import blob_storage
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+@contextmanager
+def settled_later():
+    """
+    Hard deletes in this block leave their blobs alone; the caller settles
+    them afterwards with ``forget_many``, in a few queries rather than a few
+    per record.
+    """
+    _local.deferred = True
+    try:
+        yield
+    finally:
+        _local.deferred = False
+
+
+def release(record):
+    """Drop a live record's reference; the file stays for the soft-deleted row."""
+    if record.blob_id is not None:
+        Blob.objects.filter(pk=record.blob_id, refcount__gt=0).update(refcount=F('refcount') - 1)
+
+
+def retain(record):
+    """Take the reference back for a soft-deleted record made live again."""
+    if record.blob_id is not None:
+        Blob.objects.filter(pk=record.blob_id).update(refcount=F('refcount') + 1)
+
+
+def forget(record, was_live):
+    """
+    After ``record``'s row is deleted, or its file replaced: release it and
+    drop the blob if nothing else uses it.
+    """
+    if record.blob_id is None or getattr(_local, 'deferred', False):
+        return
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(pk=record.blob_id).first()
+        if blob is None:
+            return
+        if was_live and blob.refcount:
+            blob.refcount -= 1
+            Blob.objects.filter(pk=blob.pk).update(refcount=F('refcount') - 1)
+        if Record.objects.filter(blob_id=blob.pk).exists():
+            return
+        blob.delete()
+        transaction.on_commit(lambda: discard(blob))
+
+
+def forget_many(blob_ids):
+    """
+    After soft-deleted records pointing at ``blob_ids`` were deleted in bulk:
+    drop the blobs no record points at any more. Returns the dropped blobs;
+    their files go when the transaction commits.
+    """
+    if not blob_ids:
+        return []
+    with transaction.atomic():
+        locked = list(Blob.objects.select_for_update().filter(pk__in=blob_ids).order_by('pk'))
+        used = set(Record.objects.filter(blob_id__in=blob_ids).values_list('blob_id', flat=True).distinct())
+        orphans = [blob for blob in locked if blob.pk not in used]
+        if orphans:
+            Blob.objects.filter(pk__in=[blob.pk for blob in orphans]).delete()
+            transaction.on_commit(lambda: [discard(blob) for blob in orphans])
+    return orphans
+
+
+def discard(blob):
+    # A new upload of the same content may have recreated the blob since
+    if Blob.objects.filter(sha256=blob.sha256).exists():
+        return
+    try:
+        blob_storage.delete(blob.name)
+    except OSError as e:
+        logger.error(f"Could not delete blob file {blob.name}: {e}")
+    derivatives.discard(blob.sha256)
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """(sha256, size) of a file on disk, or None if it is missing. hashlib releases the GIL, so threads run these in parallel."""
+    sha = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                sha.update(chunk)
+                size += len(chunk)
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    return sha.hexdigest(), size
@@ -0,0 +1,272 @@
+"""
+Sending record files to clients once a view has done its access check.
+
+FILE_DELIVERY picks how:
+
+- ``'python'``: Django sends the file. A whole file goes out as a FileResponse
+  over the real file object, which WSGI servers with a ``wsgi.file_wrapper``
+  (gunicorn, uWSGI) pass to os.sendfile, so the bytes never enter Python.
+  ``Range`` requests get a 206 with just the asked-for bytes, which is what
+  lets a dropped download resume.
+- ``'x-accel-redirect'``: nginx sends it from an ``internal`` location mapped
+  to MEDIA_ROOT at FILE_DELIVERY_ACCEL_PREFIX, and the worker is free at once.
+- ``'x-sendfile'``: the same for Apache mod_xsendfile or lighttpd.
+
+In every mode the response carries a strong ETag, so a repeat view with
+If-None-Match is answered 304 without sending or even opening the file. Files
+are content-addressed (hospital/storage.py), so the ETag is simply the SHA-256;
+records from before that fall back to size and mtime, as nginx does.
+
+Under ASGI a sync FileResponse is read into memory whole before it is sent,
+so the async views (ASYNC_FILE_VIEWS) use ``aserve``, which streams the file
+one awaited chunk at a time.
+
+Files in the archive tier (hospital/archive.py) are streamed from their
+segment by Django in every mode, since the front server has no file to send.
+Views load ``record.blob`` along with the record so no query is added.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+from urllib.parse import quote
+from . import archive
+from .models import Blob
+import asyncio
+import functools
+import mimetypes
+import os
+import re
+
+PYTHON, X_ACCEL_REDIRECT, X_SENDFILE = 'python', 'x-accel-redirect', 'x-sendfile'
+MODES = (PYTHON, X_ACCEL_REDIRECT, X_SENDFILE)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class Unsatisfiable(ValueError):
+    pass
+
+
+def mode():
+    value = getattr(settings, 'FILE_DELIVERY', PYTHON)
+    if value not in MODES:
+        raise ValueError(f'FILE_DELIVERY must be one of {", ".join(MODES)}, not {value!r}')
+    return value
+
+
+def etag(record, stat=None):
+    if record.sha256:
+        return quote_etag(record.sha256)
+    return quote_etag(f'{stat.st_size:x}-{stat.st_mtime_ns:x}')
+
+
+def byte_range(header, size):
+    """
+    The (start, end) inclusive span a ``Range`` header asks for, or None to
+    send the whole file. Only single ranges are honoured; a multi-range
+    request gets the whole file, which RFC 9110 allows. Raises Unsatisfiable.
+    """
+    match = RANGE_RE.match((header or '').replace(' ', ''))
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise Unsatisfiable(header)
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or (last and int(last) < start):
+        raise Unsatisfiable(header)
+    return start, end
+
+
+def if_range_matches(request, tag, last_modified):
+    """Whether a Range request may be honoured: If-Range, when sent, must name the current file."""
+    validator = request.META.get('HTTP_IF_RANGE')
+    if not validator:
+        return True
+    if validator.startswith(('"', 'W/')):
+        # Strong comparison: a weak tag never matches
+        return validator == tag
+    return parse_http_date_safe(validator) == last_modified
+
+
+class _Slice:
+    """``length`` bytes of ``file`` from its current position. No fileno(), so servers stream it rather than sendfile the whole file."""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _archived(record):
+    return record.blob_id is not None and record.blob.archived
+
+
+def _stat(record):
+    """
+    os.stat of the record's hot file, or None if it is in the archive tier,
+    including when it was archived after the record was loaded.
+    """
+    if _archived(record):
+        return None
+    try:
+        return os.stat(record.prescription.path)
+    except FileNotFoundError:
+        blob = Blob.objects.select_related('segment').filter(pk=record.blob_id, segment__isnull=False).first()
+        if blob is None:
+            raise
+        record.blob = blob
+        return None
+
+
+def _content_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def _finish(response, tag, last_modified=None):
+    response['ETag'] = tag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # Records are private to their patient and doctor: revalidate, and never in a shared cache
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def prepare(request, record, as_attachment=True):
+    """
+    Everything short of reading the file. Returns a finished response (a
+    front-server handoff, 304, 412 or 416), or the (opener, span, size,
+    headers) of the body to send, ``opener()`` giving a file object. Raises
+    FileNotFoundError if it is missing.
+    """
+    prescription = record.prescription
+    filename = record.download_name
+    how = mode()
+
+    if how != PYTHON and not _archived(record):
+        # The front server stats and sends the file; only answer what needs no disk access
+        stat = None if record.sha256 else os.stat(prescription.path)
+        tag = etag(record, stat)
+        not_modified = get_conditional_response(request, etag=tag)
+        if not_modified is not None:
+            return _finish(not_modified, tag)
+        response = HttpResponse(content_type=_content_type(filename))
+        response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+        if how == X_ACCEL_REDIRECT:
+            prefix = getattr(settings, 'FILE_DELIVERY_ACCEL_PREFIX', '/protected-media/')
+            response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(prescription.name)
+        else:
+            response['X-Sendfile'] = prescription.path
+        return _finish(response, tag)
+
+    stat = _stat(record)
+    if stat is None:
+        size = record.blob.size
+        last_modified = int(record.blob.created_at.timestamp())
+        opener = functools.partial(archive.reader, record.blob)
+    else:
+        size = stat.st_size
+        last_modified = int(stat.st_mtime)
+        opener = functools.partial(open, prescription.path, 'rb')
+    tag = etag(record, stat)
+    not_modified = get_conditional_response(request, etag=tag, last_modified=last_modified)
+    if not_modified is not None:
+        return _finish(not_modified, tag, last_modified)
+
+    span = None
+    if request.method == 'GET' and if_range_matches(request, tag, last_modified):
+        try:
+            span = byte_range(request.META.get('HTTP_RANGE'), size)
+        except Unsatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return _finish(response, tag, last_modified)
+    headers = {
+        'Content-Type': _content_type(filename),
+        'Content-Disposition': content_disposition_header(as_attachment, filename),
+        'Accept-Ranges': 'bytes',
+        'ETag': tag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': 'private, no-cache',
+    }
+    if span is not None:
+        headers['Content-Range'] = f'bytes {span[0]}-{span[1]}/{size}'
+    return opener, span, size, headers
+
+
+def serve(request, record, as_attachment=True):
+    """The response delivering ``record``'s file. Raises FileNotFoundError if it is missing."""
+    prepared = prepare(request, record, as_attachment)
+    if isinstance(prepared, HttpResponse):
+        return prepared
+    opener, span, size, headers = prepared
+    # For a hot file, a real file object, so the WSGI server's file wrapper can sendfile() it
+    file = opener()
+    if span is None:
+        response = FileResponse(file, as_attachment=as_attachment, filename=record.download_name)
+    else:
+        start, end = span
+        file.seek(start)
+        response = FileResponse(_Slice(file, end - start + 1), status=206, as_attachment=as_attachment, filename=record.download_name)
+        response['Content-Length'] = end - start + 1
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+def chunk_size():
+    return getattr(settings, 'FILE_STREAM_CHUNK_SIZE', 256 * 1024)
+
+
+async def read_chunks(opener, start, length):
+    """
+    ``length`` bytes from ``start`` of the file ``opener()`` returns, one chunk
+    per await. The ASGI handler awaits each send before asking for the next
+    chunk, so a slow client pauses the reads (backpressure) and no thread is
+    held in between.
+    """
+    loop = asyncio.get_running_loop()
+    file = await loop.run_in_executor(None, opener)
+    try:
+        await loop.run_in_executor(None, file.seek, start)
+        while length > 0:
+            chunk = await loop.run_in_executor(None, file.read, min(chunk_size(), length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+async def aserve(request, record, as_attachment=True):
+    """serve() for async views: the file is streamed without a thread per download."""
+    prepared = await sync_to_async(prepare, thread_sensitive=False)(request, record, as_attachment)
+    if isinstance(prepared, HttpResponse):
+        return prepared
+    opener, span, size, headers = prepared
+    start, end = span if span is not None else (0, size - 1)
+    response = StreamingHttpResponse(read_chunks(opener, start, end - start + 1), status=200 if span is None else 206)
+    response['Content-Length'] = end - start + 1
+    for header, value in headers.items():
+        response[header] = value
+    return response
@@ -0,0 +1,172 @@
+"""
+Thumbnails and web-size previews of record files.
+
+Derivatives are keyed by the file's SHA-256, like the blobs they are made
+from, so records with the same content share them. They live under
+MEDIA_ROOT in ``derivatives/`` and are served from MEDIA_URL like the
+originals. A new record schedules its derivatives once its transaction
+commits, and a worker in a process pool (DERIVATIVE_WORKERS) renders them
+with hospital/imaging.py, so the request never waits on image decoding.
+``build_derivatives`` backfills existing records. Until a derivative exists,
+the preview endpoint falls back to the original.
+
+The cache is capped at DERIVATIVE_CACHE_MAX_MB. Previewing a record touches
+its derivatives, so the least recently previewed are evicted first; a preview
+that finds them gone schedules them again.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from . import imaging
+from .storage import blob_storage
+import logging
+import multiprocessing
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'derivatives'
+KINDS = ('preview', 'thumbnail')
+
+_lock = threading.Lock()
+_pool = None
+_pending = {}
+# Files that failed to render are not retried by this process on every preview
+_failed = set()
+_written_since_evict = 0
+
+
+def workers():
+    return getattr(settings, 'DERIVATIVE_WORKERS', 2)
+
+
+def sizes():
+    return {
+        'preview': getattr(settings, 'DERIVATIVE_PREVIEW_SIZE', 1280),
+        'thumbnail': getattr(settings, 'DERIVATIVE_THUMBNAIL_SIZE', 256),
+    }
+
+
+def quality():
+    return getattr(settings, 'DERIVATIVE_QUALITY', 80)
+
+
+def max_bytes():
+    return getattr(settings, 'DERIVATIVE_CACHE_MAX_MB', 2048) * 1024 * 1024
+
+
+def root():
+    return blob_storage.path(PREFIX)
+
+
+def name(sha256, kind):
+    # The size is part of the name, so changing a setting never serves stale renders
+    return f'{PREFIX}/{sha256[:2]}/{sha256}-{kind}-{sizes()[kind]}.jpg'
+
+
+def targets(sha256):
+    """``(path, longest_side)`` for each kind, largest first, as imaging.render wants them."""
+    return sorted(((blob_storage.path(name(sha256, kind)), size) for kind, size in sizes().items()),
+                  key=lambda target: -target[1])
+
+
+def missing(sha256):
+    return [kind for kind in KINDS if not os.path.exists(blob_storage.path(name(sha256, kind)))]
+
+
+def discard(sha256):
+    """Remove the derivatives of content no record has any more."""
+    for kind in KINDS:
+        try:
+            os.remove(blob_storage.path(name(sha256, kind)))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Could not delete derivative {name(sha256, kind)}: {e}")
+
+
+def lookup(record, render=True):
+    """
+    ``{kind: url}`` for the derivatives of ``record`` that exist, marking them
+    as used. Schedules the render if any are missing, unless ``render`` is
+    false (the file is archived, so there is none to render from). No
+    database access.
+    """
+    if not record.sha256 or not record.prescription or not imaging.can_render(record.prescription.name):
+        return {}
+    found = {}
+    for kind in KINDS:
+        derivative = name(record.sha256, kind)
+        try:
+            # Eviction goes by mtime, so a preview keeps its derivatives cached
+            os.utime(blob_storage.path(derivative))
+        except FileNotFoundError:
+            continue
+        found[kind] = blob_storage.url(derivative)
+    if render and len(found) < len(KINDS):
+        schedule(record.sha256, record.prescription.name)
+    return found
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        # Spawned rather than forked: the web process has threads and open connections
+        _pool = ProcessPoolExecutor(max_workers=workers(), mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def schedule(sha256, source_name):
+    """Render derivatives of the stored file ``source_name`` in the pool, unless they exist or are on their way."""
+    if workers() <= 0 or not sha256 or sha256 in _failed or not imaging.can_render(source_name) or not missing(sha256):
+        return None
+    source = blob_storage.path(source_name)
+    with _lock:
+        if sha256 in _pending:
+            return _pending[sha256]
+        try:
+            future = _executor().submit(imaging.render, source, targets(sha256), quality())
+        except BrokenProcessPool:
+            _reset()
+            future = _executor().submit(imaging.render, source, targets(sha256), quality())
+        _pending[sha256] = future
+    future.add_done_callback(lambda future: _rendered(sha256, source, future))
+    return future
+
+
+def _reset():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _rendered(sha256, source, future):
+    global _written_since_evict
+    with _lock:
+        _pending.pop(sha256, None)
+    try:
+        written = future.result()
+    except Exception as e:
+        _failed.add(sha256)
+        logger.error(f"Could not render derivatives of {source}: {e}")
+        return
+    with _lock:
+        _written_since_evict += written
+        # Checked after every tenth of the cap is written, not on every render
+        if _written_since_evict < max_bytes() // 10 or _pool is None:
+            return
+        _written_since_evict = 0
+        _pool.submit(imaging.evict, root(), max_bytes())
+
+
+def wait(timeout=None):
+    """Block until every scheduled render has finished."""
+    with _lock:
+        futures = list(_pending.values())
+    for future in futures:
+        try:
+            future.result(timeout)
+        except Exception:
+            pass
@@ -0,0 +1,148 @@
+"""
+Live reminder events for /api/reminders/stream/.
+
+The dispatcher (``check_reminders`` or its daemon, possibly on another host)
+``publish``es a ReminderEvent row for every reminder it queues, in the same
+transaction. Each ASGI process runs one ``Broker`` task that polls for rows
+newer than the last it saw and fans them out to per-connection queues, so the
+database sees one cheap indexed query per poll interval however many clients
+are connected, and none while nobody is. Dispatchers running side by side can
+commit ids out of order, so an id skipped over is polled for again until it
+shows up or REMINDER_STREAM_GAP_SECONDS pass (its transaction rolled back). An idle connection costs a queue and
+a suspended coroutine, which is what lets a process hold tens of thousands.
+
+Streaming needs the app served over ASGI (backend/asgi.py); under WSGI every
+open stream would pin a worker thread.
+"""
+from asgiref.sync import sync_to_async
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from .models import ReminderEvent
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def publish(reminders):
+    """Record that ``reminders`` fell due, for their doctor or patient."""
+    ReminderEvent.objects.bulk_create([
+        ReminderEvent(user_id=reminder.doctor_id or reminder.patient_id, reminder_id=reminder.id,
+                      title=reminder.title, scheduled_at=reminder.next_fire_at)
+        for reminder in reminders
+    ], batch_size=500)
+
+
+def prune(now=None):
+    """Drop events older than REMINDER_EVENT_RETENTION_MINUTES; clients further behind than that resync."""
+    cutoff = (now or timezone.now()) - timedelta(minutes=_setting('REMINDER_EVENT_RETENTION_MINUTES', 24 * 60))
+    deleted, _ = ReminderEvent.objects.filter(created_at__lt=cutoff).delete()
+    return deleted
+
+
+def serialize(event):
+    return {'id': event.id, 'user': event.user_id, 'reminder': event.reminder_id,
+            'title': event.title, 'scheduled_at': event.scheduled_at.isoformat()}
+
+
+def latest_event_id():
+    return ReminderEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def events_after(last_id, limit, missing=()):
+    """Events after ``last_id``, and any of the ``missing`` ids committed since, in id order."""
+    query = Q(id__gt=last_id)
+    if missing:
+        query |= Q(id__in=list(missing))
+    return [serialize(event) for event in ReminderEvent.objects.filter(query).order_by('id')[:limit]]
+
+
+def user_events_after(user_id, last_id, limit):
+    return [serialize(event) for event in ReminderEvent.objects.filter(user_id=user_id, id__gt=last_id).order_by('id')[:limit]]
+
+
+def format_event(event):
+    return f"id: {event['id']}\nevent: reminder\ndata: {json.dumps(event)}\n\n"
+
+
+class Broker:
+    """
+    Per-process fan-out from the ReminderEvent table to connected clients.
+    The poll task starts with the first subscriber and stops with the last.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.task = None
+        self.subscribers = {}
+        self.last_id = None
+        # Ids below last_id not committed yet when it was passed, and when that was noticed
+        self.gaps = {}
+
+    def subscribe(self, user_id):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # Queues and tasks belong to one event loop
+            self.loop, self.task, self.subscribers, self.last_id, self.gaps = loop, None, {}, None, {}
+        queue = asyncio.Queue(maxsize=_setting('REMINDER_STREAM_QUEUE_SIZE', 100))
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        queues = self.subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user_id]
+
+    @property
+    def connections(self):
+        return sum(len(queues) for queues in self.subscribers.values())
+
+    def deliver(self, event):
+        for queue in self.subscribers.get(event['user'], ()):
+            if queue.full():
+                # A client this far behind gets the newest events; it can resync with Last-Event-ID
+                queue.get_nowait()
+                logger.warning(f"Dropped a reminder event for slow stream client of user {event['user']}")
+            queue.put_nowait(event)
+
+    async def poll(self):
+        if self.last_id is None:
+            self.last_id = await sync_to_async(latest_event_id)()
+            return
+        found = await sync_to_async(events_after)(self.last_id, _setting('REMINDER_STREAM_FETCH_LIMIT', 1000), tuple(self.gaps))
+        now = asyncio.get_running_loop().time()
+        for event in found:
+            if self.gaps.pop(event['id'], None) is None:
+                for missing in range(self.last_id + 1, event['id']):
+                    self.gaps[missing] = now
+                self.last_id = event['id']
+            self.deliver(event)
+        wait = _setting('REMINDER_STREAM_GAP_SECONDS', 30)
+        self.gaps = {event_id: noticed for event_id, noticed in self.gaps.items() if now - noticed < wait}
+
+    async def run(self):
+        interval = _setting('REMINDER_STREAM_POLL_SECONDS', 1)
+        try:
+            while self.subscribers:
+                try:
+                    await self.poll()
+                except Exception as e:
+                    logger.error(f"Reminder event poll failed: {e}")
+                await asyncio.sleep(interval)
+        finally:
+            # Nobody was listening in between, so the next subscriber starts from now
+            self.task, self.last_id, self.gaps = None, None, {}
+
+
+broker = Broker()
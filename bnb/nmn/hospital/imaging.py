@@ -0,0 +1,212 @@
+"""
+Image work on record files: rendering derivatives (hospital/derivatives.py)
+and recompressing uploads (hospital/ingest.py).
+
+Everything here runs in pool worker processes, so it takes plain paths and
+numbers and touches neither settings nor the database. PDFs are rendered
+(first page) only when pypdfium2 is installed; Pillow cannot read them.
+"""
+from PIL import Image, ImageOps
+import hashlib
+import io
+import os
+import uuid
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def can_render(name):
+    ext = os.path.splitext(name)[1].lower()
+    return ext in IMAGE_EXTENSIONS or (ext == '.pdf' and pdfium is not None)
+
+
+def _open(source, size):
+    if source.lower().endswith('.pdf'):
+        document = pdfium.PdfDocument(source)
+        try:
+            page = document[0]
+            width, height = page.get_size()
+            # Rendered straight at the largest size wanted rather than at full resolution
+            return page.render(scale=size / max(width, height, 1)).to_pil()
+        finally:
+            document.close()
+    image = Image.open(source)
+    # Lets the JPEG decoder downscale by up to 8x while decoding, far cheaper than resizing after
+    image.draft('RGB', (size, size))
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        flattened = Image.new('RGB', image.size, 'white')
+        flattened.paste(image, mask=image.getchannel('A'))
+        return flattened
+    return image.convert('RGB')
+
+
+def _write(image, path, quality):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f'{path}.{uuid.uuid4().hex}.partial'
+    image.save(partial, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(partial, path)
+    return os.path.getsize(path)
+
+
+def render(source, targets, quality):
+    """
+    Worker: write a JPEG of ``source`` for each ``(path, longest_side)`` in
+    ``targets``, largest first, each scaled from the one before. Returns the
+    bytes written.
+    """
+    image = _open(source, targets[0][1])
+    written = 0
+    for path, size in targets:
+        image.thumbnail((size, size), Image.LANCZOS)
+        written += _write(image, path, quality)
+    return written
+
+
+def evict(root, max_bytes, low_water=0.9):
+    """
+    Worker: when the files under ``root`` exceed ``max_bytes``, remove the
+    least recently used (oldest mtime) down to ``low_water`` of it, so one
+    eviction makes room for many renders. Returns (files removed, bytes freed).
+    """
+    files, total = [], 0
+    try:
+        shards = [entry for entry in os.scandir(root) if entry.is_dir()]
+    except FileNotFoundError:
+        return 0, 0
+    for shard in shards:
+        for entry in os.scandir(shard.path):
+            if entry.is_file() and not entry.name.endswith('.partial'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    if total <= max_bytes:
+        return 0, 0
+    files.sort()
+    removed = freed = 0
+    for _, size, path in files:
+        if total - freed <= max_bytes * low_water:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+        freed += size
+    return removed, freed
+
+
+EXIF_ORIENTATION = 0x0112
+# APP1 carries Exif and XMP, APP3-APP13 vendor data and COM comments; APP0
+# (JFIF), APP2 (the ICC profile) and APP14 (Adobe colour transform) are kept
+JPEG_DROPPED_MARKERS = {0xE1, *range(0xE3, 0xEE), 0xFE}
+PNG_DROPPED_CHUNKS = {b'eXIf', b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+
+
+def strip_jpeg(data):
+    """``data`` without its metadata segments, losslessly, or None if it has none (or is not a JPEG)."""
+    if not data.startswith(b'\xff\xd8'):
+        return None
+    kept, position, dropped = [data[:2]], 2, False
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+        if marker == 0xDA:
+            # Start of scan: the compressed image follows, untouched
+            kept.append(data[position:])
+            return b''.join(kept) if dropped else None
+        end = position + 2 + int.from_bytes(data[position + 2:position + 4], 'big')
+        if marker in JPEG_DROPPED_MARKERS:
+            dropped = True
+        else:
+            kept.append(data[position:end])
+        position = end
+    return None
+
+
+def strip_png(data):
+    """``data`` without its text, time and Exif chunks, losslessly, or None if it has none."""
+    if not data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return None
+    kept, position, dropped = [data[:8]], 8, False
+    while position + 12 <= len(data):
+        length = int.from_bytes(data[position:position + 4], 'big')
+        kind = data[position + 4:position + 8]
+        end = position + 12 + length
+        if kind in PNG_DROPPED_CHUNKS:
+            dropped = True
+        else:
+            kept.append(data[position:end])
+        position = end
+        if kind == b'IEND':
+            break
+    return b''.join(kept) if dropped else None
+
+
+def is_photo(image):
+    """A PNG with no transparency and too many colours for a palette: a camera shot or scan, not a document render."""
+    if image.mode not in ('RGB', 'L') or 'transparency' in image.info:
+        return False
+    sample = image.copy()
+    sample.thumbnail((256, 256))
+    return sample.getcolors(4096) is None
+
+
+def _encode(image, fmt, quality, max_side):
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = io.BytesIO()
+    # Metadata is only written when passed in, so everything but the colour profile is left behind
+    options = {'icc_profile': image.info['icc_profile']} if image.info.get('icc_profile') else {}
+    if fmt == 'JPEG':
+        if image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True, **options)
+    else:
+        image.save(buffer, 'PNG', optimize=True, **options)
+    return buffer.getvalue()
+
+
+def compact(source, target, quality, max_side, png_photos_to_jpeg, min_saving):
+    """
+    Worker: a smaller, metadata-free version of the JPEG or PNG at ``source``.
+    Re-encodes (scaling down past ``max_side`` and turning photographic PNGs
+    into JPEGs if asked); when that saves less than ``min_saving`` of the size,
+    the metadata is stripped losslessly instead. Writes it to ``target``
+    (unless None) and returns (extension, size, sha256), or None when the file
+    is best kept as it is.
+    """
+    with open(source, 'rb') as f:
+        data = f.read()
+    with Image.open(io.BytesIO(data)) as image:
+        fmt = image.format
+        if fmt not in ('JPEG', 'PNG'):
+            return None
+        upright = image.getexif().get(EXIF_ORIENTATION, 1) in (0, 1)
+        oversized = bool(max_side) and max(image.size) > max_side
+        to_jpeg = fmt == 'JPEG' or (png_photos_to_jpeg and is_photo(image))
+        if fmt == 'JPEG' and oversized:
+            image.draft('RGB', (max_side, max_side))
+        encoded = _encode(ImageOps.exif_transpose(image), 'JPEG' if to_jpeg else 'PNG', quality, max_side)
+    ext = '.jpg' if to_jpeg else '.png'
+    # Past the size cap or stored sideways, the re-encode is needed whatever it saves
+    if not oversized and upright and len(encoded) > len(data) * (1 - min_saving):
+        encoded = strip_jpeg(data) if fmt == 'JPEG' else strip_png(data)
+        ext = '.jpg' if fmt == 'JPEG' else '.png'
+        if encoded is None:
+            return None
+    if target is not None:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(encoded)
+    return ext, len(encoded), hashlib.sha256(encoded).hexdigest()
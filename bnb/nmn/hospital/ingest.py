@@ -0,0 +1,140 @@
+"""
+Recompressing uploaded images before they are stored.
+
+Phone photos of prescriptions arrive at several megabytes, and every byte
+counts against the patient's storage and is sent again on each download.
+Once an upload has been received and inspected, and before its record is
+saved, ``ingest`` re-encodes a JPEG or PNG at INGEST_JPEG_QUALITY,
+scales down past INGEST_MAX_DIMENSION, stores photographic PNGs as JPEG
+(INGEST_PNG_PHOTOS_TO_JPEG) and drops the EXIF data, which can carry the
+location the photo was taken. When re-encoding saves too little the
+metadata is stripped losslessly instead (see imaging.compact).
+
+The work runs in a process pool of INGEST_WORKERS, so decoding never
+holds the GIL that the web threads need. At most twice that many uploads
+are waiting on the pool at once; beyond that, or after
+INGEST_TIMEOUT_SECONDS, the file is stored as sent. The record's
+``original_size`` stays null so that ``compact_records`` picks it up later.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from . import imaging, uploads
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+
+logger = logging.getLogger(__name__)
+
+COMPACTABLE_KINDS = ('jpeg', 'png')
+KINDS_BY_EXTENSION = {'.jpg': 'jpeg', '.png': 'png'}
+
+_lock = threading.Lock()
+_pool = None
+_slots = None
+
+
+def workers():
+    return getattr(settings, 'INGEST_WORKERS', 2)
+
+
+def options():
+    """Everything imaging.compact takes after its paths."""
+    return (
+        getattr(settings, 'INGEST_JPEG_QUALITY', 85),
+        getattr(settings, 'INGEST_MAX_DIMENSION', 3000),
+        getattr(settings, 'INGEST_PNG_PHOTOS_TO_JPEG', True),
+        getattr(settings, 'INGEST_MIN_SAVING', 0.05),
+    )
+
+
+def _executor():
+    global _pool, _slots
+    with _lock:
+        if _pool is None:
+            # Spawned rather than forked: the web process has threads and open connections
+            _pool = ProcessPoolExecutor(max_workers=workers(), mp_context=multiprocessing.get_context('spawn'))
+            _slots = threading.BoundedSemaphore(workers() * 2)
+        return _pool, _slots
+
+
+def _reset():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def renamed(file_name, ext):
+    base, old_ext = os.path.splitext(file_name)
+    return file_name if old_ext.lower() in ('.jpeg', ext) else base + ext
+
+
+def ingest(upload):
+    """
+    Recompress an inspected upload in place when that makes it smaller,
+    updating its size, digest, kind and name to match. Always returns
+    ``upload``; it carries ``original_size`` once the pool has looked at it.
+    """
+    if workers() <= 0 or getattr(upload, 'kind', None) not in COMPACTABLE_KINDS:
+        return upload
+    # Only files spooled to disk; all of them are when the inspecting handler received them
+    if not hasattr(upload, 'temporary_file_path'):
+        return upload
+    pool, slots = _executor()
+    if not slots.acquire(blocking=False):
+        logger.info(f"Ingest pool busy, storing {upload.name} as sent")
+        return upload
+    source = upload.temporary_file_path()
+    target = f'{source}.compact'
+    future = None
+    try:
+        upload.flush()
+        future = pool.submit(imaging.compact, source, target, *options())
+        result = future.result(timeout=getattr(settings, 'INGEST_TIMEOUT_SECONDS', 20))
+    except TimeoutError:
+        # The worker may still write its output; clear it up when it does
+        future.add_done_callback(lambda future: _remove(target))
+        logger.warning(f"Compacting {upload.name} timed out; stored as sent")
+        return upload
+    except BrokenProcessPool:
+        _reset()
+        logger.error(f"Ingest pool broke while compacting {upload.name}; stored as sent")
+        return upload
+    except Exception as e:
+        # Not retried by compact_records either: the file is undecodable, not merely unprocessed
+        upload.original_size = upload.size
+        logger.warning(f"Could not compact {upload.name}, stored as sent: {e}")
+        return upload
+    finally:
+        slots.release()
+
+    upload.original_size = upload.size
+    if result is None:
+        return upload
+    ext, size, sha256 = result
+    try:
+        with open(target, 'rb') as f:
+            # The same open file, so every handle on the upload sees the new content
+            upload.seek(0)
+            shutil.copyfileobj(f, upload.file)
+            upload.truncate()
+            upload.flush()
+    finally:
+        _remove(target)
+    upload.seek(0)
+    upload.size = size
+    upload.name = renamed(upload.name, ext)
+    uploads.mark(upload, sha256, KINDS_BY_EXTENSION[ext])
+    logger.info(f"Compacted {upload.name} from {upload.original_size} to {size} bytes")
+    return upload
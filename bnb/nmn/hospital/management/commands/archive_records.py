@@ -0,0 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from hospital import archive
+from hospital.storage import blob_storage
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Move files whose newest record is older than ARCHIVE_AFTER_DAYS into compressed archive segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--after-days', type=int, default=None,
+                            help=f'Archive files not uploaded again for this long (default ARCHIVE_AFTER_DAYS, {archive.after_days()})')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Files compressed concurrently')
+        parser.add_argument('--batch-size', type=int, default=200, help='Files archived per transaction')
+        parser.add_argument('--batch-mb', type=int, default=64, help='Most file data held in memory per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Report what is due without moving anything')
+
+    def handle(self, *args, **options):
+        days = archive.after_days() if options['after_days'] is None else options['after_days']
+        cutoff = timezone.now() - timedelta(days=days)
+        batch_size = options['batch_size']
+        batch_bytes = options['batch_mb'] * 1024 * 1024
+        dry_run = options['dry_run']
+        level = archive.compression_level()
+        pending = archive.candidates(cutoff).only('id', 'sha256', 'name', 'size').order_by('id')
+
+        last_id = 0
+        archived = missing = failed = before = after = 0
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            while True:
+                rows = list(pending.filter(id__gt=last_id)[:batch_size])
+                if not rows:
+                    break
+                batch, size = [], 0
+                for blob in rows:
+                    if batch and size + blob.size > batch_bytes:
+                        break
+                    batch.append(blob)
+                    size += blob.size
+                last_id = batch[-1].id
+                if dry_run:
+                    archived += len(batch)
+                    before += size
+                    continue
+
+                jobs = [(blob, pool.submit(archive.pack, blob_storage.path(blob.name), level)) for blob in batch]
+                packed = []
+                for blob, future in jobs:
+                    try:
+                        data, compressed = future.result()
+                    except FileNotFoundError:
+                        missing += 1
+                        continue
+                    except Exception as e:
+                        failed += 1
+                        logger.warning(f"Could not pack {blob.name}: {e}")
+                        continue
+                    packed.append((blob, data, compressed))
+                for blob in archive.store(packed, cutoff):
+                    archived += 1
+                    before += blob.size
+                    after += blob.segment_length
+
+        if dry_run:
+            self.stdout.write(self.style.SUCCESS(f'[dry run] {archived} files ({before} bytes) are due for the archive'))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {archived} files, {before} bytes packed into {after}; {missing} missing, {failed} failed'
+        ))
@@ -0,0 +1,56 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand
+from hospital import derivatives, imaging
+from hospital.models import Blob, Record
+from hospital.storage import blob_storage
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Render missing thumbnails and previews of existing records in a process pool, then trim the cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Files rendered concurrently')
+        parser.add_argument('--batch-size', type=int, default=500, help='Blobs read per query')
+        parser.add_argument('--force', action='store_true', help='Render again even where derivatives exist')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        force = options['force']
+        # One blob per distinct file, so shared content is rendered once; records only
+        # soft-deleted are left out, and so are files in the archive tier
+        live = Blob.objects.filter(refcount__gt=0, segment__isnull=True).only('id', 'sha256', 'name').order_by('id')
+
+        last_id = 0
+        rendered = failed = skipped = written = 0
+        with ProcessPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            while True:
+                batch = list(live.filter(id__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+                jobs = []
+                for blob in batch:
+                    if not imaging.can_render(blob.name) or not (force or derivatives.missing(blob.sha256)):
+                        skipped += 1
+                        continue
+                    jobs.append((blob, pool.submit(imaging.render, blob_storage.path(blob.name),
+                                                   derivatives.targets(blob.sha256), derivatives.quality())))
+                for blob, future in jobs:
+                    try:
+                        written += future.result()
+                        rendered += 1
+                    except Exception as e:
+                        failed += 1
+                        logger.warning(f"Could not render derivatives of {blob.name}: {e}")
+            removed, freed = pool.submit(imaging.evict, derivatives.root(), derivatives.max_bytes()).result()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendered {rendered} files ({written} bytes), {skipped} skipped, {failed} failed; '
+            f'evicted {removed} derivatives ({freed} bytes)'
+        ))
+        unhashed = Record.objects.filter(blob__isnull=True, is_deleted=False).exclude(prescription='').count()
+        if unhashed:
+            self.stdout.write(f'{unhashed} records are not in content-addressed storage yet; run dedupe_blobs first')
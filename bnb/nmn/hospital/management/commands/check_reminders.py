@@ -1,60 +1,50 @@
 from django.core.management.base import BaseCommand
-from django.core.mail import send_mail
-from hospital.models import Reminder
-from django.utils import timezone
-from django.conf import settings
-from datetime import timedelta
+from hospital import events, outbox, reminders
 import logging
+import signal
+import threading
 
 logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
     help = 'Send reminder emails'
 
-    def handle(self, *args, **kwargs):
-        now = timezone.now()
-        window_start = now - timedelta(minutes=1)
-        reminders = Reminder.objects.filter(date__gte=window_start, date__lte=now, notified=False)
-        sent_count = 0
-        for reminder in reminders:
-            try:
-                recipient = None
-                user_type = None
-                # Check doctor's package permission
-                if reminder.doctor:
-                    if not reminder.doctor.package or not reminder.doctor.package.can_set_reminders:
-                        logger.info(f"Skipping reminder {reminder.id}: Doctor's package does not allow reminders.")
-                        continue
-                    recipient = reminder.doctor.email
-                    user_type = "doctor"
-                elif reminder.patient:
-                    if not reminder.patient.package or not reminder.patient.package.can_set_reminders:
-                        logger.info(f"Skipping reminder {reminder.id}: Patient's package does not allow reminders.")
-                        continue
-                    recipient = reminder.patient.email
-                    user_type = "patient"
-                else:
-                    logger.info(f"Skipping reminder {reminder.id}: No doctor or patient assigned.")
-                    continue
-                if not recipient:
-                    logger.info(f"Skipping reminder {reminder.id}: No recipient email found.")
-                    continue
-                subject = f"[Pixeltre Medical] Reminder: {reminder.title}"
-                message = f"Dear {user_type.capitalize()},\n\nThis is a reminder for: {reminder.title}\nScheduled at: {reminder.date.strftime('%Y-%m-%d %H:%M')}\n\nThank you."
-
-                send_mail(
-                    subject=subject,
-                    message=message,
-                    from_email=getattr(settings, 'DEFAULT_FROM_EMAIL', None) or 'noreply@example.com',
-                    recipient_list=[recipient],
-                    fail_silently=False,
-                )
-                reminder.notified = True
-                reminder.save()
-                sent_count += 1
-                logger.info(f"Sent reminder to {recipient}")
-            except Exception as e:
-                logger.error(f"Failed to send reminder (ID {reminder.id}): {e}")
-        self.stdout.write(self.style.SUCCESS(f'Sent {sent_count} reminders'))
-        logger.info(f"Total reminders sent: {sent_count}")
+    def add_arguments(self, parser):
+        parser.add_argument('--daemon', action='store_true', help='Keep running, waking when the next reminder is due')
+        parser.add_argument('--batch-size', type=int, default=reminders.DEFAULT_BATCH_SIZE, help='Reminders claimed per transaction')
+        parser.add_argument('--max-sleep', type=float, default=60, help='Longest idle wait in daemon mode, in seconds')
+        parser.add_argument('--enqueue-only', action='store_true', help='Only write reminder emails to the outbox; leave sending to send_outbox')
 
+    def handle(self, *args, **options):
+        if options['daemon']:
+            return self.run_daemon(options)
+        reminders.resume_stale_series(batch_size=options['batch_size'])
+        totals = reminders.dispatch_due(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Queued {totals['queued']} reminders"))
+        logger.info(f"Total reminders queued: {totals['queued']} (skipped {totals['skipped']})")
+        events.prune()
+        if not options['enqueue_only']:
+            sent = outbox.drain()
+            self.stdout.write(self.style.SUCCESS(outbox.describe(sent)))
+            logger.info(outbox.describe(sent))
+
+    def run_daemon(self, options):
+        stop = threading.Event()
+
+        def request_stop(signum, frame):
+            logger.info(f"Reminder dispatcher stopping on signal {signum}")
+            stop.set()
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        def report(totals):
+            if totals['queued'] or totals['skipped']:
+                logger.info(f"Reminders queued: {totals['queued']} (skipped {totals['skipped']})")
+            if totals.get('sent') or totals.get('failed') or totals.get('dead'):
+                logger.info(outbox.describe(totals))
+
+        self.stdout.write(f'Reminder dispatcher running (catch-up window {reminders.lookback()})')
+        reminders.run_forever(stop, batch_size=options['batch_size'], max_sleep=options['max_sleep'],
+                              send=not options['enqueue_only'], on_dispatch=report)
+        self.stdout.write(self.style.SUCCESS('Reminder dispatcher stopped'))
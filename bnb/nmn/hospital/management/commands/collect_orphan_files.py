@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from hospital.models import Blob, Record
+from hospital.storage import BLOB_PREFIX, blob_storage
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Where record files were saved before content-addressed storage (see dedupe_blobs)
+LEGACY_PREFIX = 'prescriptions'
+
+
+def walk(root, relative):
+    """
+    ``(name, path, size, mtime)`` of every file under ``root/relative``,
+    streamed with os.scandir one directory at a time, never the whole listing.
+    """
+    subdirs = []
+    try:
+        with os.scandir(os.path.join(root, relative)) as entries:
+            for entry in entries:
+                name = f'{relative}/{entry.name}'
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(name)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    yield name, entry.path, stat.st_size, stat.st_mtime
+    except FileNotFoundError:
+        return
+    for subdir in subdirs:
+        yield from walk(root, subdir)
+
+
+def referenced(names):
+    """The ``names`` a blob or record still points at, in two indexed IN queries."""
+    # Blob files are named by digest; the name check catches a blob since renamed (compact_records)
+    digests = {os.path.basename(name).split('.')[0] for name in names if name.startswith(f'{BLOB_PREFIX}/')}
+    used = set(Blob.objects.filter(sha256__in=digests).values_list('name', flat=True)) if digests else set()
+    used.update(Record.objects.filter(prescription__in=names).values_list('prescription', flat=True))
+    return used
+
+
+def remove(path, cutoff):
+    """Bytes freed, or None if the file was left: gone already, or taken over by an upload since it was listed."""
+    try:
+        stat = os.stat(path)
+        if stat.st_mtime > cutoff:
+            return None
+        os.remove(path)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.error(f"Could not delete orphaned file {path}: {e}")
+        return None
+    return stat.st_size
+
+
+class Command(BaseCommand):
+    help = 'Delete files under MEDIA_ROOT that no record or blob references, streaming the directory tree'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Files deleted concurrently')
+        parser.add_argument('--batch-size', type=int, default=500, help='File names looked up per query')
+        parser.add_argument('--grace-hours', type=float, default=getattr(settings, 'ORPHAN_FILE_GRACE_HOURS', 24),
+                            help='Leave files modified more recently than this alone')
+        parser.add_argument('--dry-run', action='store_true', help='Report the orphans and their size without deleting anything')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        cutoff = time.time() - options['grace_hours'] * 3600
+        root = blob_storage.location
+
+        scanned = recent = orphaned = removed = freed = 0
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            # The previous batch's deletions run while the next batch is listed and looked up
+            deleting = []
+            for prefix in (BLOB_PREFIX, LEGACY_PREFIX):
+                files = walk(root, prefix)
+                while True:
+                    batch = []
+                    for name, path, size, mtime in files:
+                        scanned += 1
+                        if mtime > cutoff:
+                            recent += 1
+                            continue
+                        batch.append((name, path, size))
+                        if len(batch) == batch_size:
+                            break
+                    if not batch:
+                        break
+                    used = referenced([name for name, _, _ in batch])
+                    orphans = [(path, size) for name, path, size in batch if name not in used]
+                    orphaned += len(orphans)
+                    if dry_run:
+                        freed += sum(size for _, size in orphans)
+                        continue
+                    for future in deleting:
+                        size = future.result()
+                        if size is not None:
+                            removed += 1
+                            freed += size
+                    deleting = [pool.submit(remove, path, cutoff) for path, _ in orphans]
+            for future in deleting:
+                size = future.result()
+                if size is not None:
+                    removed += 1
+                    freed += size
+
+        if dry_run:
+            summary = f'[dry run] Found {orphaned} orphaned files ({freed} bytes)'
+        else:
+            summary = f'Removed {removed} orphaned files, reclaiming {freed} bytes'
+        summary += f' among {scanned} scanned; {recent} within the grace period left alone'
+        logger.info(summary)
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,109 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from hospital import blobs, imaging, ingest, usage
+from hospital.models import Blob, Record
+from hospital.storage import blob_name, blob_storage
+import logging
+import os
+import uuid
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Recompress and strip metadata from stored JPEG and PNG files that have not been through ingest, in a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Files compacted concurrently')
+        parser.add_argument('--batch-size', type=int, default=200, help='Files compacted per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Report the saving without replacing anything')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        # Stored content is in blobs/ once dedupe_blobs has moved the old prescriptions/ tree;
+        # archived files are left as they were packed
+        pending = (Blob.objects.filter(records__original_size__isnull=True, segment__isnull=True)
+                   .filter(Q(name__endswith='.jpg') | Q(name__endswith='.png'))
+                   .distinct().only('id', 'sha256', 'name', 'size').order_by('id'))
+
+        last_id = 0
+        compacted = unchanged = failed = before = after = 0
+        with ProcessPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            while True:
+                batch = list(pending.filter(id__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+                jobs = []
+                for blob in batch:
+                    target = None if dry_run else blob_storage.path(f'{blob.name}.{uuid.uuid4().hex}.partial')
+                    jobs.append((blob, target, pool.submit(imaging.compact, blob_storage.path(blob.name), target, *ingest.options())))
+                results = []
+                for blob, target, future in jobs:
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        failed += 1
+                        logger.warning(f"Could not compact {blob.name}: {e}")
+                        result = None
+                    if result is None:
+                        unchanged += 1
+                    else:
+                        compacted += 1
+                        before += blob.size
+                        after += result[1]
+                    results.append((blob, target, result))
+                if not dry_run:
+                    self.replace(results)
+
+        prefix = '[dry run] ' if dry_run else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}Compacted {compacted} files from {before} to {after} bytes; {unchanged} left as they were, {failed} failed'
+        ))
+        unhashed = Record.objects.filter(blob__isnull=True, is_deleted=False).exclude(prescription='').count()
+        if unhashed:
+            self.stdout.write(f'{unhashed} records are not in content-addressed storage yet; run dedupe_blobs first')
+
+    def replace(self, results):
+        """Point every record of each compacted blob at the new content, and mark the rest as done."""
+        old_blobs = []
+        with transaction.atomic():
+            for blob, target, result in results:
+                # Held until commit, so an upload of the old content waits rather than taking a reference to it
+                Blob.objects.select_for_update().filter(pk=blob.pk).first()
+                records = list(Record.objects.select_for_update().filter(blob_id=blob.pk))
+                if result is None:
+                    Record.objects.filter(pk__in=[record.pk for record in records], original_size__isnull=True).update(
+                        original_size=blob.size)
+                    continue
+                ext, size, sha256 = result
+                live = sum(1 for record in records if not record.is_deleted)
+                new_blob = Blob.acquire(sha256, blob_name(sha256, ingest.renamed(blob.name, ext)), size, references=live)
+                if blob_storage.exists(new_blob.name):
+                    os.remove(target)
+                else:
+                    os.makedirs(os.path.dirname(blob_storage.path(new_blob.name)), exist_ok=True)
+                    os.replace(target, blob_storage.path(new_blob.name))
+                resized = defaultdict(int)
+                for record in records:
+                    if not record.is_deleted:
+                        resized[record.patient_id] += size - record.file_size
+                    record.original_size = record.original_size or record.file_size
+                    record.prescription.name = new_blob.name
+                    record.blob = new_blob
+                    record.sha256 = sha256
+                    record.file_size = size
+                    record.file_name = ingest.renamed(record.file_name, ext) if record.file_name else record.file_name
+                Record.objects.bulk_update(records, ['original_size', 'prescription', 'blob', 'sha256', 'file_size', 'file_name'])
+                for patient_id, delta in resized.items():
+                    usage.bytes_changed(patient_id, delta)
+                Blob.objects.filter(pk=blob.pk).delete()
+                old_blobs.append(blob)
+            transaction.on_commit(lambda: self.discard(old_blobs))
+
+    def discard(self, old_blobs):
+        for blob in old_blobs:
+            blobs.discard(blob)
@@ -0,0 +1,97 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from hospital.blobs import hash_file
+from hospital.models import Blob, Record
+from hospital.storage import blob_name, blob_storage
+import logging
+import os
+import shutil
+import uuid
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Hash existing record files in parallel, move them into content-addressed storage and collapse duplicates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Files hashed concurrently')
+        parser.add_argument('--batch-size', type=int, default=500, help='Records moved per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Hash and report without moving anything')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        pending = (Record.objects.filter(blob__isnull=True).exclude(prescription='')
+                   .only('id', 'prescription', 'is_deleted', 'file_name').order_by('id'))
+
+        last_id = 0
+        moved = missing = freed = 0
+        seen = {}
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                batch = list(pending.filter(id__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+                digests = pool.map(hash_file, [blob_storage.path(record.prescription.name) for record in batch])
+                groups = defaultdict(list)
+                for record, digest in zip(batch, digests):
+                    if digest is None:
+                        missing += 1
+                        logger.warning(f"Record {record.id} file is missing: {record.prescription.name}")
+                        continue
+                    groups[digest].append(record)
+                for (sha256, size), records in groups.items():
+                    # Every copy after the first, in this batch or an earlier one, is reclaimed
+                    freed += size * (len(records) - (0 if sha256 in seen else 1))
+                    seen[sha256] = size
+                    moved += len(records)
+                if not dry_run:
+                    self.move(groups)
+
+        prefix = '[dry run] ' if dry_run else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}Moved {moved} records into {len(seen)} blobs, reclaiming {freed} bytes; {missing} files missing'
+        ))
+
+    def move(self, groups):
+        old_names = set()
+        with transaction.atomic():
+            for (sha256, size), records in groups.items():
+                name = blob_name(sha256, records[0].prescription.name)
+                live = sum(1 for record in records if not record.is_deleted)
+                blob = Blob.acquire(sha256, name, size, references=live)
+                if not blob_storage.exists(blob.name):
+                    self.adopt(records[0].prescription.name, blob.name)
+                for record in records:
+                    old_names.add(record.prescription.name)
+                    record.file_name = record.file_name or os.path.basename(record.prescription.name)[-255:]
+                    record.prescription.name = blob.name
+                    record.blob = blob
+                    record.sha256 = sha256
+                    record.file_size = size
+            Record.objects.bulk_update([record for records in groups.values() for record in records],
+                                       ['prescription', 'blob', 'file_name', 'sha256', 'file_size'], batch_size=500)
+            transaction.on_commit(lambda: self.remove(old_names))
+
+    def adopt(self, old_name, new_name):
+        """Put a copy of ``old_name`` at ``new_name``, linking rather than copying where the filesystem allows."""
+        source, target = blob_storage.path(old_name), blob_storage.path(new_name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        partial = f'{target}.{uuid.uuid4().hex}.partial'
+        try:
+            os.link(source, partial)
+        except OSError:
+            shutil.copyfile(source, partial)
+        os.replace(partial, target)
+
+    def remove(self, old_names):
+        # Another record not yet moved may share a path (seeded or copied rows)
+        still_used = set(Record.objects.filter(prescription__in=list(old_names)).values_list('prescription', flat=True))
+        for name in old_names - still_used:
+            try:
+                blob_storage.delete(name)
+            except OSError as e:
+                logger.error(f"Could not delete {name}: {e}")
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+from hospital import resumable
+from hospital.models import UploadSession
+import logging
+import os
+import shutil
+import uuid
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Delete expired or finalized resumable uploads and any chunk directories left without a session'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Sessions deleted per query')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        now = timezone.now()
+        stale = UploadSession.objects.filter(Q(expires_at__lte=now) | Q(record__isnull=False)).order_by('expires_at')
+
+        expired = 0
+        while True:
+            batch = list(stale.values_list('id', flat=True)[:batch_size])
+            if not batch:
+                break
+            UploadSession.objects.filter(id__in=batch).delete()
+            for session_id in batch:
+                shutil.rmtree(os.path.join(resumable.root(), str(session_id)), ignore_errors=True)
+            expired += len(batch)
+
+        # Directories whose session row is gone, e.g. a chunk that landed while its session was deleted
+        orphans = 0
+        try:
+            entries = list(os.scandir(resumable.root()))
+        except FileNotFoundError:
+            entries = []
+        names = {}
+        for entry in entries:
+            try:
+                names[uuid.UUID(entry.name)] = entry
+            except ValueError:
+                continue
+        live = set()
+        ids = list(names)
+        for start in range(0, len(ids), batch_size):
+            live.update(UploadSession.objects.filter(id__in=ids[start:start + batch_size]).values_list('id', flat=True))
+        # The row is created before the first chunk, so a directory without one is garbage
+        for session_id, entry in names.items():
+            if session_id not in live:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                orphans += 1
+
+        logger.info(f"Expired {expired} upload sessions, removed {orphans} orphaned chunk directories")
+        self.stdout.write(self.style.SUCCESS(f'Expired {expired} upload sessions, removed {orphans} orphaned chunk directories'))
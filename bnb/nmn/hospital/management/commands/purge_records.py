@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from hospital import purge
+
+class Command(BaseCommand):
+    help = 'Hard-delete records soft-deleted longer ago than the retention period, with their files, in small transactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, default=None,
+                            help=f'Days a deleted record is kept (default PURGE_RETENTION_DAYS, {purge.retention_days()})')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'PURGE_BATCH_SIZE', 200),
+                            help='Records deleted per transaction')
+        parser.add_argument('--pause', type=float, default=getattr(settings, 'PURGE_PAUSE_SECONDS', 0.5),
+                            help='Seconds to sleep between transactions')
+        parser.add_argument('--max-batches', type=int, default=None, help='Stop after this many transactions')
+        parser.add_argument('--dry-run', action='store_true', help='Report what is due without deleting anything')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            records, size = purge.pending(purge.cutoff(options['retention_days']))
+            self.stdout.write(self.style.SUCCESS(
+                f'[dry run] {records} records are due for purging, holding up to {size} bytes'
+            ))
+            return
+
+        totals = purge.purge(days=options['retention_days'], batch_size=options['batch_size'],
+                             pause=options['pause'], max_batches=options['max_batches'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Purged {totals['records']} records in {totals['batches']} batches, "
+            f"reclaiming {totals['bytes']} bytes ({totals['files']} files)"
+        ))
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from hospital.models import User, UsageLedger
+from hospital.usage import compute_usage
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Rebuild and reconcile the per-patient usage ledger from the files on disk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Patients processed per transaction')
+        parser.add_argument('--no-stat', action='store_true', help='Trust stored file sizes and only stat records without one')
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without writing anything')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        stat_files = not options['no_stat']
+        dry_run = options['dry_run']
+        patient_ids = User.objects.filter(user_type='patient').order_by('id').values_list('id', flat=True)
+
+        last_id = 0
+        checked = drifted = created = resized_total = 0
+        while True:
+            batch = list(patient_ids.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1]
+            with transaction.atomic():
+                # Hold the ledger rows so concurrent uploads wait for the rebuilt totals
+                existing = {ledger.user_id: ledger for ledger in UsageLedger.objects.select_for_update().filter(user_id__in=batch)}
+                totals, resized = compute_usage(batch, stat_files=stat_files)
+                resized_total += resized
+                now = timezone.now()
+                to_update, to_create = [], []
+                for user_id, values in totals.items():
+                    ledger = existing.get(user_id)
+                    if ledger is None:
+                        to_create.append(UsageLedger(user_id=user_id, updated_at=now, **values))
+                        continue
+                    if any(getattr(ledger, field) != value for field, value in values.items()):
+                        logger.info(f"Usage drift for user {user_id}: "
+                                    f"{ledger.bytes_used}/{ledger.upload_count}/{ledger.share_count} -> "
+                                    f"{values['bytes_used']}/{values['upload_count']}/{values['share_count']}")
+                        for field, value in values.items():
+                            setattr(ledger, field, value)
+                        ledger.updated_at = now
+                        to_update.append(ledger)
+                checked += len(batch)
+                drifted += len(to_update)
+                created += len(to_create)
+                if dry_run:
+                    transaction.set_rollback(True)
+                    continue
+                UsageLedger.objects.bulk_create(to_create, batch_size=500)
+                UsageLedger.objects.bulk_update(to_update, ['bytes_used', 'upload_count', 'share_count', 'updated_at'], batch_size=500)
+
+        prefix = '[dry run] ' if dry_run else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}Checked {checked} patients: {created} ledgers created, {drifted} corrected, {resized_total} file sizes updated'
+        ))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from hospital import archive
+from hospital.models import Blob
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Bring archived files back to the hot tier: those of the given records or patients, or all of them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--record', type=int, action='append', default=[], help='Record id; may be repeated')
+        parser.add_argument('--patient', type=int, action='append', default=[], help='Patient id; may be repeated')
+        parser.add_argument('--all', action='store_true', help='Every archived file')
+        parser.add_argument('--batch-size', type=int, default=200, help='Blobs read per query')
+
+    def handle(self, *args, **options):
+        pending = Blob.objects.filter(segment__isnull=False)
+        if options['record'] or options['patient']:
+            if options['record']:
+                pending = pending.filter(records__id__in=options['record'])
+            if options['patient']:
+                pending = pending.filter(records__patient_id__in=options['patient'])
+            pending = pending.distinct()
+        elif not options['all']:
+            raise CommandError('Name the records (--record) or patients (--patient) to rehydrate, or pass --all')
+        pending = pending.only('id').order_by('id')
+
+        last_id = 0
+        restored = failed = 0
+        while True:
+            batch = list(pending.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            for blob in batch:
+                try:
+                    restored += archive.rehydrate(blob)
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"Could not rehydrate blob {blob.pk}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(f'Rehydrated {restored} files, {failed} failed'))
@@ -0,0 +1,328 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from hospital.models import Package, Record, Reminder, SharedLink, UsageLedger, User
+import io
+import itertools
+import os
+import random
+import time
+import uuid
+
+PACKAGE_TIERS = [
+    # name, price, can_share, can_set_reminders, can_delete, max_storage_mb, max_uploads, max_shares
+    ('Free', '0.00', False, False, False, 50, 10, 0),
+    ('Basic', '199.00', True, True, True, 500, 100, 5),
+    ('Plus', '499.00', True, True, True, 2000, 500, 20),
+    ('Unlimited', '999.00', True, True, True, 0, -1, 0),
+]
+
+
+def rng_for(key, kind, index):
+    """A private RNG per generated entity, so output is identical however the work is chunked."""
+    return random.Random(f'{key}:{kind}:{index}')
+
+
+def minimal_pdf(text):
+    """A valid one-page PDF with a line of text."""
+    content = f'BT /F1 14 Tf 20 60 Td ({text}) Tj ET'.encode()
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 300 120] /Contents 4 0 R '
+        b'/Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    out = io.BytesIO()
+    out.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b'%d 0 obj\n%s\nendobj\n' % (number, body))
+    xref = out.tell()
+    out.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b'%010d 00000 n \n' % offset)
+    out.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def small_jpeg(rng, fmt='JPEG'):
+    from PIL import Image, ImageDraw
+    image = Image.new('RGB', (64, 48), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(4):
+        x, y = rng.randrange(60), rng.randrange(44)
+        draw.rectangle([x, y, x + rng.randrange(4, 30), y + rng.randrange(2, 12)], fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, quality=70)
+    return buffer.getvalue()
+
+
+def write_files(media_root, seed, specs):
+    """Worker: write ``(record_index, relative_path)`` files and return their sizes in order."""
+    sizes = []
+    made_dirs = set()
+    for index, name in specs:
+        rng = rng_for(seed, 'file', index)
+        if name.endswith('.pdf'):
+            data = minimal_pdf(f'Prescription {index}')
+        else:
+            data = small_jpeg(rng, 'PNG' if name.endswith('.png') else 'JPEG')
+        path = os.path.join(media_root, name)
+        directory = os.path.dirname(path)
+        if directory not in made_dirs:
+            os.makedirs(directory, exist_ok=True)
+            made_dirs.add(directory)
+        with open(path, 'wb') as f:
+            f.write(data)
+        sizes.append(len(data))
+    return sizes
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = 'Generate a deterministic synthetic dataset (packages, users, records with files, shares, links, reminders)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=1, help='Same seed and options produce the same dataset')
+        parser.add_argument('--prefix', default='seed', help='Username prefix, so several datasets can coexist')
+        parser.add_argument('--doctors', type=int, default=50)
+        parser.add_argument('--patients', type=int, default=1000)
+        parser.add_argument('--doctors-per-patient', type=int, default=2, help='Assigned doctors per patient (max)')
+        parser.add_argument('--records-per-patient', type=float, default=5, help='Mean records per patient')
+        parser.add_argument('--share-ratio', type=float, default=0.2, help='Fraction of records shared with another doctor')
+        parser.add_argument('--link-ratio', type=float, default=0.1, help='Fraction of records with a share link')
+        parser.add_argument('--reminders-per-patient', type=float, default=2, help='Mean reminders per patient')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Rows per bulk_create')
+        parser.add_argument('--workers', type=int, default=0, help='Processes writing files (0 writes in this process)')
+        parser.add_argument('--no-files', action='store_true', help='Create records without writing files to MEDIA_ROOT')
+        parser.add_argument('--password', default='Seed-Pass-2025', help='Password shared by every generated user')
+        parser.add_argument('--anchor', help='ISO datetime upload/reminder dates are spread around (default: now)')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.seed = options['seed']
+        self.prefix = options['prefix']
+        self.batch_size = options['batch_size']
+        self.anchor = parse_datetime(options['anchor']) if options['anchor'] else timezone.now()
+        if self.anchor is None:
+            raise CommandError('--anchor must be an ISO datetime')
+        if User.objects.filter(username__startswith=f'{self.prefix}-').exists():
+            raise CommandError(f"Users prefixed '{self.prefix}-' already exist; pick another --prefix")
+
+        started = time.monotonic()
+        packages = self.seed_packages()
+        password = make_password(options['password'])
+        self.doctor_ids = self.seed_users('doctor', options['doctors'], packages, password)
+        self.patient_ids = self.seed_users('patient', options['patients'], packages, password)
+        if not self.doctor_ids or not self.patient_ids:
+            raise CommandError('Need at least one doctor and one patient')
+        self.seed_assignments()
+        usage = self.seed_records()
+        self.seed_ledgers(usage)
+        self.seed_reminders()
+        self.stdout.write(self.style.SUCCESS(f'Seeded dataset {self.prefix!r} in {time.monotonic() - started:.1f}s'))
+
+    def report(self, label, count, since):
+        elapsed = time.monotonic() - since
+        rate = count / elapsed if elapsed else count
+        self.stdout.write(f'  {label}: {count} rows in {elapsed:.1f}s ({rate:,.0f}/s)')
+
+    def seed_packages(self):
+        packages = []
+        for name, price, can_share, can_remind, can_delete, storage, uploads, shares in PACKAGE_TIERS:
+            package, _ = Package.objects.get_or_create(name=f'{self.prefix} {name}', defaults={
+                'price': Decimal(price), 'can_share': can_share, 'can_set_reminders': can_remind, 'can_delete': can_delete,
+                'max_storage_mb': storage, 'max_uploads': uploads, 'max_shares': shares,
+            })
+            packages.append(package)
+        return packages
+
+    def seed_users(self, user_type, count, packages, password):
+        since = time.monotonic()
+        for chunk in chunked(range(count), self.batch_size):
+            users = []
+            for i in chunk:
+                rng = rng_for(self.seed, user_type, i)
+                users.append(User(
+                    username=f'{self.prefix}-{user_type}-{i}', email=f'{self.prefix}-{user_type}-{i}@example.com',
+                    password=password, user_type=user_type, phone_number=f'{rng.randrange(10 ** 10):010d}',
+                    first_name=user_type.capitalize(), last_name=str(i),
+                    package=packages[rng.randrange(1, len(packages))] if user_type == 'doctor' else rng.choice(packages),
+                ))
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+        ids = list(User.objects.filter(username__startswith=f'{self.prefix}-{user_type}-')
+                   .order_by('id').values_list('id', flat=True))
+        self.report(f'{user_type}s', len(ids), since)
+        return ids
+
+    def patient_doctors(self, patient_index):
+        rng = rng_for(self.seed, 'assign', patient_index)
+        wanted = min(len(self.doctor_ids), rng.randint(1, max(1, self.options['doctors_per_patient'])))
+        return rng.sample(self.doctor_ids, wanted)
+
+    def seed_assignments(self):
+        since = time.monotonic()
+        Through = User.patients.through
+        total = 0
+        for chunk in chunked(range(len(self.patient_ids)), self.batch_size):
+            rows = [Through(from_user_id=doctor_id, to_user_id=self.patient_ids[i])
+                    for i in chunk for doctor_id in self.patient_doctors(i)]
+            with transaction.atomic():
+                Through.objects.bulk_create(rows, ignore_conflicts=True)
+            total += len(rows)
+        self.report('doctor-patient assignments', total, since)
+
+    def record_specs(self):
+        """Yield (record_index, patient_index, rng) for every record, in a fixed order."""
+        mean = self.options['records_per_patient']
+        record_index = 0
+        for patient_index in range(len(self.patient_ids)):
+            count = rng_for(self.seed, 'record-count', patient_index).randint(0, max(0, round(mean * 2)))
+            for _ in range(count):
+                yield record_index, patient_index, rng_for(self.seed, 'record', record_index)
+                record_index += 1
+
+    def build_records(self, chunk):
+        records = []
+        for record_index, patient_index, rng in chunk:
+            kind = rng.choices(['jpg', 'png', 'pdf'], weights=[6, 1, 3])[0]
+            record = Record(
+                patient_id=self.patient_ids[patient_index],
+                doctor_id=rng.choice(self.patient_doctors(patient_index)),
+                prescription=f'prescriptions/{self.prefix}/{record_index // 1000:05d}/rx-{self.seed}-{record_index}.{kind}',
+                description=f'Synthetic record {record_index}',
+            )
+            record.seed_index = record_index
+            records.append(record)
+        return records
+
+    def seed_records(self):
+        since = time.monotonic()
+        workers = self.options['workers']
+        write = not self.options['no_files']
+        media_root = str(settings.MEDIA_ROOT)
+        usage = {}
+        totals = {'records': 0, 'shares': 0, 'links': 0, 'bytes': 0}
+
+        chunks = (self.build_records(chunk) for chunk in chunked(self.record_specs(), self.batch_size))
+        pool = ProcessPoolExecutor(max_workers=workers) if write and workers > 0 else None
+        try:
+            def with_sizes():
+                if not write:
+                    for records in chunks:
+                        yield records, [0] * len(records)
+                    return
+                if pool is None:
+                    for records in chunks:
+                        yield records, write_files(media_root, self.seed, self.file_specs(records))
+                    return
+                # Keep a bounded number of chunks in flight so memory stays flat
+                pending = []
+                for records in chunks:
+                    pending.append((records, pool.submit(write_files, media_root, self.seed, self.file_specs(records))))
+                    if len(pending) > workers * 2:
+                        records, future = pending.pop(0)
+                        yield records, future.result()
+                for records, future in pending:
+                    yield records, future.result()
+
+            for records, sizes in with_sizes():
+                for record, size in zip(records, sizes):
+                    record.file_size = size
+                self.insert_records(records, usage, totals)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        self.report('records', totals['records'], since)
+        self.stdout.write(f"  files: {totals['bytes'] / (1024 * 1024):.1f} MB, shares: {totals['shares']}, links: {totals['links']}")
+        return usage
+
+    def file_specs(self, records):
+        return [(record.seed_index, record.prescription.name) for record in records]
+
+    def insert_records(self, records, usage, totals):
+        with transaction.atomic():
+            created = Record.objects.bulk_create(records)
+            if created and created[0].pk is None:
+                # Backends without RETURNING (MySQL): read the ids back by file name
+                ids = dict(Record.objects.filter(prescription__in=[r.prescription.name for r in records])
+                           .values_list('prescription', 'id'))
+                for record in records:
+                    record.pk = record.id = ids[record.prescription.name]
+
+            SharedWith = Record.shared_with.through
+            shares, links = [], []
+            for record in records:
+                rng = rng_for(self.seed, 'share', record.seed_index)
+                entry = usage.setdefault(record.patient_id, [0, 0, 0])
+                entry[0] += record.file_size
+                entry[1] += 1
+                if rng.random() < self.options['share_ratio']:
+                    doctor_id = rng.choice(self.doctor_ids)
+                    if doctor_id != record.doctor_id:
+                        shares.append(SharedWith(record_id=record.pk, user_id=doctor_id))
+                        entry[2] += 1
+                if rng.random() < self.options['link_ratio']:
+                    # Tokens are unique across the table, so they also depend on the prefix
+                    token_rng = rng_for(f'{self.prefix}:{self.seed}', 'link', record.seed_index)
+                    links.append(SharedLink(
+                        record_id=record.pk, token=str(uuid.UUID(int=token_rng.getrandbits(128), version=4)),
+                        expires_at=self.anchor + timedelta(hours=rng.randint(-72, 72)),
+                    ))
+            SharedWith.objects.bulk_create(shares)
+            SharedLink.objects.bulk_create(links)
+        totals['records'] += len(records)
+        totals['shares'] += len(shares)
+        totals['links'] += len(links)
+        totals['bytes'] += sum(record.file_size for record in records)
+
+    def seed_ledgers(self, usage):
+        since = time.monotonic()
+        now = timezone.now()
+        rows = (UsageLedger(user_id=user_id, bytes_used=values[0], upload_count=values[1], share_count=values[2], updated_at=now)
+                for user_id, values in usage.items())
+        for chunk in chunked(rows, self.batch_size):
+            with transaction.atomic():
+                UsageLedger.objects.bulk_create(chunk)
+        self.report('usage ledgers', len(usage), since)
+
+    def seed_reminders(self):
+        since = time.monotonic()
+        mean = self.options['reminders_per_patient']
+
+        def reminders():
+            for patient_index, patient_id in enumerate(self.patient_ids):
+                rng = rng_for(self.seed, 'reminder', patient_index)
+                for n in range(rng.randint(0, max(0, round(mean * 2)))):
+                    date = self.anchor + timedelta(minutes=rng.randint(-30 * 24 * 60, 30 * 24 * 60))
+                    for_doctor = rng.random() < 0.3
+                    yield Reminder(
+                        title=f'Synthetic reminder {patient_index}-{n}', date=date, next_fire_at=date, notified=date < self.anchor,
+                        patient_id=None if for_doctor else patient_id,
+                        doctor_id=rng.choice(self.patient_doctors(patient_index)) if for_doctor else None,
+                    )
+
+        total = 0
+        for chunk in chunked(reminders(), self.batch_size):
+            with transaction.atomic():
+                Reminder.objects.bulk_create(chunk)
+            total += len(chunk)
+        self.report('reminders', total, since)
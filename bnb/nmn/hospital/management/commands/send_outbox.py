@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from hospital import outbox
+import logging
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Send queued outbound emails, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Concurrent SMTP connections (default: OUTBOX_WORKERS)')
+        parser.add_argument('--batch-size', type=int, help='Messages claimed per round (default: OUTBOX_BATCH_SIZE)')
+        parser.add_argument('--daemon', action='store_true', help='Keep running, waking when the next message is due')
+        parser.add_argument('--max-sleep', type=float, default=30, help='Longest idle wait in daemon mode, in seconds')
+        parser.add_argument('--stats', action='store_true', help='Print queue depth and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            return self.print_stats()
+        if not options['daemon']:
+            totals = outbox.drain(workers=options['workers'], batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(outbox.describe(totals)))
+            return
+
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+        self.stdout.write('Outbox worker running')
+        while not stop.is_set():
+            close_old_connections()
+            delay = options['max_sleep']
+            try:
+                totals = outbox.drain(workers=options['workers'], batch_size=options['batch_size'])
+                if totals['sent'] or totals['failed'] or totals['dead']:
+                    logger.info(outbox.describe(totals))
+                due = outbox.next_attempt_at()
+                if due is not None:
+                    delay = max(0.0, min(delay, (due - timezone.now()).total_seconds()))
+            except Exception as e:
+                logger.error(f"Outbox drain failed: {e}")
+            stop.wait(delay)
+        self.stdout.write(self.style.SUCCESS('Outbox worker stopped'))
+
+    def print_stats(self):
+        now = timezone.now()
+        for status, row in outbox.queue_stats().items():
+            age = f", oldest {(now - row['oldest']).total_seconds():.0f}s old" if row['oldest'] else ''
+            self.stdout.write(f"{status}: {row['count']}{age}")
@@ -0,0 +1,251 @@
+"""
+Per-route request metrics, exposed in the Prometheus text format at /api/metrics/.
+
+Counters live in this process: under a multi-worker server each worker reports
+its own totals, told apart by the ``pid`` label the endpoint adds.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from bisect import bisect_left
+from django.conf import settings
+from django.db import connection
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Routes whose body is a stored file; their bytes are also counted on their own
+FILE_ROUTES = frozenset({'download_record', 'view_shared_record'})
+
+UNMATCHED = 'unmatched'
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    """Counters and histograms keyed by label tuple, behind one lock."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.requests = {}        # (route, method, status) -> count
+        self.latency = {}         # (route, method) -> Histogram
+        self.queries = {}         # route -> Histogram
+        self.db_seconds = {}      # route -> float
+        self.response_size = {}   # route -> Histogram
+        self.file_bytes = {}      # route -> int
+
+    def reset(self):
+        with self.lock:
+            self._clear()
+
+    def observe_request(self, route, method, status, seconds, queries, db_seconds):
+        with self.lock:
+            key = (route, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get((route, method))
+            if histogram is None:
+                histogram = self.latency[(route, method)] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+            histogram = self.queries.get(route)
+            if histogram is None:
+                histogram = self.queries[route] = Histogram(QUERY_BUCKETS)
+            histogram.observe(queries)
+            self.db_seconds[route] = self.db_seconds.get(route, 0) + db_seconds
+
+    def observe_size(self, route, size):
+        with self.lock:
+            histogram = self.response_size.get(route)
+            if histogram is None:
+                histogram = self.response_size[route] = Histogram(SIZE_BUCKETS)
+            histogram.observe(size)
+            if route in FILE_ROUTES:
+                self.file_bytes[route] = self.file_bytes.get(route, 0) + size
+
+    def render(self):
+        pid = str(os.getpid())
+        lines = []
+        with self.lock:
+            _counter(lines, 'http_requests_total', 'Requests by route, method and status code.',
+                     (({'route': r, 'method': m, 'status': s, 'pid': pid}, n) for (r, m, s), n in sorted(self.requests.items())))
+            _histogram(lines, 'http_request_duration_seconds', 'Time until the response is returned by the view stack.',
+                       (({'route': r, 'method': m, 'pid': pid}, h) for (r, m), h in sorted(self.latency.items())))
+            _histogram(lines, 'http_request_db_queries', 'SQL queries run per request.',
+                       (({'route': r, 'pid': pid}, h) for r, h in sorted(self.queries.items())))
+            _counter(lines, 'http_request_db_seconds_total', 'Time spent executing SQL.',
+                     (({'route': r, 'pid': pid}, n) for r, n in sorted(self.db_seconds.items())))
+            _histogram(lines, 'http_response_size_bytes', 'Response body size.',
+                       (({'route': r, 'pid': pid}, h) for r, h in sorted(self.response_size.items())))
+            _counter(lines, 'file_bytes_streamed_total', 'Stored-file bytes sent by download and share-link routes.',
+                     (({'route': r, 'pid': pid}, n) for r, n in sorted(self.file_bytes.items())))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    pairs = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _counter(lines, name, help_text, samples):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} counter')
+    for labels, value in samples:
+        lines.append(f'{name}{_labels(labels)} {_number(value)}')
+
+
+def _gauge(lines, name, help_text, samples):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} gauge')
+    for labels, value in samples:
+        lines.append(f'{name}{_labels(labels)} {_number(value)}')
+
+
+def render_gauge(name, help_text, samples):
+    """Text for one gauge family, for values read at scrape time (e.g. from the database)."""
+    lines = []
+    _gauge(lines, name, help_text, samples)
+    return '\n'.join(lines) + '\n'
+
+
+def _histogram(lines, name, help_text, samples):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for labels, histogram in samples:
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels({**labels, "le": bound})} {cumulative}')
+        lines.append(f'{name}_sum{_labels(labels)} {_number(histogram.total)}')
+        lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+
+
+registry = Registry()
+
+
+class _SQLTimer:
+    __slots__ = ('queries', 'seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.queries += 1
+
+
+async def _acounted(route, chunks):
+    size = 0
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        registry.observe_size(route, size)
+
+
+def _counted(route, chunks):
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        registry.observe_size(route, size)
+
+
+def add_execute_wrapper(wrapper):
+    connection.execute_wrappers.append(wrapper)
+
+
+def remove_execute_wrapper(wrapper):
+    connection.execute_wrappers.remove(wrapper)
+
+
+class MetricsMiddleware:
+    """
+    Record latency, SQL and response size for every request, labelled by URL
+    name so the series stay bounded whatever paths clients send.
+
+    Works in both modes, so under ASGI async views run on the event loop
+    rather than being pushed back onto a thread by this middleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'METRICS_ENABLED', True)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        timer = _SQLTimer()
+        started = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        return self.observe(request, response, time.perf_counter() - started, timer)
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        timer = _SQLTimer()
+        # The request's ORM calls run on its sync thread, so the timer goes on that thread's connection
+        await sync_to_async(add_execute_wrapper)(timer)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(remove_execute_wrapper)(timer)
+        return self.observe(request, response, time.perf_counter() - started, timer)
+
+    def observe(self, request, response, elapsed, timer):
+        match = request.resolver_match
+        route = (match.url_name if match else None) or UNMATCHED
+        registry.observe_request(route, request.method, response.status_code, elapsed, timer.queries, timer.seconds)
+
+        if not response.streaming:
+            registry.observe_size(route, len(response.content))
+        elif response.has_header('Content-Length'):
+            # FileResponse sets the length up front, and may be handed to the
+            # server's sendfile path, which never iterates streaming_content
+            registry.observe_size(route, int(response['Content-Length']))
+        elif response.is_async:
+            response.streaming_content = _acounted(route, response.streaming_content)
+        else:
+            response.streaming_content = _counted(route, response.streaming_content)
+        return response
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('hospital', '0003_usage_ledger'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['patient', 'is_deleted', 'upload_date'], name='record_patient_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['doctor', 'is_deleted', 'upload_date'], name='record_doctor_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reminder',
+            index=models.Index(fields=['date', 'notified'], name='reminder_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sharedlink',
+            index=models.Index(fields=['expires_at'], name='sharedlink_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['user_type'], name='user_type_idx'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:28
+
+from django.db import migrations, models
+
+
+def backfill_next_fire_at(apps, schema_editor):
+    # Existing reminders are all one-shot: their only occurrence is their date
+    Reminder = apps.get_model('hospital', 'Reminder')
+    Reminder.objects.filter(next_fire_at__isnull=True).update(next_fire_at=models.F('date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0005_outbound_email'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='reminder',
+            name='reminder_pending_idx',
+        ),
+        migrations.AddField(
+            model_name='reminder',
+            name='byday',
+            field=models.CharField(blank=True, default='', help_text='Weekdays, e.g. MO,WE,FR', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='reminder',
+            name='byhour',
+            field=models.CharField(blank=True, default='', help_text='Hours of the day, e.g. 8,14,20', max_length=72),
+        ),
+        migrations.AddField(
+            model_name='reminder',
+            name='count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reminder',
+            name='fired_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='reminder',
+            name='freq',
+            field=models.CharField(blank=True, choices=[('', 'Once'), ('hourly', 'Hourly'), ('daily', 'Daily'), ('weekly', 'Weekly')], default='', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='reminder',
+            name='interval',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='reminder',
+            name='next_fire_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reminder',
+            name='until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='reminder',
+            index=models.Index(fields=['next_fire_at', 'notified'], name='reminder_next_fire_idx'),
+        ),
+        migrations.RunPython(backfill_next_fire_at, migrations.RunPython.noop),
+    ]
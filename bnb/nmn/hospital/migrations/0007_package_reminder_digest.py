@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0006_reminder_recurrence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='package',
+            name='reminder_digest_minutes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
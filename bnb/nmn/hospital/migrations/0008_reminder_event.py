@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:39
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0007_package_reminder_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReminderEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField()),
+                ('reminder_id', models.IntegerField(blank=True, null=True)),
+                ('title', models.CharField(max_length=255)),
+                ('scheduled_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_id', 'id'], name='reminder_event_replay_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0008_reminder_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reminder',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='reminder',
+            index=models.Index(fields=['patient', 'date', 'updated_at'], name='reminder_patient_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reminder',
+            index=models.Index(fields=['doctor', 'date', 'updated_at'], name='reminder_doctor_date_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0009_reminder_calendar_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='sha256',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:55
+
+import django.core.validators
+import django.db.models.deletion
+import django.utils.timezone
+import hospital.models
+import hospital.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0011_upload_session'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='record',
+            name='file_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='record',
+            name='prescription',
+            field=models.ImageField(storage=hospital.storage.get_blob_storage, upload_to=hospital.storage.upload_to, validators=[hospital.models.validate_file_size, hospital.models.validate_file_type, django.core.validators.FileExtensionValidator(allowed_extensions=['pdf', 'jpg', 'jpeg', 'png'])]),
+        ),
+        migrations.AddField(
+            model_name='record',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='records', to='hospital.blob'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0012_blob_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='original_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:22
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_deleted_at(apps, schema_editor):
+    # When they were deleted was never kept; the retention period starts now
+    Record = apps.get_model('hospital', 'Record')
+    Record.objects.filter(is_deleted=True, deleted_at__isnull=True).update(deleted_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0013_record_original_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['is_deleted', 'deleted_at'], name='record_purge_idx'),
+        ),
+        migrations.RunPython(backfill_deleted_at, migrations.RunPython.noop),
+    ]
@@ -1,15 +1,21 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
 from django.utils import timezone
 from django.core.validators import FileExtensionValidator
 from django.core.exceptions import ValidationError
+from . import recurrence, storage, uploads
 import os
+import uuid
 
 class Package(models.Model):
     name = models.CharField(max_length=50)
     price = models.DecimalField(max_digits=10, decimal_places=2, help_text="Price in INR")
     can_share = models.BooleanField(default=True)
     can_set_reminders = models.BooleanField(default=True)
+    # With can_set_reminders, a recipient's reminders due within this many
+    # minutes of each other go out as one digest email; 0 sends each separately
+    reminder_digest_minutes = models.PositiveIntegerField(default=0)
     can_delete = models.BooleanField(default=True)
     max_storage_mb = models.IntegerField(default=0)
     max_uploads = models.IntegerField(default=0)
@@ -33,16 +39,15 @@ class User(AbstractUser):
     can_set_reminders = models.BooleanField(null=True, blank=True)
     can_delete = models.BooleanField(null=True, blank=True)
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # list_doctors / list_all_patients filter on user_type
+            models.Index(fields=['user_type'], name='user_type_idx'),
+        ]
+
     def __str__(self):
         return self.username
 
-    def save(self, *args, **kwargs):
-        if self.pk is None or 'password' in self.get_dirty_fields():
-            if self.password and not self.password.startswith('pbkdf2_sha256$'):
-                from django.contrib.auth.hashers import make_password
-                self.password = make_password(self.password)
-        super().save(*args, **kwargs)
-
 def validate_file_size(value):
     filesize = value.size
     if filesize > 10 * 1024 * 1024:  # 10MB
@@ -54,6 +59,62 @@ def validate_file_type(value):
     if ext.lower() not in valid_extensions:
         raise ValidationError('Unsupported file type. Please upload PDF, JPG, JPEG, or PNG files.')
 
+class ArchiveSegment(models.Model):
+    """A packed file of archived blobs in the cold tier, see hospital/archive.py."""
+    name = models.CharField(max_length=255, unique=True)
+    # Bytes committed; anything past this in the file is from an interrupted run
+    size = models.BigIntegerField(default=0)
+    # Full: no more blobs are appended
+    sealed = models.BooleanField(default=False)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Segment {self.name} ({self.size} bytes)"
+
+
+class Blob(models.Model):
+    """
+    One stored file, shared by every record with the same content. ``refcount``
+    counts the live records using it; soft-deleted ones still point here and
+    keep the file until they are purged (see hospital/blobs.py).
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    # Set once archive_records has moved the file into a segment: the entry is
+    # ``segment_length`` bytes at ``segment_offset``, zlib-compressed if ``compressed``
+    segment = models.ForeignKey(ArchiveSegment, on_delete=models.PROTECT, null=True, blank=True, related_name='blobs')
+    segment_offset = models.BigIntegerField(null=True, blank=True)
+    segment_length = models.BigIntegerField(null=True, blank=True)
+    compressed = models.BooleanField(default=False)
+    archived_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def archived(self):
+        return self.segment_id is not None
+
+    @classmethod
+    def acquire(cls, sha256, name, size, references=1):
+        """The blob for ``sha256``, created if new, with ``references`` more live references."""
+        with transaction.atomic(savepoint=False):
+            blob = cls.objects.select_for_update().filter(sha256=sha256).first()
+            if blob is None:
+                try:
+                    with transaction.atomic():
+                        return cls.objects.create(sha256=sha256, name=name, size=size, refcount=references)
+                except IntegrityError:
+                    # Created by a concurrent upload of the same content
+                    blob = cls.objects.select_for_update().get(sha256=sha256)
+            if references:
+                cls.objects.filter(pk=blob.pk).update(refcount=F('refcount') + references)
+                blob.refcount += references
+            return blob
+
+    def __str__(self):
+        return f"Blob {self.sha256} ({self.refcount} refs)"
+
 class Record(models.Model):
     patient = models.ForeignKey(
         User,
@@ -68,7 +129,8 @@ class Record(models.Model):
         related_name='doctor_records'
     )
     prescription = models.ImageField(
-        upload_to='prescriptions/',
+        upload_to=storage.upload_to,
+        storage=storage.get_blob_storage,
         validators=[
             validate_file_size,
             validate_file_type,
@@ -78,27 +140,128 @@ class Record(models.Model):
     upload_date = models.DateTimeField(auto_now_add=True)
     description = models.TextField(null=True, blank=True)
     is_deleted = models.BooleanField(default=False)
+    # When it was soft-deleted; purge_records removes it PURGE_RETENTION_DAYS later
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # Size in bytes captured at upload time so quota checks never stat the file
+    file_size = models.BigIntegerField(default=0)
+    # Content digest, taken while the upload streamed in (see hospital/uploads.py)
+    sha256 = models.CharField(max_length=64, blank=True, default='')
+    # The shared file behind ``prescription``; null for records not yet moved by dedupe_blobs
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='records')
+    # The uploader's name for the file, which the blob name no longer carries
+    file_name = models.CharField(max_length=255, blank=True, default='')
+    # Size as uploaded, before hospital/ingest.py recompressed it; null until
+    # the file has been through compaction (compact_records does the rest)
+    original_size = models.BigIntegerField(null=True, blank=True)
     shared_with = models.ManyToManyField(
         User,
         blank=True,
         related_name='shared_records'
     )
 
+    class Meta:
+        indexes = [
+            # Every record listing filters on owner + is_deleted and pages by upload_date
+            models.Index(fields=['patient', 'is_deleted', 'upload_date'], name='record_patient_live_idx'),
+            models.Index(fields=['doctor', 'is_deleted', 'upload_date'], name='record_doctor_live_idx'),
+            # purge_records walks the deleted rows oldest first
+            models.Index(fields=['is_deleted', 'deleted_at'], name='record_purge_idx'),
+            # collect_orphan_files looks files up by name, a batch at a time
+            models.Index(fields=['prescription'], name='record_file_idx'),
+        ]
+
     def clean(self):
-        if self.prescription:
+        # Streamed uploads were size- and type-checked against their content on the way in
+        if self.prescription and not uploads.is_inspected(getattr(self.prescription, '_file', None)):
             validate_file_size(self.prescription)
             validate_file_type(self.prescription)
 
     def save(self, *args, **kwargs):
         self.full_clean()
+        if self.is_deleted and self.deleted_at is None:
+            self.deleted_at = timezone.now()
+        elif not self.is_deleted:
+            self.deleted_at = None
+        if self.prescription and not self.prescription._committed:
+            self.file_size = self.prescription.size
+            self.sha256 = uploads.digest(self.prescription.file)
+            # Always the new upload's name, so a replaced file never keeps the old one's extension
+            self.file_name = os.path.basename(self.prescription.name)[-255:]
+            self.original_size = getattr(self.prescription.file, 'original_size', self.original_size)
+            with transaction.atomic(savepoint=False):
+                # Taking the reference first means the blob row exists before its file does
+                self.blob = Blob.acquire(self.sha256, storage.blob_name(self.sha256, self.file_name),
+                                         self.file_size, references=0 if self.is_deleted else 1)
+                if self.blob.archived:
+                    # The content is in the archive tier already: share its entry rather than
+                    # writing a hot copy that archive_records may be removing at this moment
+                    self.prescription.name = self.blob.name
+                    self.prescription._committed = True
+                super().save(*args, **kwargs)
+            return
         super().save(*args, **kwargs)
 
+    @property
+    def download_name(self):
+        return self.file_name or os.path.basename(self.prescription.name)
+
 class Reminder(models.Model):
     title = models.CharField(max_length=255)
+    # First (or only) occurrence; see hospital/recurrence.py for the rule fields
     date = models.DateTimeField()
     doctor = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='doctor_reminders', limit_choices_to={'user_type': 'doctor'})
     patient = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='patient_reminders', limit_choices_to={'user_type': 'patient'})
+    # For a recurring reminder, set once the series is exhausted
     notified = models.BooleanField(default=False)
+    freq = models.CharField(max_length=10, choices=recurrence.FREQ_CHOICES, blank=True, default='')
+    interval = models.PositiveIntegerField(default=1)
+    byday = models.CharField(max_length=20, blank=True, default='', help_text="Weekdays, e.g. MO,WE,FR")
+    byhour = models.CharField(max_length=72, blank=True, default='', help_text="Hours of the day, e.g. 8,14,20")
+    until = models.DateTimeField(null=True, blank=True)
+    count = models.PositiveIntegerField(null=True, blank=True)
+    # The one occurrence check_reminders looks at; advanced as the series fires
+    next_fire_at = models.DateTimeField(null=True, blank=True)
+    fired_count = models.PositiveIntegerField(default=0)
+    # Bulk updates must set this too; it feeds the calendar list's ETag
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # check_reminders ranges over next_fire_at; notified=False compiles
+            # to "NOT notified", which can't seek, so it trails the range column
+            models.Index(fields=['next_fire_at', 'notified'], name='reminder_next_fire_idx'),
+            # GET /api/reminders/?from&to: a range scan per owner, with
+            # updated_at along so the ETag aggregate never touches the table
+            models.Index(fields=['patient', 'date', 'updated_at'], name='reminder_patient_date_idx'),
+            models.Index(fields=['doctor', 'date', 'updated_at'], name='reminder_doctor_date_idx'),
+        ]
+
+    # The fields next_fire_at is worked out from
+    SCHEDULE_FIELDS = ('date', 'freq', 'interval', 'byday', 'byhour', 'until', 'count')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The schedule as loaded, so save() can tell when it was changed
+        instance._schedule = {name: value for name, value in zip(field_names, values) if name in cls.SCHEDULE_FIELDS}
+        return instance
+
+    @property
+    def is_recurring(self):
+        return bool(self.freq)
+
+    @property
+    def rescheduled(self):
+        return any(getattr(self, name) != value for name, value in getattr(self, '_schedule', {}).items())
+
+    def save(self, *args, **kwargs):
+        if not self.notified and (self.next_fire_at is None or (self.fired_count == 0 and self.rescheduled)):
+            self.next_fire_at = recurrence.first_occurrence(self)
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'next_fire_at'}
+        super().save(*args, **kwargs)
+        self._schedule = {name: getattr(self, name) for name in self.SCHEDULE_FIELDS}
 
     def __str__(self):
         return f"Reminder: {self.title} ({self.date})"
@@ -108,5 +271,102 @@ class SharedLink(models.Model):
     token = models.CharField(max_length=255, unique=True, null=True, blank=True)
     expires_at = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['expires_at'], name='sharedlink_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"Link for {self.record.id} (expires {self.expires_at})"
+
+class UsageLedger(models.Model):
+    """Running storage/upload/share totals for a patient, kept in step with their records."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='usage_ledger')
+    bytes_used = models.BigIntegerField(default=0)
+    upload_count = models.IntegerField(default=0)
+    share_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Usage for {self.user_id}: {self.upload_count} uploads, {self.bytes_used} bytes"
+
+class OutboundEmail(models.Model):
+    """An email waiting to be sent (or already sent) by the outbox worker, see hospital/outbox.py."""
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    DEAD = 'dead'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (DEAD, 'Dead'),
+    )
+
+    kind = models.CharField(max_length=30, blank=True)
+    recipient = models.EmailField()
+    from_email = models.CharField(max_length=255)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # When the message may next be claimed: the retry time while pending, the
+    # lease expiry while a worker is sending it
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+            models.Index(fields=['recipient', 'sent_at'], name='outbox_recipient_sent_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind or 'email'} to {self.recipient} ({self.status})"
+
+class ReminderEvent(models.Model):
+    """A reminder that fell due, kept briefly for /api/reminders/stream/ (see hospital/events.py)."""
+    # Plain ids rather than foreign keys: events only live for
+    # REMINDER_EVENT_RETENTION_MINUTES, and deleting a user or reminder
+    # should not have to cascade through them
+    user_id = models.IntegerField()
+    reminder_id = models.IntegerField(null=True, blank=True)
+    title = models.CharField(max_length=255)
+    scheduled_at = models.DateTimeField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Last-Event-ID replay: one user's events after a given id
+            models.Index(fields=['user_id', 'id'], name='reminder_event_replay_idx'),
+        ]
+
+    def __str__(self):
+        return f"Reminder event {self.id} for {self.user_id}: {self.title}"
+
+class UploadSession(models.Model):
+    """A resumable upload being received in chunks, see hospital/resumable.py."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', limit_choices_to={'user_type': 'patient'})
+    doctor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', limit_choices_to={'user_type': 'doctor'})
+    file_name = models.CharField(max_length=255)
+    description = models.TextField(blank=True, default='')
+    size = models.BigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    # Set by finalize; a retried finalize returns this record again
+    record = models.ForeignKey(Record, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(db_index=True)
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
     def __str__(self):
-        return f"Link for {self.record.id} (expires {self.expires_at})"
\ No newline at end of file
+        return f"Upload {self.id} of {self.file_name} ({self.size} bytes)"
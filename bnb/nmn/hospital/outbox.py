@@ -0,0 +1,233 @@
+"""
+Transactional email outbox.
+
+Anything that sends mail calls ``enqueue``/``enqueue_many`` inside its own
+transaction, so a message exists exactly when the change that caused it
+commits. ``drain`` (run by ``send_outbox`` and ``check_reminders``) claims due
+messages with SKIP LOCKED and sends them from a bounded thread pool, one SMTP
+connection per thread. Failures are retried with exponential backoff and
+dead-lettered after OUTBOX_MAX_ATTEMPTS; recipients over their hourly limit
+are deferred rather than failed.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Count, F, Min
+from django.utils import timezone
+from . import metrics
+from .models import OutboundEmail
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+CLAIMABLE = (OutboundEmail.PENDING, OutboundEmail.SENDING)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def default_from_email():
+    return getattr(settings, 'DEFAULT_FROM_EMAIL', None) or 'noreply@example.com'
+
+
+def build(recipient, subject, body, kind='', from_email=None):
+    """An unsaved outbox row, for ``enqueue_many``."""
+    return OutboundEmail(kind=kind, recipient=recipient, subject=subject[:255], body=body,
+                         from_email=from_email or default_from_email())
+
+
+def enqueue(recipient, subject, body, kind='', from_email=None):
+    message = build(recipient, subject, body, kind, from_email)
+    message.save()
+    return message
+
+
+def enqueue_many(messages):
+    return OutboundEmail.objects.bulk_create(messages, batch_size=500)
+
+
+def backoff(attempts):
+    """Delay before retry number ``attempts``: doubling from OUTBOX_BACKOFF_SECONDS, capped, with jitter."""
+    base = _setting('OUTBOX_BACKOFF_SECONDS', 30)
+    cap = _setting('OUTBOX_BACKOFF_MAX_SECONDS', 3600)
+    delay = min(cap, base * 2 ** max(0, attempts - 1))
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def claim(now, batch_size):
+    """
+    Lease up to ``batch_size`` due messages to this worker. Messages whose
+    recipient has hit the hourly limit are pushed back instead.
+    """
+    limit = _setting('OUTBOX_RECIPIENT_LIMIT', 100)
+    window = timedelta(seconds=_setting('OUTBOX_RECIPIENT_WINDOW_SECONDS', 3600))
+    lease_until = now + timedelta(seconds=_setting('OUTBOX_LEASE_SECONDS', 300))
+    with transaction.atomic():
+        # A message left in 'sending' by a worker that died is claimable again once its lease ends
+        rows = list(
+            OutboundEmail.objects.filter(status__in=CLAIMABLE, next_attempt_at__lte=now)
+            .select_for_update(skip_locked=True)
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        if not rows:
+            return []
+        claimed, deferred = rows, []
+        if limit:
+            sent = dict(
+                OutboundEmail.objects.filter(recipient__in={row.recipient for row in rows}, sent_at__gte=now - window)
+                .values_list('recipient').annotate(n=Count('id'))
+            )
+            claimed = []
+            for row in rows:
+                if sent.get(row.recipient, 0) >= limit:
+                    deferred.append(row.id)
+                else:
+                    sent[row.recipient] = sent.get(row.recipient, 0) + 1
+                    claimed.append(row)
+        if claimed:
+            OutboundEmail.objects.filter(id__in=[row.id for row in claimed]).update(
+                status=OutboundEmail.SENDING, next_attempt_at=lease_until)
+        if deferred:
+            logger.info(f"Deferred {len(deferred)} outbound emails over the per-recipient limit")
+            OutboundEmail.objects.filter(id__in=deferred).update(next_attempt_at=now + window / limit)
+    return claimed
+
+
+def send_chunk(rows):
+    """
+    Worker: send ``rows`` over one connection. Returns ``[(id, error, seconds)]``
+    with ``error`` None on success. Touches no database.
+    """
+    results = []
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        return [(row.id, f'connect: {e}', 0.0) for row in rows]
+    try:
+        for row in rows:
+            started = time.perf_counter()
+            try:
+                connection.send_messages([EmailMessage(row.subject, row.body, row.from_email, [row.recipient])])
+                error = None
+            except Exception as e:
+                error = str(e) or e.__class__.__name__
+                # The session may be broken; the rest go over a fresh one
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+                try:
+                    connection.open()
+                except Exception:
+                    # send_messages will try again, and report it, for the next message
+                    pass
+            results.append((row.id, error, time.perf_counter() - started))
+    finally:
+        try:
+            connection.close()
+        except Exception:
+            pass
+    return results
+
+
+def record_results(rows, results):
+    """Mark sent messages, and schedule a retry or dead-letter for failed ones."""
+    by_id = {row.id: row for row in rows}
+    now = timezone.now()
+    sent = [message_id for message_id, error, _ in results if error is None]
+    if sent:
+        OutboundEmail.objects.filter(id__in=sent).update(
+            status=OutboundEmail.SENT, sent_at=now, attempts=F('attempts') + 1, last_error='')
+    max_attempts = _setting('OUTBOX_MAX_ATTEMPTS', 6)
+    failed, dead = [], 0
+    for message_id, error, _ in results:
+        if error is None:
+            continue
+        row = by_id[message_id]
+        row.attempts += 1
+        row.last_error = error[:2000]
+        if row.attempts >= max_attempts:
+            row.status = OutboundEmail.DEAD
+            dead += 1
+            logger.error(f"Outbound email {row.id} to {row.recipient} dead after {row.attempts} attempts: {error}")
+        else:
+            row.status = OutboundEmail.PENDING
+            row.next_attempt_at = now + backoff(row.attempts)
+            logger.warning(f"Outbound email {row.id} to {row.recipient} failed (attempt {row.attempts}): {error}")
+        failed.append(row)
+    if failed:
+        OutboundEmail.objects.bulk_update(failed, ['status', 'attempts', 'last_error', 'next_attempt_at'])
+    return len(sent), len(failed) - dead, dead
+
+
+def drain(now=None, workers=None, batch_size=None):
+    """
+    Send everything due at ``now``. Returns counts plus the per-message send
+    latencies in seconds: ``{'sent', 'failed', 'dead', 'latencies'}``.
+    """
+    workers = max(1, workers or _setting('OUTBOX_WORKERS', 4))
+    batch_size = batch_size or _setting('OUTBOX_BATCH_SIZE', 100)
+    totals = {'sent': 0, 'failed': 0, 'dead': 0, 'latencies': []}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            rows = claim(now or timezone.now(), batch_size)
+            if not rows:
+                break
+            chunks = [rows[i::workers] for i in range(workers) if rows[i::workers]]
+            results = [result for chunk_results in pool.map(send_chunk, chunks) for result in chunk_results]
+            sent, failed, dead = record_results(rows, results)
+            totals['sent'] += sent
+            totals['failed'] += failed
+            totals['dead'] += dead
+            totals['latencies'] += [seconds for _, error, seconds in results if error is None]
+    return totals
+
+
+def next_attempt_at():
+    """When the earliest queued message becomes claimable, or None if the queue is empty."""
+    return (OutboundEmail.objects.filter(status__in=CLAIMABLE)
+            .order_by('next_attempt_at').values_list('next_attempt_at', flat=True).first())
+
+
+def queue_stats():
+    """``{status: {'count', 'oldest'}}`` for every unsent status, in one query."""
+    stats = {status: {'count': 0, 'oldest': None} for status in CLAIMABLE + (OutboundEmail.DEAD,)}
+    rows = (OutboundEmail.objects.filter(status__in=list(stats))
+            .values('status').annotate(count=Count('id'), oldest=Min('created_at')))
+    for row in rows:
+        stats[row['status']] = {'count': row['count'], 'oldest': row['oldest']}
+    return stats
+
+
+def latency_summary(latencies):
+    """p50/p95/max of send latencies, in milliseconds."""
+    if not latencies:
+        return {'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+    ordered = sorted(latencies)
+    pick = lambda pct: round(ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))] * 1000, 1)
+    return {'p50_ms': pick(50), 'p95_ms': pick(95), 'max_ms': round(ordered[-1] * 1000, 1)}
+
+
+def describe(totals):
+    latency = latency_summary(totals['latencies'])
+    return (f"Sent {totals['sent']} emails ({totals['failed']} to retry, {totals['dead']} dead-lettered; "
+            f"latency p50 {latency['p50_ms']}ms, p95 {latency['p95_ms']}ms)")
+
+
+def render_metrics():
+    """Queue depth and age gauges for /api/metrics/. The queue is shared, so any process can report it."""
+    stats = queue_stats()
+    now = timezone.now()
+    return (
+        metrics.render_gauge('outbox_messages', 'Outbound emails not yet sent, by status.',
+                             [({'status': status}, row['count']) for status, row in stats.items()])
+        + metrics.render_gauge('outbox_oldest_message_age_seconds', 'Age of the oldest outbound email in each status.',
+                               [({'status': status}, round((now - row['oldest']).total_seconds(), 3) if row['oldest'] else 0)
+                                for status, row in stats.items()])
+    )
@@ -0,0 +1,118 @@
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+import base64
+import json
+
+# Newest records first; id breaks ties between uploads in the same instant
+RECORD_ORDERING = ('-upload_date', '-id')
+# Calendar order; served by the (owner, date) reminder indexes
+REMINDER_ORDERING = ('date', 'id')
+ID_ORDERING = ('id',)
+
+CURSOR_PARAM = 'cursor'
+PAGE_SIZE_PARAM = 'page_size'
+
+
+def _field_name(term):
+    return term.lstrip('-')
+
+
+def encode_cursor(obj, ordering):
+    values = []
+    for term in ordering:
+        value = getattr(obj, _field_name(term))
+        values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, model, ordering):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise ValueError(cursor)
+        return [model._meta.get_field(_field_name(term)).to_python(value) for term, value in zip(ordering, values)]
+    except Exception:
+        raise ValidationError({CURSOR_PARAM: 'Invalid cursor.'})
+
+
+def keyset_filter(ordering, values):
+    """
+    Rows strictly after ``values`` in ``ordering``: for (a desc, b desc) this is
+    ``a < x OR (a = x AND b < y)``, which the composite indexes serve as a range scan.
+    """
+    condition = Q()
+    for i, term in enumerate(ordering):
+        lookup = 'lt' if term.startswith('-') else 'gt'
+        step = Q(**{f'{_field_name(term)}__{lookup}': values[i]})
+        for prior, value in zip(ordering[:i], values[:i]):
+            step &= Q(**{_field_name(prior): value})
+        condition |= step
+    return condition
+
+
+def page_size(request):
+    default = getattr(settings, 'API_PAGE_SIZE', 50)
+    maximum = getattr(settings, 'API_MAX_PAGE_SIZE', 500)
+    raw = request.query_params.get(PAGE_SIZE_PARAM)
+    if raw is None:
+        return min(default, maximum)
+    try:
+        size = int(raw)
+    except ValueError:
+        raise ValidationError({PAGE_SIZE_PARAM: 'Must be an integer.'})
+    if size < 1:
+        raise ValidationError({PAGE_SIZE_PARAM: 'Must be at least 1.'})
+    return min(size, maximum)
+
+
+def wants_page(request):
+    """
+    Whether to return a page rather than the whole list.
+
+    While API_UNPAGINATED_LISTS is on, existing clients that send neither
+    ``cursor`` nor ``page_size`` keep getting a bare array.
+    """
+    if not getattr(settings, 'API_UNPAGINATED_LISTS', False):
+        return True
+    return CURSOR_PARAM in request.query_params or PAGE_SIZE_PARAM in request.query_params
+
+
+def shape_queryset(queryset, serializer_class):
+    """Apply the serializer's declared select/prefetch_related to ``queryset``."""
+    setup = getattr(serializer_class, 'setup_eager_loading', None)
+    return setup(queryset) if setup else queryset
+
+
+def paginate(request, queryset, serializer_class, ordering, context=None):
+    """
+    Serialise one keyset page of ``queryset`` as
+    ``{'results': [...], 'next': url|None, 'next_cursor': str|None}``.
+    """
+    context = context or {}
+    queryset = shape_queryset(queryset, serializer_class)
+    if not wants_page(request):
+        return Response(serializer_class(queryset, many=True, context=context).data)
+
+    size = page_size(request)
+    queryset = queryset.order_by(*ordering)
+    cursor = request.query_params.get(CURSOR_PARAM)
+    if cursor:
+        queryset = queryset.filter(keyset_filter(ordering, decode_cursor(cursor, queryset.model, ordering)))
+    rows = list(queryset[:size + 1])
+    has_next = len(rows) > size
+    rows = rows[:size]
+
+    next_cursor = encode_cursor(rows[-1], ordering) if has_next else None
+    next_url = None
+    if next_cursor:
+        next_url = replace_query_param(request.build_absolute_uri(), CURSOR_PARAM, next_cursor)
+    return Response({
+        'results': serializer_class(rows, many=True, context=context).data,
+        'next': next_url,
+        'next_cursor': next_cursor,
+    })
@@ -0,0 +1,218 @@
+"""
+On-demand profiling of single requests, for staff.
+
+Send ``X-Profile: 1`` (or ``?__profile=1``) with a staff session or JWT and the
+request runs under cProfile with its SQL captured. The report is saved under
+PROFILE_DIR and its id returned in the ``X-Profile-Id`` header; fetch it from
+/api/profiles/<id>/ (add ``?download=prof`` for the raw pstats file). Use
+``inline`` instead of ``1`` to get the report back as an attachment in place of
+the normal response.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import HttpResponse
+from django.utils import timezone
+from .metrics import add_execute_wrapper, remove_execute_wrapper
+from rest_framework.exceptions import APIException
+from rest_framework_simplejwt.authentication import JWTAuthentication
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_PARAM = '__profile'
+INLINE = 'inline'
+PROFILE_ID_RE = re.compile(r'[0-9a-f]{32}')
+
+# Only one profiler can be active per process at a time
+_profiler_lock = threading.Lock()
+
+
+def profile_dir():
+    return str(getattr(settings, 'PROFILE_DIR', os.path.join(settings.BASE_DIR, 'profiles')))
+
+
+def report_paths(profile_id):
+    """``(json_path, prof_path)`` for a profile id, or None if the id is malformed."""
+    if not PROFILE_ID_RE.fullmatch(profile_id or ''):
+        return None
+    base = os.path.join(profile_dir(), profile_id)
+    return base + '.json', base + '.prof'
+
+
+def _staff_user(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user if user.is_staff else None
+    # Token-authenticated API calls are only resolved inside DRF views
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except APIException:
+        return None
+    if result and result[0].is_staff:
+        return result[0]
+    return None
+
+
+class _QueryLog:
+    def __init__(self):
+        self.queries = []
+        # Parameters carry patient data and password hashes, so reports leave them out unless asked
+        self.capture_params = getattr(settings, 'PROFILE_CAPTURE_PARAMS', False)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            query = {'sql': sql, 'ms': round((time.perf_counter() - started) * 1000, 3)}
+            if self.capture_params:
+                query['params'] = repr(params)[:500]
+            self.queries.append(query)
+
+
+class ProfilingMiddleware:
+    """
+    Untriggered requests cost a header lookup and a substring test on the
+    query string. With PROFILING_ENABLED off
+    the middleware removes itself from the stack altogether.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def requested_mode(self, request):
+        mode = request.META.get(PROFILE_HEADER)
+        if not mode and PROFILE_PARAM in request.META.get('QUERY_STRING', ''):
+            mode = request.GET.get(PROFILE_PARAM)
+        return mode
+
+    def profiled_user(self, request):
+        user = _staff_user(request)
+        if user is None:
+            logger.warning(f"Ignored profiling request for {request.path} from a non-staff client")
+        return user
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        mode = self.requested_mode(request)
+        if not mode:
+            return self.get_response(request)
+        user = self.profiled_user(request)
+        if user is None:
+            return self.get_response(request)
+        if not _profiler_lock.acquire(blocking=False):
+            response = self.get_response(request)
+            response['X-Profile-Error'] = 'busy'
+            return response
+        try:
+            profiler = cProfile.Profile()
+            queries = _QueryLog()
+            started = time.perf_counter()
+            with connection.execute_wrapper(queries):
+                profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    profiler.disable()
+            elapsed = time.perf_counter() - started
+        finally:
+            _profiler_lock.release()
+        return self.finish(mode, request, user, response, elapsed, profiler, queries)
+
+    async def __acall__(self, request):
+        mode = self.requested_mode(request)
+        if not mode:
+            return await self.get_response(request)
+        user = await sync_to_async(self.profiled_user)(request)
+        if user is None:
+            return await self.get_response(request)
+        if not _profiler_lock.acquire(blocking=False):
+            response = await self.get_response(request)
+            response['X-Profile-Error'] = 'busy'
+            return response
+        try:
+            # Profiles the event loop thread, so other requests it serves meanwhile show up too
+            profiler = cProfile.Profile()
+            queries = _QueryLog()
+            await sync_to_async(add_execute_wrapper)(queries)
+            started = time.perf_counter()
+            profiler.enable()
+            try:
+                response = await self.get_response(request)
+            finally:
+                profiler.disable()
+                await sync_to_async(remove_execute_wrapper)(queries)
+            elapsed = time.perf_counter() - started
+        finally:
+            _profiler_lock.release()
+        return await sync_to_async(self.finish)(mode, request, user, response, elapsed, profiler, queries)
+
+    def finish(self, mode, request, user, response, elapsed, profiler, queries):
+        profile_id = uuid.uuid4().hex
+        report = self.build_report(profile_id, request, user, response, elapsed, profiler, queries.queries)
+        if mode == INLINE:
+            response.close()
+            attachment = HttpResponse(json.dumps(report, indent=2), content_type='application/json')
+            attachment['Content-Disposition'] = f'attachment; filename="profile-{profile_id}.json"'
+            attachment['X-Profile-Id'] = profile_id
+            return attachment
+        self.save(profile_id, report, profiler)
+        response['X-Profile-Id'] = profile_id
+        return response
+
+    def build_report(self, profile_id, request, user, response, elapsed, profiler, queries):
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(getattr(settings, 'PROFILE_TOP_FUNCTIONS', 40))
+        return {
+            'id': profile_id,
+            'created_at': timezone.now().isoformat(),
+            'method': request.method,
+            'path': request.get_full_path(),
+            'user': user.username,
+            'status': response.status_code,
+            'duration_ms': round(elapsed * 1000, 3),
+            'query_count': len(queries),
+            'sql_ms': round(sum(query['ms'] for query in queries), 3),
+            'queries': queries,
+            'stats': stream.getvalue(),
+        }
+
+    def save(self, profile_id, report, profiler):
+        directory = profile_dir()
+        os.makedirs(directory, exist_ok=True)
+        json_path, prof_path = report_paths(profile_id)
+        profiler.dump_stats(prof_path)
+        with open(json_path, 'w') as f:
+            json.dump(report, f)
+        self.prune(directory)
+
+    def prune(self, directory):
+        keep = getattr(settings, 'PROFILE_KEEP', 200)
+        reports = sorted((entry for entry in os.scandir(directory) if entry.name.endswith('.json')),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in reports[:max(0, len(reports) - keep)]:
+            for path in (entry.path, entry.path[:-len('.json')] + '.prof'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
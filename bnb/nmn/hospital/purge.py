@@ -0,0 +1,103 @@
+"""
+Hard-deleting soft-deleted records once PURGE_RETENTION_DAYS have passed.
+
+Deleting a record only marks it (usage.soft_delete), and its file stays on
+disk. ``purge`` removes the rows for good in transactions of
+PURGE_BATCH_SIZE, oldest deletion first, sleeping PURGE_PAUSE_SECONDS
+between them so a large backlog never holds locks or saturates the disk
+for long. Rows another transaction has locked are skipped until the next
+run. A file goes once no record points at it: blobs still used by another
+record, live or not, are kept.
+
+The usage ledger is not touched: a soft delete already gave the bytes back.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+from . import blobs
+from .models import Record
+from .storage import blob_storage
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def retention_days():
+    return getattr(settings, 'PURGE_RETENTION_DAYS', 30)
+
+
+def due(cutoff):
+    """Soft-deleted records deleted before ``cutoff``, oldest first."""
+    return Record.objects.filter(is_deleted=True, deleted_at__lte=cutoff).order_by('deleted_at', 'id')
+
+
+def cutoff(days=None, now=None):
+    return (now or timezone.now()) - timedelta(days=retention_days() if days is None else days)
+
+
+def pending(cutoff):
+    """(records, bytes) a purge at ``cutoff`` would delete, counting shared files as theirs."""
+    totals = due(cutoff).order_by().aggregate(records=Count('id'), bytes=Sum('file_size'))
+    return totals['records'], totals['bytes'] or 0
+
+
+def purge_batch(cutoff, batch_size):
+    """
+    Delete up to ``batch_size`` due records in one transaction. Returns
+    (records, files, bytes) reclaimed; the files are removed once it commits.
+    """
+    with transaction.atomic():
+        rows = list(due(cutoff).select_for_update(skip_locked=True)
+                    .values_list('id', 'blob_id', 'prescription', 'file_size')[:batch_size])
+        if not rows:
+            return 0, 0, 0
+        with blobs.settled_later():
+            Record.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        dropped = blobs.forget_many({blob_id for _, blob_id, _, _ in rows if blob_id is not None})
+
+        # Files saved before content-addressed storage have no blob; they are
+        # removed unless another record still names them
+        legacy = {name: size for _, blob_id, name, size in rows if blob_id is None and name}
+        if legacy:
+            for name in Record.objects.filter(prescription__in=list(legacy)).values_list('prescription', flat=True):
+                legacy.pop(name, None)
+            transaction.on_commit(lambda: _remove(legacy))
+    freed = sum(blob.size for blob in dropped) + sum(legacy.values())
+    return len(rows), len(dropped) + len(legacy), freed
+
+
+def _remove(names):
+    for name in names:
+        try:
+            blob_storage.delete(name)
+        except OSError as e:
+            logger.error(f"Could not delete record file {name}: {e}")
+
+
+def purge(days=None, batch_size=None, pause=None, max_batches=None, now=None):
+    """
+    Purge every record soft-deleted more than ``days`` ago, in batches.
+    Returns the totals: records, files, bytes and batches.
+    """
+    batch_size = batch_size or getattr(settings, 'PURGE_BATCH_SIZE', 200)
+    pause = getattr(settings, 'PURGE_PAUSE_SECONDS', 0.5) if pause is None else pause
+    # Fixed for the run, so records deleted meanwhile wait for the next one
+    before = cutoff(days, now)
+    totals = {'records': 0, 'files': 0, 'bytes': 0, 'batches': 0}
+    while max_batches is None or totals['batches'] < max_batches:
+        records, files, freed = purge_batch(before, batch_size)
+        if not records:
+            break
+        totals['records'] += records
+        totals['files'] += files
+        totals['bytes'] += freed
+        totals['batches'] += 1
+        logger.info(f"Purged {records} records, reclaiming {freed} bytes in {files} files")
+        if records < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return totals
@@ -0,0 +1,146 @@
+"""
+RRULE-style recurrence for reminders, expanded lazily.
+
+A reminder's ``date`` is the start of the series (DTSTART). ``freq`` is one of
+hourly/daily/weekly, stepped by ``interval``; ``byday`` ("MO,WE,FR") and
+``byhour`` ("8,14,20") pick occurrences within each period, which otherwise
+repeat the start's weekday, hour and minute. The series ends at ``until``
+(inclusive) or after ``count`` occurrences. Wall-clock fields are read in
+TIME_ZONE, so a daily 08:00 dose stays at 08:00 across DST changes.
+
+Only the next occurrence is ever stored (``Reminder.next_fire_at``); calendar
+views expand a window on demand with ``occurrences``.
+"""
+from datetime import datetime, timedelta
+from django.utils import timezone
+
+HOURLY = 'hourly'
+DAILY = 'daily'
+WEEKLY = 'weekly'
+FREQ_CHOICES = (
+    ('', 'Once'),
+    (HOURLY, 'Hourly'),
+    (DAILY, 'Daily'),
+    (WEEKLY, 'Weekly'),
+)
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+# Periods walked without producing an occurrence before a rule is deemed empty
+# (e.g. hourly every 24h with a byhour that the start hour never lands on)
+MAX_EMPTY_PERIODS = 10000
+
+
+def parse_byday(value):
+    """``"MO,we"`` -> ``{0, 2}``; raises ValueError on unknown days."""
+    days = set()
+    for token in filter(None, (part.strip().upper() for part in (value or '').split(','))):
+        if token not in WEEKDAYS:
+            raise ValueError(f'Unknown weekday {token!r}; use {",".join(WEEKDAYS)}')
+        days.add(WEEKDAYS.index(token))
+    return days
+
+
+def parse_byhour(value):
+    """``"8,20"`` -> ``[8, 20]``; raises ValueError outside 0-23."""
+    hours = set()
+    for token in filter(None, (part.strip() for part in (value or '').split(','))):
+        hour = int(token)
+        if not 0 <= hour <= 23:
+            raise ValueError(f'Hour {hour} is outside 0-23')
+        hours.add(hour)
+    return sorted(hours)
+
+
+def _aware(naive):
+    return timezone.make_aware(naive, timezone.get_current_timezone())
+
+
+def _candidates(start_local, freq, interval, days, hours, first_period):
+    """Naive local datetimes in order, from period ``first_period`` onward."""
+    minute, second = start_local.minute, start_local.second
+    period = first_period
+    empty = 0
+    while empty < MAX_EMPTY_PERIODS:
+        found = False
+        if freq == HOURLY:
+            moment = start_local + timedelta(hours=period)
+            if (not days or moment.weekday() in days) and (not hours or moment.hour in hours):
+                found = True
+                yield moment
+        elif freq == DAILY:
+            day = start_local.date() + timedelta(days=period)
+            if not days or day.weekday() in days:
+                for hour in hours or [start_local.hour]:
+                    found = True
+                    yield datetime.combine(day, start_local.time()).replace(hour=hour, minute=minute, second=second)
+        else:
+            monday = start_local.date() - timedelta(days=start_local.weekday()) + timedelta(weeks=period)
+            for weekday in sorted(days) or [start_local.weekday()]:
+                for hour in hours or [start_local.hour]:
+                    found = True
+                    yield datetime.combine(monday + timedelta(days=weekday), start_local.time()).replace(
+                        hour=hour, minute=minute, second=second)
+        empty = 0 if found else empty + 1
+        period += interval
+
+
+def _first_period(start_local, freq, interval, moment_local):
+    """The first period index (a multiple of ``interval``) that can hold ``moment_local``."""
+    if freq == HOURLY:
+        elapsed = int((moment_local - start_local).total_seconds() // 3600)
+    elif freq == DAILY:
+        elapsed = (moment_local.date() - start_local.date()).days
+    else:
+        elapsed = (moment_local.date() - start_local.date()).days // 7 - 1
+    return max(0, elapsed // interval * interval)
+
+
+def iter_occurrences(reminder, after=None):
+    """
+    Occurrences of ``reminder`` as aware datetimes, in order. With ``after``,
+    only those strictly later; the walk jumps straight to ``after`` unless the
+    series is bounded by ``count``, which needs counting from the start.
+    """
+    start = reminder.date
+    if not reminder.freq:
+        if after is None or start > after:
+            yield start
+        return
+    tz = timezone.get_current_timezone()
+    start_local = timezone.localtime(start, tz).replace(tzinfo=None)
+    days, hours = parse_byday(reminder.byday), parse_byhour(reminder.byhour)
+    interval = max(1, reminder.interval or 1)
+    first_period = 0
+    if after is not None and not reminder.count and after > start:
+        first_period = _first_period(start_local, reminder.freq, interval, timezone.localtime(after, tz).replace(tzinfo=None))
+    emitted = 0
+    for naive in _candidates(start_local, reminder.freq, interval, days, hours, first_period):
+        if naive < start_local:
+            continue
+        moment = _aware(naive)
+        if reminder.until and moment > reminder.until:
+            return
+        emitted += 1
+        if reminder.count and emitted > reminder.count:
+            return
+        if after is None or moment > after:
+            yield moment
+
+
+def next_occurrence(reminder, after):
+    """The first occurrence strictly after ``after``, or None when the series is over."""
+    return next(iter_occurrences(reminder, after), None)
+
+
+def first_occurrence(reminder):
+    return next(iter_occurrences(reminder), None)
+
+
+def occurrences(reminder, start, end, limit=None):
+    """Occurrences with ``start <= t < end``, at most ``limit`` of them."""
+    found = []
+    for moment in iter_occurrences(reminder, start - timedelta(microseconds=1)):
+        if moment >= end or (limit is not None and len(found) >= limit):
+            break
+        found.append(moment)
+    return found
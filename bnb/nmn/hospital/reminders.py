@@ -0,0 +1,276 @@
+"""
+Reminder dispatch shared by ``check_reminders`` and its ``--daemon`` mode.
+
+Workers claim due rows with ``SELECT ... FOR UPDATE SKIP LOCKED`` so any number
+can run side by side without double-sending. Each claimed batch is written to
+the email outbox and marked notified in the same transaction; hospital/outbox.py
+does the sending.
+
+Recurring reminders are a single row whose ``next_fire_at`` is moved on to the
+following occurrence each time it fires, so the dispatcher never sees more than
+one pending occurrence per series (see hospital/recurrence.py).
+
+Recipients whose package sets ``reminder_digest_minutes`` get one email for
+everything due now plus whatever falls due within that many minutes.
+
+Every reminder that falls due for an owner whose package allows reminders is
+also published as a ReminderEvent for clients of /api/reminders/stream/
+(hospital/events.py), emailed or not: a user with no address still sees it.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from . import events, outbox, recurrence
+from .models import Reminder
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 100
+
+
+def lookback():
+    """How far back a worker catches up on reminders missed while nothing was running."""
+    return timedelta(minutes=getattr(settings, 'REMINDER_LOOKBACK_MINUTES', 24 * 60))
+
+
+def pending(now, since):
+    return Reminder.objects.filter(notified=False, next_fire_at__gte=since, next_fire_at__lte=now)
+
+
+def owner(reminder):
+    return reminder.doctor or reminder.patient
+
+
+def allowed(reminder):
+    """Whether the reminder's owner may have reminders at all, whatever their email."""
+    user = owner(reminder)
+    return user is not None and user.package is not None and user.package.can_set_reminders
+
+
+def recipient(reminder):
+    """``(email, user_type)`` for a reminder, or ``(None, reason)`` when it must not be sent."""
+    if reminder.doctor:
+        owner, user_type = reminder.doctor, 'doctor'
+    elif reminder.patient:
+        owner, user_type = reminder.patient, 'patient'
+    else:
+        return None, 'No doctor or patient assigned.'
+    if not owner.package or not owner.package.can_set_reminders:
+        return None, f"{user_type.capitalize()}'s package does not allow reminders."
+    if not owner.email:
+        return None, 'No recipient email found.'
+    return owner.email, user_type
+
+
+def build_message(reminder, email, user_type):
+    subject = f"[Pixeltre Medical] Reminder: {reminder.title}"
+    message = f"Dear {user_type.capitalize()},\n\nThis is a reminder for: {reminder.title}\nScheduled at: {reminder.next_fire_at.strftime('%Y-%m-%d %H:%M')}\n\nThank you."
+    return outbox.build(email, subject, message, kind='reminder')
+
+
+def build_digest(reminders, email, user_type):
+    reminders = sorted(reminders, key=lambda reminder: (reminder.next_fire_at, reminder.id))
+    lines = '\n'.join(f"- {reminder.next_fire_at.strftime('%Y-%m-%d %H:%M')}: {reminder.title}" for reminder in reminders)
+    subject = f"[Pixeltre Medical] {len(reminders)} reminders"
+    message = f"Dear {user_type.capitalize()},\n\nThis is a reminder for:\n{lines}\n\nThank you."
+    return outbox.build(email, subject, message, kind='reminder_digest')
+
+
+def digest_window(reminder):
+    """How far ahead to gather this reminder's recipient's other reminders, or None if they get no digest."""
+    package = owner(reminder).package
+    if package.can_set_reminders and package.reminder_digest_minutes:
+        return timedelta(minutes=package.reminder_digest_minutes)
+    return None
+
+
+def claim(now, since, batch_size):
+    """
+    Lock up to ``batch_size`` due reminders that no other worker holds. Must be
+    called inside a transaction; the locks last until it ends.
+    """
+    return list(
+        pending(now, since).select_related('doctor__package', 'patient__package')
+        .select_for_update(skip_locked=True, of=('self',))
+        .order_by('next_fire_at', 'id')[:batch_size]
+    )
+
+
+def claim_digest_extras(batch, now, since):
+    """
+    Lock the other reminders of digest recipients in ``batch`` that are due,
+    or fall due within the recipient's window, so they share one email.
+    Costs no query when nobody in the batch takes digests.
+    """
+    windows = {}
+    for reminder in batch:
+        if recipient(reminder)[0] is not None:
+            window = digest_window(reminder)
+            if window:
+                windows[owner(reminder).id] = window
+    if not windows:
+        return []
+    candidates = (
+        Reminder.objects.filter(notified=False, next_fire_at__gte=since, next_fire_at__lte=now + max(windows.values()))
+        .filter(Q(doctor_id__in=windows) | Q(patient_id__in=windows))
+        .exclude(id__in=[reminder.id for reminder in batch])
+        .select_related('doctor__package', 'patient__package')
+        .select_for_update(skip_locked=True, of=('self',))
+        .order_by('next_fire_at', 'id')
+    )
+    return [reminder for reminder in candidates
+            if owner(reminder).id in windows and reminder.next_fire_at <= now + windows[owner(reminder).id]]
+
+
+def queue_batch(reminders):
+    """
+    Write outbox messages for ``reminders``, one digest per recipient that
+    takes them. Returns ``(queued_ids, skipped_ids)``.
+    """
+    groups, skipped = {}, []
+    for reminder in reminders:
+        email, detail = recipient(reminder)
+        if email is None:
+            logger.info(f"Skipping reminder {reminder.id}: {detail}")
+            skipped.append(reminder.id)
+            continue
+        digest = digest_window(reminder) is not None
+        key = ('owner', owner(reminder).id) if digest else ('reminder', reminder.id)
+        groups.setdefault((email, detail, key), []).append(reminder)
+    messages, queued, digests = [], [], 0
+    for (email, user_type, _), group in groups.items():
+        if len(group) > 1:
+            messages.append(build_digest(group, email, user_type))
+            digests += 1
+        else:
+            messages.append(build_message(group[0], email, user_type))
+        queued += [reminder.id for reminder in group]
+    outbox.enqueue_many(messages)
+    if digests:
+        logger.info(f"Collapsed {len(queued)} reminders into {len(messages)} emails ({digests} digests)")
+    return queued, skipped
+
+
+def advance(reminders, now, fired):
+    """
+    Move recurring ``reminders`` on to their next occurrence after ``now``,
+    closing any whose series is over. Occurrences missed while nothing ran
+    collapse into the one just sent rather than arriving as a burst.
+    """
+    for reminder in reminders:
+        following = recurrence.next_occurrence(reminder, max(reminder.next_fire_at, now))
+        if following is None:
+            reminder.notified = True
+        else:
+            reminder.next_fire_at = following
+        if reminder.id in fired:
+            reminder.fired_count += 1
+    touched = timezone.now()
+    for reminder in reminders:
+        reminder.updated_at = touched
+    Reminder.objects.bulk_update(reminders, ['next_fire_at', 'notified', 'fired_count', 'updated_at'])
+
+
+def close_batch(batch, queued, skipped, now):
+    one_shot = [reminder.id for reminder in batch if not reminder.is_recurring]
+    recurring = [reminder for reminder in batch if reminder.is_recurring]
+    # Reminders that can never be sent are closed too, so later
+    # runs do not keep claiming them for the whole lookback window
+    if one_shot:
+        Reminder.objects.filter(id__in=one_shot).update(notified=True, updated_at=timezone.now())
+    if recurring:
+        advance(recurring, now, set(queued))
+
+
+def resume_stale_series(now=None, since=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Recurring reminders whose next occurrence fell out of the lookback window
+    (the dispatcher was down longer than that) would never be claimed again;
+    skip them ahead to their first occurrence inside it. Returns the count.
+    """
+    now = now or timezone.now()
+    since = since or now - lookback()
+    total = 0
+    while True:
+        with transaction.atomic():
+            stale = list(
+                Reminder.objects.filter(notified=False, next_fire_at__lt=since).exclude(freq='')
+                .select_for_update(skip_locked=True).order_by('next_fire_at', 'id')[:batch_size]
+            )
+            if not stale:
+                break
+            advance(stale, since, fired=set())
+        total += len(stale)
+        if len(stale) < batch_size:
+            break
+    if total:
+        logger.info(f"Moved {total} recurring reminders past occurrences older than {since}")
+    return total
+
+
+def dispatch_due(now=None, batch_size=DEFAULT_BATCH_SIZE, since=None):
+    """
+    Queue every reminder due between ``since`` (default: now - lookback) and
+    ``now``. Returns ``{'queued', 'skipped'}`` counts.
+    """
+    now = now or timezone.now()
+    since = since or now - lookback()
+    totals = {'queued': 0, 'skipped': 0}
+    while True:
+        with transaction.atomic():
+            batch = claim(now, since, batch_size)
+            if not batch:
+                break
+            claimed = len(batch)
+            batch += claim_digest_extras(batch, now, since)
+            queued, skipped = queue_batch(batch)
+            events.publish([reminder for reminder in batch if allowed(reminder)])
+            close_batch(batch, queued, skipped, now)
+        totals['queued'] += len(queued)
+        totals['skipped'] += len(skipped)
+        if claimed < batch_size:
+            break
+    return totals
+
+
+def next_due_at(now):
+    """When the next pending reminder falls due, or None if there is none."""
+    return (Reminder.objects.filter(next_fire_at__gt=now, notified=False)
+            .order_by('next_fire_at').values_list('next_fire_at', flat=True).first())
+
+
+def seconds_until_next(now, max_sleep, include_outbox=False):
+    due = [next_due_at(now)]
+    if include_outbox:
+        due.append(outbox.next_attempt_at())
+    due = [when for when in due if when is not None]
+    if not due:
+        return max_sleep
+    return max(0.0, min(max_sleep, (min(due) - now).total_seconds()))
+
+
+def run_forever(stop, batch_size=DEFAULT_BATCH_SIZE, max_sleep=60, send=True, on_dispatch=None):
+    """
+    Queue due reminders and, with ``send``, drain the outbox; then sleep until
+    the next reminder or retry is due (at most ``max_sleep`` seconds, so newly
+    created ones are picked up). Returns once ``stop`` (a threading.Event) is set.
+    """
+    while not stop.is_set():
+        close_old_connections()
+        try:
+            resume_stale_series(batch_size=batch_size)
+            totals = dispatch_due(batch_size=batch_size)
+            events.prune()
+            if send:
+                totals.update(outbox.drain())
+            if on_dispatch:
+                on_dispatch(totals)
+            delay = seconds_until_next(timezone.now(), max_sleep, include_outbox=send)
+        except Exception as e:
+            logger.error(f"Reminder dispatch failed: {e}")
+            delay = max_sleep
+        stop.wait(delay)
+    close_old_connections()
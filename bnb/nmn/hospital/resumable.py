@@ -0,0 +1,136 @@
+"""
+Resumable uploads, in the spirit of tus.
+
+A client creates an UploadSession (POST /api/uploads/) declaring the file's
+name and size, then PUTs the body in any order, in parallel if it likes, as
+chunks of the server's ``chunk_size`` at aligned offsets (``Upload-Offset``
+header or ``?offset=``). GET on the session lists the chunks already held, so
+after a dropped connection only the missing ones are resent. Finalize stitches
+the chunks into a Record through the same package checks as upload_record.
+
+Chunks live as one file each under UPLOAD_SESSION_DIR/<session id>/, written
+to a temporary name and renamed into place, so the directory itself is the
+record of what has arrived and parallel writers never see a partial chunk.
+Abandoned sessions are removed by ``expire_upload_sessions``.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.utils import timezone
+from . import uploads
+import os
+import shutil
+import uuid
+
+CHUNK_SUFFIX = '.part'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def root():
+    return str(_setting('UPLOAD_SESSION_DIR', os.path.join(settings.BASE_DIR, 'upload_sessions')))
+
+
+def default_chunk_size():
+    return _setting('UPLOAD_SESSION_CHUNK_SIZE', 1024 * 1024)
+
+
+def expiry(now=None):
+    return (now or timezone.now()) + timedelta(hours=_setting('UPLOAD_SESSION_TTL_HOURS', 24))
+
+
+def session_dir(session):
+    return os.path.join(root(), str(session.id))
+
+
+def chunk_path(session, index):
+    return os.path.join(session_dir(session), f'{index}{CHUNK_SUFFIX}')
+
+
+def chunk_index(session, offset):
+    """The chunk starting at ``offset``; raises ValueError unless it is a chunk boundary inside the file."""
+    if offset < 0 or offset >= session.size or offset % session.chunk_size:
+        raise ValueError(f'Upload-Offset must be a multiple of {session.chunk_size} below {session.size}.')
+    return offset // session.chunk_size
+
+
+def received(session):
+    """Indexes of the chunks on disk, sorted."""
+    try:
+        entries = os.scandir(session_dir(session))
+    except FileNotFoundError:
+        return []
+    with entries:
+        return sorted(int(entry.name[:-len(CHUNK_SUFFIX)]) for entry in entries
+                      if entry.name.endswith(CHUNK_SUFFIX) and entry.name[:-len(CHUNK_SUFFIX)].isdigit())
+
+
+def contiguous_bytes(session, indexes):
+    """How far from the start the file has arrived without gaps (tus's Upload-Offset)."""
+    have, index = set(indexes), 0
+    while index in have:
+        index += 1
+    return min(session.size, index * session.chunk_size)
+
+
+def write_chunk(session, index, data):
+    """
+    Store chunk ``index``. Returns False if an identical copy was already
+    held; raises ValueError on a wrong length and FileExistsError on a
+    conflicting copy.
+    """
+    expected = session.chunk_length(index)
+    if len(data) != expected:
+        raise ValueError(f'Chunk {index} must be {expected} bytes, got {len(data)}.')
+    path = chunk_path(session, index)
+    os.makedirs(session_dir(session), exist_ok=True)
+    partial = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(partial, 'wb') as f:
+            f.write(data)
+        try:
+            # Unlike a rename, fails rather than replace a copy a concurrent request put there first
+            os.link(partial, path)
+        except FileExistsError:
+            with open(path, 'rb') as f:
+                existing = f.read(expected + 1)
+            if existing != data:
+                raise FileExistsError(f'Chunk {index} was already received with different content.') from None
+            return False
+    finally:
+        os.remove(partial)
+    return True
+
+
+def assemble(session, quota=None):
+    """
+    Concatenate the chunks into a temporary upload, inspected on the way
+    through exactly as a streamed upload_record body is. Raises ValueError
+    if chunks are missing, or an uploads.UploadRejected.
+    """
+    missing = sorted(set(range(session.chunk_count)) - set(received(session)))
+    if missing:
+        raise ValueError(f'{len(missing)} chunks are missing, starting at offset {missing[0] * session.chunk_size}.')
+    inspection = uploads.Inspection(session.file_name, uploads.MAX_UPLOAD_BYTES, quota)
+    upload = TemporaryUploadedFile(session.file_name, None, session.size, None)
+    try:
+        for index in range(session.chunk_count):
+            with open(chunk_path(session, index), 'rb') as f:
+                while True:
+                    piece = f.read(uploads.chunk_size())
+                    if not piece:
+                        break
+                    inspection.feed(piece)
+                    upload.write(piece)
+        uploads.mark(upload, *inspection.finish())
+    except Exception:
+        upload.close()
+        raise
+    upload.seek(0)
+    return upload
+
+
+def discard(session):
+    shutil.rmtree(session_dir(session), ignore_errors=True)
@@ -1,12 +1,31 @@
 from rest_framework import serializers
-from .models import User, Package, Record, Reminder, SharedLink
+from .models import User, Package, Record, Reminder, SharedLink, UploadSession
+from . import recurrence, uploads
+import os
 
-class PackageSerializer(serializers.ModelSerializer):
+class EagerLoadingMixin:
+    """
+    Declares the relations a serializer reads so list querysets can be shaped
+    up front instead of issuing one query per row. paginate() and the record
+    viewset always pass their querysets through setup_eager_loading().
+    """
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*cls.prefetch_related_fields)
+        return queryset
+
+class PackageSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = Package
         fields = '__all__'
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     package = serializers.PrimaryKeyRelatedField(queryset=Package.objects.all(), required=False, allow_null=True)
     password = serializers.CharField(write_only=True, required=False)
     can_share = serializers.BooleanField(required=False, allow_null=True)
@@ -24,6 +43,21 @@ class UserSerializer(serializers.ModelSerializer):
             pass
         return data
 
+    def create(self, validated_data):
+        # Hashed here, where the raw password comes in
+        password = validated_data.pop('password', None)
+        user = User(**validated_data)
+        if password:
+            user.set_password(password)
+        user.save()
+        return user
+
+    def update(self, instance, validated_data):
+        password = validated_data.pop('password', None)
+        if password:
+            instance.set_password(password)
+        return super().update(instance, validated_data)
+
     def get_package(self, obj):
         if obj.user_type == 'doctor' and obj.package:
             return {
@@ -38,7 +72,10 @@ class UserSerializer(serializers.ModelSerializer):
             }
         return None
 
-class RecordSerializer(serializers.ModelSerializer):
+class RecordSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    # doctor/patient render as primary keys; only get_doctor_package follows a relation
+    select_related_fields = ('doctor__package',)
+
     doctor = serializers.PrimaryKeyRelatedField(
         queryset=User.objects.filter(user_type='doctor'),
         required=True
@@ -53,7 +90,9 @@ class RecordSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Record
-        fields = ['id', 'doctor', 'patient', 'prescription', 'description', 'upload_date', 'doctor_package']
+        fields = ['id', 'doctor', 'patient', 'prescription', 'file_name', 'file_size', 'original_size', 'description',
+                  'upload_date', 'doctor_package']
+        read_only_fields = ['file_name', 'file_size', 'original_size']
 
     def get_doctor_package(self, obj):
         if obj.doctor and obj.doctor.package:
@@ -76,17 +115,73 @@ class RecordSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError({"prescription": "This field is required."})
         return data
 
-class ReminderSerializer(serializers.ModelSerializer):
+class ReminderSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     doctor = serializers.PrimaryKeyRelatedField(queryset=User.objects.filter(user_type='doctor'), required=False, allow_null=True)
     patient = serializers.PrimaryKeyRelatedField(queryset=User.objects.filter(user_type='patient'), required=False, allow_null=True)
 
     class Meta:
         model = Reminder
-        fields = ['id', 'title', 'date', 'doctor', 'patient', 'notified']
+        fields = ['id', 'title', 'date', 'doctor', 'patient', 'notified',
+                  'freq', 'interval', 'byday', 'byhour', 'until', 'count', 'next_fire_at', 'fired_count', 'updated_at']
+        read_only_fields = ['next_fire_at', 'fired_count', 'updated_at']
+
+    def validate_byday(self, value):
+        try:
+            days = recurrence.parse_byday(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return ','.join(recurrence.WEEKDAYS[day] for day in sorted(days))
+
+    def validate_byhour(self, value):
+        try:
+            hours = recurrence.parse_byhour(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return ','.join(str(hour) for hour in hours)
+
+    def validate(self, data):
+        freq = data.get('freq', '')
+        if not freq:
+            extra = [name for name in ('byday', 'byhour', 'until', 'count') if data.get(name)]
+            if extra or data.get('interval', 1) != 1:
+                raise serializers.ValidationError({'freq': f"Required when {', '.join(extra) or 'interval'} is set."})
+            return data
+        if data.get('interval', 1) < 1:
+            raise serializers.ValidationError({'interval': 'Must be at least 1.'})
+        if data.get('until') and data.get('count'):
+            raise serializers.ValidationError({'until': 'Use either until or count, not both.'})
+        if data.get('until') and data['until'] < data['date']:
+            raise serializers.ValidationError({'until': 'Must not be before date.'})
+        if recurrence.first_occurrence(Reminder(**data)) is None:
+            raise serializers.ValidationError({'freq': 'This rule never produces an occurrence.'})
+        return data
+
+class SharedLinkSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ('record__doctor__package',)
 
-class SharedLinkSerializer(serializers.ModelSerializer):
     record = RecordSerializer()
 
     class Meta:
         model = SharedLink
-        fields = ['token', 'record', 'expires_at']
\ No newline at end of file
+        fields = ['token', 'record', 'expires_at']
+
+class UploadSessionSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    doctor = serializers.PrimaryKeyRelatedField(queryset=User.objects.filter(user_type='doctor'))
+    patient = serializers.PrimaryKeyRelatedField(queryset=User.objects.filter(user_type='patient'))
+    description = serializers.CharField(required=False, allow_blank=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'doctor', 'patient', 'file_name', 'description', 'size', 'chunk_size', 'record', 'created_at', 'expires_at']
+        read_only_fields = ['chunk_size', 'record', 'created_at', 'expires_at']
+
+    def validate_file_name(self, value):
+        uploads.expected_kind(value)
+        return os.path.basename(value)
+
+    def validate_size(self, value):
+        if value < 1:
+            raise serializers.ValidationError('The file is empty.')
+        if value > uploads.MAX_UPLOAD_BYTES:
+            raise uploads.FileTooLarge()
+        return value
@@ -0,0 +1,27 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from .models import Record
+from . import blobs, derivatives, usage
+
+
+@receiver(pre_delete, sender=Record)
+def release_usage_on_delete(sender, instance, **kwargs):
+    # Hard deletes (admin, user cascades, purges) bypass the views, so the
+    # ledger is adjusted here. Soft-deleted records were already released.
+    if not instance.is_deleted:
+        usage.record_removed(instance)
+
+
+@receiver(post_delete, sender=Record)
+def release_blob_on_delete(sender, instance, **kwargs):
+    # After the row is gone, so the blob's remaining references can be counted
+    blobs.forget(instance, was_live=not instance.is_deleted)
+
+
+@receiver(post_save, sender=Record)
+def schedule_derivatives(sender, instance, created, **kwargs):
+    # Once committed, so a worker never looks for a file whose upload was rolled back
+    if created and instance.sha256:
+        sha256, name = instance.sha256, instance.prescription.name
+        transaction.on_commit(lambda: derivatives.schedule(sha256, name))
@@ -0,0 +1,61 @@
+"""
+Content-addressed storage for record files.
+
+A file is stored once, at ``blobs/<aa>/<bb>/<sha256><ext>``, however many
+records point at it: the same lab report uploaded by the doctor and again by
+the patient is one file and one Blob row with two references. Record.save()
+hashes the upload (or reuses the digest taken while it streamed in) and
+``upload_to`` turns the digest into the name, so the storage only has to
+notice that the name already exists and skip the write.
+
+Reference counting lives on the Blob row (see hospital/blobs.py).
+"""
+from django.core.files.storage import FileSystemStorage
+import os
+import uuid
+
+BLOB_PREFIX = 'blobs'
+# One extension per kind, so identical bytes uploaded as .jpg and .jpeg share a blob
+EXTENSION_ALIASES = {'.jpeg': '.jpg'}
+
+
+def blob_name(sha256, file_name):
+    ext = os.path.splitext(file_name or '')[1].lower()
+    ext = EXTENSION_ALIASES.get(ext, ext)
+    return f'{BLOB_PREFIX}/{sha256[:2]}/{sha256[2:4]}/{sha256}{ext}'
+
+
+def upload_to(instance, filename):
+    """Record.prescription's upload_to: the blob chosen in Record.save()."""
+    if instance.blob_id:
+        return instance.blob.name
+    return blob_name(instance.sha256, filename)
+
+
+class BlobStorage(FileSystemStorage):
+    """MEDIA_ROOT storage that treats an existing name as the same content."""
+
+    def get_available_name(self, name, max_length=None):
+        # Names are digests: an existing file is this file, never a clash to rename around
+        return name
+
+    def _save(self, name, content):
+        try:
+            # An existing file is reused, its mtime refreshed so collect_orphan_files'
+            # grace period covers a file this upload is about to reference again
+            os.utime(self.path(name))
+            return name
+        except FileNotFoundError:
+            pass
+        # Written under a private name and renamed, so a concurrent upload of
+        # the same content never reads or clobbers half a file
+        partial = super()._save(f'{name}.{uuid.uuid4().hex}.partial', content)
+        os.replace(self.path(partial), self.path(name))
+        return name
+
+
+blob_storage = BlobStorage()
+
+
+def get_blob_storage():
+    return blob_storage
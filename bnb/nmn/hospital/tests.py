@@ -1,13 +1,34 @@
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from unittest import skipUnless
 from rest_framework.test import APITestCase, APIClient
 from django.contrib.auth import get_user_model
-from hospital.models import Package, Record, Reminder, SharedLink
+from django.test import override_settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, make_password
+from django.core.cache import cache
+from django.urls import URLResolver
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from hospital import urls as hospital_urls
+from hospital.models import ArchiveSegment, Blob, OutboundEmail, Package, Record, Reminder, ReminderEvent, SharedLink, UploadSession, UsageLedger
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
 from django.utils import timezone
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone as dt_timezone
+from collections import Counter
+from io import StringIO
+from asgiref.sync import sync_to_async
+import asyncio
+import io
 import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
 
 User = get_user_model()
 
@@ -232,4 +253,2038 @@ class ReminderCommandTests(TestCase):
         self.assertTrue(self.reminder.notified)
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].subject, "Reminder: Doctor Visit")
-        self.assertEqual(mail.outbox[0].to, ["tharunkumarvk28@gmail.com"])
\ No newline at end of file
+        self.assertEqual(mail.outbox[0].to, ["tharunkumarvk28@gmail.com"])
+
+class MediaRootMixin:
+    """
+    Each test gets an empty MEDIA_ROOT of its own, removed afterwards.
+    ``media_settings`` adds overrides that depend on it.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, **self.media_settings())
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def media_settings(self):
+        return {}
+
+    def create_users(self, **package):
+        """A package with ``package``'s limits, and drbob and john on it."""
+        self.package = Package.objects.create(name="Basic", price=10.00, **package)
+        self.doctor = User.objects.create_user(
+            username="drbob", email="drbob@example.com", password="RustyB0ff!n28#",
+            user_type="doctor", phone_number="1234567890", package=self.package
+        )
+        self.patient = User.objects.create_user(
+            username="john", email="john@example.com", password="Th@runkum@r2025!",
+            user_type="patient", phone_number="9876543210", package=self.package
+        )
+
+
+class UsageLedgerTests(MediaRootMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_users(max_uploads=3, max_storage_mb=1)
+        self.client.force_authenticate(self.patient)
+
+    def upload(self, size=1024, name="scan.jpg"):
+        return self.client.post('/api/records/upload/', {
+            "patient": self.patient.id,
+            "doctor": self.doctor.id,
+            "prescription": SimpleUploadedFile(name, b"\xff\xd8\xff" + b"x" * (size - 3), content_type="image/jpeg"),
+        }, format='multipart')
+
+    def test_upload_and_delete_update_ledger(self):
+        self.assertEqual(self.upload(1000).status_code, 201)
+        self.assertEqual(self.upload(500).status_code, 201)
+        ledger = UsageLedger.objects.get(user=self.patient)
+        self.assertEqual((ledger.upload_count, ledger.bytes_used), (2, 1500))
+
+        record = Record.objects.filter(patient=self.patient).first()
+        self.client.post(f'/api/records/{record.id}/delete/')
+        self.client.post(f'/api/records/{record.id}/delete/')
+        ledger.refresh_from_db()
+        self.assertEqual((ledger.upload_count, ledger.bytes_used), (1, 500))
+
+    def test_quota_checks_read_the_ledger(self):
+        self.assertEqual(self.upload(1000).status_code, 201)
+        UsageLedger.objects.filter(user=self.patient).update(bytes_used=1024 * 1024)
+        response = self.upload(1000)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data, {'error': 'You have exceeded your storage limit.'})
+
+        response = self.client.get('/api/api/package-details/')
+        self.assertEqual(response.data['current_uploads'], 1)
+        self.assertEqual(response.data['used_storage_mb'], 1)
+
+    def test_hard_delete_releases_usage(self):
+        self.upload(1000)
+        Record.objects.filter(patient=self.patient).delete()
+        ledger = UsageLedger.objects.get(user=self.patient)
+        self.assertEqual((ledger.upload_count, ledger.bytes_used), (0, 0))
+
+    @override_settings(UPLOAD_CHUNK_SIZE=1024)
+    def test_upload_is_inspected_while_it_streams(self):
+        import hashlib
+        content = b"\xff\xd8\xff" + os.urandom(5000)
+        response = self.client.post('/api/records/upload/', {
+            "patient": self.patient.id, "doctor": self.doctor.id,
+            "prescription": SimpleUploadedFile("scan.jpg", content, content_type="image/jpeg")}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        record = Record.objects.get(patient=self.patient)
+        self.assertEqual((record.file_size, record.sha256), (len(content), hashlib.sha256(content).hexdigest()))
+        with open(record.prescription.path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    @override_settings(UPLOAD_CHUNK_SIZE=1024)
+    def test_quota_is_enforced_mid_stream(self):
+        UsageLedger.objects.create(user=self.patient, bytes_used=1024 * 1024 - 2000)
+        response = self.upload(5000)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data, {'error': 'You have exceeded your storage limit.'})
+        self.assertFalse(Record.objects.exists())
+        self.assertEqual(os.listdir(self.media_root), [])
+
+    def test_content_must_match_extension(self):
+        response = self.upload(1000, name="scan.pdf")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Unsupported file type', response.data['error'])
+        self.assertEqual(self.upload(1000, name="scan.exe").status_code, 400)
+        self.assertFalse(Record.objects.exists())
+
+    def test_oversized_body_is_refused_unread(self):
+        self.package.max_storage_mb = 100
+        self.package.save()
+        response = self.upload(11 * 1024 * 1024)
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Record.objects.exists())
+
+    def test_records_saved_elsewhere_get_a_digest(self):
+        import hashlib
+        record = Record.objects.create(patient=self.patient, doctor=self.doctor, prescription=SimpleUploadedFile(
+            "direct.png", b"\x89PNG\r\n\x1a\n" + b"p" * 100, content_type="image/png"))
+        self.assertEqual(record.sha256, hashlib.sha256(b"\x89PNG\r\n\x1a\n" + b"p" * 100).hexdigest())
+
+    def test_rebuild_usage_reconciles_from_disk(self):
+        self.upload(1000)
+        record = Record.objects.get(patient=self.patient)
+        record.shared_with.add(self.doctor)
+        UsageLedger.objects.filter(user=self.patient).update(bytes_used=1, upload_count=7)
+        with open(record.prescription.path, 'ab') as f:
+            f.write(b"y" * 24)
+        out = StringIO()
+        call_command('rebuild_usage', '--batch-size', '1', stdout=out)
+        ledger = UsageLedger.objects.get(user=self.patient)
+        self.assertEqual((ledger.upload_count, ledger.bytes_used, ledger.share_count), (1, 1024, 1))
+        self.assertIn('1 corrected', out.getvalue())
+
+
+# Tables whose hot-path lookups must always go through an index
+INDEXED_TABLES = ('hospital_record', 'hospital_reminder', 'hospital_sharedlink', 'hospital_user')
+
+def full_table_scans(sql):
+    """Return the plan steps of ``sql`` that walk an entire hot table."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            steps = [row[-1] for row in cursor.fetchall()]
+            return [step for step in steps if step.split()[0] == 'SCAN' and step.split()[1] in INDEXED_TABLES]
+        cursor.execute('EXPLAIN ' + sql)
+        columns = [col[0].lower() for col in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return [f"{row['table']}: type=ALL" for row in rows if row.get('type') == 'ALL' and row.get('table') in INDEXED_TABLES]
+
+
+class BlobStorageTests(MediaRootMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_users(max_uploads=10)
+        self.content = b"%PDF-" + os.urandom(2000)
+
+    def upload(self, user, name="lab-report.pdf", content=None):
+        self.client.force_authenticate(user)
+        return self.client.post('/api/records/upload/', {
+            "patient": self.patient.id, "doctor": self.doctor.id,
+            "prescription": SimpleUploadedFile(name, content or self.content, content_type="application/pdf")}, format='multipart')
+
+    def blob_files(self):
+        return [name for _, _, names in os.walk(os.path.join(self.media_root, 'blobs')) for name in names]
+
+    def test_identical_uploads_share_one_file(self):
+        import hashlib
+        self.assertEqual(self.upload(self.doctor).status_code, 201)
+        self.assertEqual(self.upload(self.patient, name="copy.pdf").status_code, 201)
+        first, second = Record.objects.order_by('id')
+        self.assertEqual(first.prescription.name, second.prescription.name)
+        self.assertEqual(self.blob_files(), [f'{hashlib.sha256(self.content).hexdigest()}.pdf'])
+        self.assertEqual(Blob.objects.get().refcount, 2)
+        self.assertEqual((first.file_name, second.file_name), ("lab-report.pdf", "copy.pdf"))
+
+        response = self.client.get(f'/api/records/{second.id}/download/')
+        self.assertIn('filename="copy.pdf"', response['Content-Disposition'])
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_deletes_release_references(self):
+        self.upload(self.doctor)
+        self.upload(self.patient)
+        first, second = Record.objects.order_by('id')
+        self.client.force_authenticate(self.patient)
+        self.client.post(f'/api/records/{first.id}/delete/')
+        blob = Blob.objects.get()
+        self.assertEqual(blob.refcount, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(Blob.objects.get().refcount, 0)
+        # The soft-deleted record still points at the file
+        self.assertEqual(len(self.blob_files()), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Record.objects.get(id=first.id).delete()
+        self.assertFalse(Blob.objects.exists())
+        self.assertEqual(self.blob_files(), [])
+
+    def test_replacing_a_file_releases_the_old_blob(self):
+        self.upload(self.doctor)
+        record = Record.objects.get()
+        old_path = record.prescription.path
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(f'/api/records/{record.id}/', {
+                "patient": self.patient.id, "doctor": self.doctor.id,
+                "prescription": SimpleUploadedFile("scan.png", png_bytes(40, 30), content_type="image/png")}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        record.refresh_from_db()
+        self.assertEqual(record.file_name, "scan.png")
+        self.assertTrue(record.prescription.name.endswith('.png'))
+        self.assertEqual(list(Blob.objects.values_list('id', 'refcount')), [(record.blob_id, 1)])
+        self.assertFalse(os.path.exists(old_path))
+        self.assertEqual(self.blob_files(), [os.path.basename(record.prescription.name)])
+
+    def test_updating_a_record_keeps_one_reference(self):
+        self.upload(self.doctor)
+        record = Record.objects.get()
+        response = self.client.put(f'/api/records/{record.id}/', {
+            "patient": self.patient.id, "doctor": self.doctor.id,
+            "prescription": SimpleUploadedFile("again.pdf", self.content, content_type="application/pdf")}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Blob.objects.get().refcount, 1)
+
+        # Deleted and restored in the same update as the file is sent again
+        from hospital.serializers import RecordSerializer
+        from hospital.views import RecordViewSet
+        view = RecordViewSet()
+        for deleted, refcount in ((True, 0), (False, 1)):
+            record = Record.objects.get()
+            record.is_deleted = deleted
+            serializer = RecordSerializer(record, data={
+                "patient": self.patient.id, "doctor": self.doctor.id,
+                "prescription": SimpleUploadedFile("again.pdf", self.content, content_type="application/pdf")})
+            serializer.is_valid(raise_exception=True)
+            view.perform_update(serializer)
+            self.assertEqual(Blob.objects.get().refcount, refcount)
+
+    def test_dedupe_command_collapses_existing_files(self):
+        other = b"\x89PNG\r\n\x1a\n" + os.urandom(500)
+        os.makedirs(os.path.join(self.media_root, 'prescriptions'))
+        for name, content in (('a.pdf', self.content), ('b.pdf', self.content), ('c.png', other)):
+            with open(os.path.join(self.media_root, 'prescriptions', name), 'wb') as f:
+                f.write(content)
+        Record.objects.bulk_create([
+            Record(patient=self.patient, doctor=self.doctor, prescription='prescriptions/a.pdf'),
+            Record(patient=self.patient, doctor=self.doctor, prescription='prescriptions/b.pdf', is_deleted=True),
+            Record(patient=self.patient, doctor=self.doctor, prescription='prescriptions/c.png'),
+            Record(patient=self.patient, doctor=self.doctor, prescription='prescriptions/gone.pdf'),
+        ])
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_blobs', workers=2, batch_size=2, stdout=out)
+        self.assertIn(f'Moved 3 records into 2 blobs, reclaiming {len(self.content)} bytes; 1 files missing', out.getvalue())
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'prescriptions')), [])
+        self.assertEqual(sorted(Blob.objects.values_list('size', 'refcount')), [(len(other), 1), (len(self.content), 1)])
+        a, b = Record.objects.filter(prescription__startswith='blobs/').order_by('id')[:2]
+        self.assertEqual((a.prescription.name, a.file_name, b.file_name), (b.prescription.name, 'a.pdf', 'b.pdf'))
+        with a.prescription.open('rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_collect_orphan_files_removes_unreferenced_files_past_the_grace_period(self):
+        self.upload(self.doctor)
+        record = Record.objects.get()
+        legacy_dir = os.path.join(self.media_root, 'prescriptions')
+        os.makedirs(legacy_dir)
+        Record.objects.bulk_create([Record(patient=self.patient, doctor=self.doctor, prescription='prescriptions/kept.pdf')])
+        orphans = {
+            'prescriptions/kept.pdf': b'%PDF-kept',
+            'prescriptions/failed-upload.pdf': b'%PDF-' + os.urandom(100),
+            'blobs/ab/cd/' + 'abcd' * 16 + '.pdf': b'%PDF-' + os.urandom(200),
+            record.prescription.name + '.0123.partial': b'%PDF-half',
+            'prescriptions/in-flight.pdf': b'%PDF-' + os.urandom(50),
+        }
+        old = time.time() - 2 * 86400
+        for name, content in orphans.items():
+            path = os.path.join(self.media_root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+            if name != 'prescriptions/in-flight.pdf':
+                os.utime(path, (old, old))
+        os.utime(record.prescription.path, (old, old))
+        doomed = ['prescriptions/failed-upload.pdf', 'blobs/ab/cd/' + 'abcd' * 16 + '.pdf', record.prescription.name + '.0123.partial']
+        size = sum(len(orphans[name]) for name in doomed)
+
+        out = StringIO()
+        call_command('collect_orphan_files', batch_size=2, grace_hours=24, dry_run=True, stdout=out)
+        self.assertIn(f'[dry run] Found 3 orphaned files ({size} bytes) among 6 scanned; 1 within the grace period', out.getvalue())
+        self.assertTrue(all(os.path.exists(os.path.join(self.media_root, name)) for name in doomed))
+
+        out = StringIO()
+        # Two indexed lookups per batch of blob files, one per batch of legacy ones
+        with self.assertNumQueries(5):
+            call_command('collect_orphan_files', batch_size=2, workers=2, grace_hours=24, stdout=out)
+        self.assertIn(f'Removed 3 orphaned files, reclaiming {size} bytes', out.getvalue())
+        self.assertFalse(any(os.path.exists(os.path.join(self.media_root, name)) for name in doomed))
+        self.assertEqual(sorted(os.listdir(legacy_dir)), ['in-flight.pdf', 'kept.pdf'])
+        self.assertTrue(os.path.exists(record.prescription.path))
+
+        # Uploading content whose file is still on disk takes it over and refreshes it
+        os.utime(record.prescription.path, (old, old))
+        self.upload(self.patient, name="again.pdf")
+        self.assertGreater(os.stat(record.prescription.path).st_mtime, old + 86400)
+
+
+class FileDeliveryTests(MediaRootMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_users()
+        self.content = b"%PDF-" + os.urandom(4000)
+        self.record = Record.objects.create(patient=self.patient, doctor=self.doctor,
+                                            prescription=SimpleUploadedFile("report.pdf", self.content))
+        self.url = f'/api/records/{self.record.id}/download/'
+        self.client.force_authenticate(self.patient)
+
+    def test_full_download_carries_validators(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['ETag'], f'"{self.record.sha256}"')
+        self.assertEqual((response['Accept-Ranges'], response['Content-Length']), ('bytes', str(len(self.content))))
+        self.assertIn('Last-Modified', response)
+
+        again = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+        again = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(again.status_code, 304)
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[100:200])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-50')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-50:])
+        response = self.client.get(self.url, HTTP_RANGE='bytes=4000-')
+        self.assertEqual(b''.join(response.streaming_content), self.content[4000:])
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, f'bytes */{len(self.content)}'))
+
+    def test_if_range_falls_back_to_the_whole_file_when_stale(self):
+        tag = f'"{self.record.sha256}"'
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=tag)
+        self.assertEqual(response.status_code, 206)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"something-else"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_front_server_handoff(self):
+        with override_settings(FILE_DELIVERY='x-accel-redirect', FILE_DELIVERY_ACCEL_PREFIX='/protected/'):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/{self.record.prescription.name}')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertIn('filename="report.pdf"', response['Content-Disposition'])
+        self.assertEqual(response.content, b'')
+
+        link = SharedLink.objects.create(record=self.record, token=str(uuid.uuid4()), expires_at=timezone.now() + timedelta(hours=1))
+        self.client.force_authenticate(None)
+        with override_settings(FILE_DELIVERY='x-sendfile'):
+            response = self.client.get(f'/api/share/{link.token}/')
+            self.assertEqual(response['X-Sendfile'], self.record.prescription.path)
+            self.assertEqual(self.client.get(f'/api/share/{link.token}/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+
+
+class AsyncFileViewTests(MediaRootMixin, TestCase):
+    def media_settings(self):
+        from benchmarks.scenarios import AsyncFileURLConf
+        return {'ROOT_URLCONF': AsyncFileURLConf, 'FILE_STREAM_CHUNK_SIZE': 1000}
+
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+        self.doctor = User.objects.create_user(username="adoc", password="x", user_type="doctor", phone_number="1")
+        self.patient = User.objects.create_user(username="apat", password="x", user_type="patient", phone_number="2")
+        self.other = User.objects.create_user(username="aother", password="x", user_type="patient", phone_number="3")
+        self.content = b"%PDF-" + os.urandom(4000)
+        self.record = Record.objects.create(patient=self.patient, doctor=self.doctor,
+                                            prescription=SimpleUploadedFile("report.pdf", self.content))
+        self.url = f'/api/records/{self.record.id}/download/'
+
+    def auth(self, user):
+        return {'Authorization': f'Bearer {AccessToken.for_user(user)}'}
+
+    async def body(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    async def test_download_streams_in_chunks_and_honours_validators(self):
+        response = await self.async_client.get(self.url, headers=self.auth(self.patient))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual((b''.join(chunks), len(chunks)), (self.content, 5))
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['ETag'], f'"{self.record.sha256}"')
+
+        again = await self.async_client.get(self.url, headers={**self.auth(self.patient), 'If-None-Match': response['ETag']})
+        self.assertEqual(again.status_code, 304)
+        partial = await self.async_client.get(self.url, headers={**self.auth(self.patient), 'Range': 'bytes=1000-2499'})
+        self.assertEqual((partial.status_code, partial['Content-Range']), (206, f'bytes 1000-2499/{len(self.content)}'))
+        self.assertEqual(await self.body(partial), self.content[1000:2500])
+
+    async def test_archived_file_streams_from_its_segment(self):
+        with override_settings(ARCHIVE_ROOT=os.path.join(self.media_root, 'archive')):
+            await sync_to_async(Record.objects.update)(upload_date=timezone.now() - timedelta(days=365))
+            await sync_to_async(call_command)('archive_records', workers=1, stdout=StringIO())
+            response = await self.async_client.get(self.url, headers=self.auth(self.patient))
+            self.assertEqual(await self.body(response), self.content)
+            partial = await self.async_client.get(self.url, headers={**self.auth(self.patient), 'Range': 'bytes=3500-'})
+            self.assertEqual(await self.body(partial), self.content[3500:])
+        self.assertTrue(await Blob.objects.filter(pk=self.record.blob_id, segment__isnull=False).aexists())
+
+    async def test_authentication_and_access(self):
+        self.assertEqual((await self.async_client.get(self.url)).status_code, 401)
+        self.assertEqual((await self.async_client.post(self.url, headers=self.auth(self.patient))).status_code, 405)
+        preview = f'/api/records/{self.record.id}/preview/'
+        self.assertEqual((await self.async_client.get(preview, headers=self.auth(self.other))).status_code, 403)
+        response = await self.async_client.get(preview, headers=self.auth(self.doctor))
+        self.assertEqual((response.status_code, response.json()['record_id']), (200, self.record.id))
+
+    async def test_shared_link_is_anonymous(self):
+        link = await SharedLink.objects.acreate(record=self.record, token=str(uuid.uuid4()), expires_at=timezone.now() + timedelta(hours=1))
+        response = await self.async_client.get(f'/api/share/{link.token}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await self.body(response), self.content)
+        await SharedLink.objects.filter(pk=link.pk).aupdate(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual((await self.async_client.get(f'/api/share/{link.token}/')).status_code, 410)
+
+
+
+def png_bytes(width, height, color=(200, 40, 40)):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@override_settings(DERIVATIVE_WORKERS=0, DERIVATIVE_PREVIEW_SIZE=400, DERIVATIVE_THUMBNAIL_SIZE=100)
+class DerivativeTests(MediaRootMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor = User.objects.create_user(username="ddoc", password="x", user_type="doctor", phone_number="1")
+        self.patient = User.objects.create_user(username="dpat", password="x", user_type="patient", phone_number="2")
+        self.client.force_authenticate(self.patient)
+
+    def tearDown(self):
+        from hospital import derivatives
+        derivatives.wait(30)
+
+    def create(self, name, content):
+        return Record.objects.create(patient=self.patient, doctor=self.doctor, prescription=SimpleUploadedFile(name, content))
+
+    def dimensions(self, name):
+        from PIL import Image
+        with Image.open(os.path.join(self.media_root, name)) as image:
+            return image.size
+
+    def test_upload_renders_in_the_pool_and_preview_points_at_them(self):
+        from hospital import derivatives
+        with override_settings(DERIVATIVE_WORKERS=1), self.captureOnCommitCallbacks(execute=True):
+            record = self.create("scan.png", png_bytes(1200, 900))
+        derivatives.wait(60)
+        self.assertEqual(derivatives.missing(record.sha256), [])
+        self.assertEqual(self.dimensions(derivatives.name(record.sha256, 'preview')), (400, 300))
+        self.assertEqual(self.dimensions(derivatives.name(record.sha256, 'thumbnail')), (100, 75))
+
+        body = self.client.get(f'/api/records/{record.id}/preview/').json()
+        self.assertTrue(body['preview_url'].endswith(f"/media/{derivatives.name(record.sha256, 'preview')}"))
+        self.assertTrue(body['thumbnail_url'].endswith(f"/media/{derivatives.name(record.sha256, 'thumbnail')}"))
+        self.assertTrue(body['original_url'].endswith(record.prescription.url))
+
+    def test_preview_falls_back_to_the_original_until_rendered(self):
+        record = self.create("scan.png", png_bytes(300, 200))
+        body = self.client.get(f'/api/records/{record.id}/preview/').json()
+        self.assertEqual(body['preview_url'], body['original_url'])
+        self.assertIsNone(body['thumbnail_url'])
+
+    def test_build_derivatives_backfills_each_file_once(self):
+        from hospital import derivatives, imaging
+        first = self.create("a.png", png_bytes(800, 800))
+        self.create("copy.png", png_bytes(800, 800))
+        self.create("report.pdf", b"%PDF-" + os.urandom(500))
+        out = StringIO()
+        call_command('build_derivatives', workers=1, stdout=out)
+        rendered = 1 + (imaging.pdfium is not None)
+        self.assertIn(f'Rendered {rendered} files', out.getvalue())
+        self.assertEqual(derivatives.missing(first.sha256), [])
+        self.assertEqual(self.dimensions(derivatives.name(first.sha256, 'preview')), (400, 400))
+
+        out = StringIO()
+        call_command('build_derivatives', workers=1, stdout=out)
+        self.assertIn('Rendered 0 files', out.getvalue())
+
+    def test_eviction_removes_least_recently_used_first(self):
+        from hospital import imaging
+        root = os.path.join(self.media_root, 'derivatives')
+        os.makedirs(os.path.join(root, 'ab'))
+        for n in range(10):
+            path = os.path.join(root, 'ab', f'{n}.jpg')
+            with open(path, 'wb') as f:
+                f.write(b'0' * 1000)
+            os.utime(path, (1000 + n, 1000 + n))
+        self.assertEqual(imaging.evict(root, 20000), (0, 0))
+        self.assertEqual(imaging.evict(root, 8000), (3, 3000))
+        self.assertEqual(sorted(os.listdir(os.path.join(root, 'ab'))), [f'{n}.jpg' for n in range(3, 10)])
+
+
+
+def photo_jpeg(width, height, quality=95, exif=True):
+    from PIL import Image
+    image = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    options = {}
+    if exif:
+        tags = Image.Exif()
+        tags[0x010F] = 'PhoneMaker'
+        tags[0x0110] = 'Model X'
+        options['exif'] = tags
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality, **options)
+    return buffer.getvalue()
+
+
+@override_settings(INGEST_WORKERS=1, INGEST_MAX_DIMENSION=300)
+class IngestTests(MediaRootMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.package = Package.objects.create(name="Basic", price=10.00, max_uploads=10, max_storage_mb=50)
+        self.doctor = User.objects.create_user(username="idoc", password="x", user_type="doctor", phone_number="1")
+        self.patient = User.objects.create_user(username="ipat", password="x", user_type="patient", phone_number="2",
+                                                package=self.package)
+        self.client.force_authenticate(self.patient)
+
+    def upload(self, name, content, content_type="image/jpeg"):
+        return self.client.post('/api/records/upload/', {
+            "patient": self.patient.id, "doctor": self.doctor.id,
+            "prescription": SimpleUploadedFile(name, content, content_type=content_type)}, format='multipart')
+
+    def stored(self, record):
+        from PIL import Image
+        with open(record.prescription.path, 'rb') as f:
+            data = f.read()
+        with Image.open(io.BytesIO(data)) as image:
+            return data, image.format, image.size, dict(image.getexif())
+
+    def test_large_photo_is_scaled_recompressed_and_stripped(self):
+        from hospital import usage
+        original = photo_jpeg(600, 400)
+        response = self.upload("scan.jpg", original)
+        self.assertEqual(response.status_code, 201)
+        record = Record.objects.get()
+        data, fmt, size, exif = self.stored(record)
+        self.assertEqual((fmt, size, exif), ('JPEG', (300, 200), {}))
+        self.assertEqual((record.original_size, record.file_size), (len(original), len(data)))
+        self.assertEqual((response.data['original_size'], response.data['file_size']), (len(original), len(data)))
+        self.assertLess(len(data), len(original) / 2)
+        self.assertEqual(usage.get_ledger(self.patient).bytes_used, len(data))
+
+    def test_metadata_is_stripped_losslessly_when_re_encoding_saves_too_little(self):
+        original = photo_jpeg(200, 100, quality=60)
+        self.assertEqual(self.upload("small.jpg", original).status_code, 201)
+        record = Record.objects.get()
+        data, fmt, size, exif = self.stored(record)
+        self.assertEqual((fmt, size, exif), ('JPEG', (200, 100), {}))
+        # Only the Exif segment is gone: the compressed image is byte for byte the same
+        self.assertEqual(data[-1000:], original[-1000:])
+        self.assertLess(len(data), len(original))
+
+    def test_photographic_png_is_stored_as_jpeg(self):
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.frombytes('RGB', (200, 150), os.urandom(200 * 150 * 3)).save(buffer, 'PNG')
+        self.assertEqual(self.upload("photo.png", buffer.getvalue(), "image/png").status_code, 201)
+        record = Record.objects.get()
+        self.assertEqual(self.stored(record)[1], 'JPEG')
+        self.assertEqual(record.file_name, 'photo.jpg')
+        self.assertTrue(record.prescription.name.endswith('.jpg'))
+
+        # A flat document render stays a PNG
+        self.assertEqual(self.upload("letter.png", png_bytes(200, 150), "image/png").status_code, 201)
+        self.assertEqual(self.stored(Record.objects.latest('id'))[1], 'PNG')
+
+    def test_undecodable_images_are_stored_as_sent(self):
+        content = b'\xff\xd8\xff' + os.urandom(500)
+        self.assertEqual(self.upload("broken.jpg", content).status_code, 201)
+        record = Record.objects.get()
+        self.assertEqual((record.file_size, record.original_size), (len(content), len(content)))
+
+    def test_compact_records_rewrites_stored_files(self):
+        from hospital import usage
+        original = photo_jpeg(600, 400)
+        with override_settings(INGEST_WORKERS=0):
+            self.upload("old.jpeg", original)
+            self.client.force_authenticate(self.doctor)
+            self.upload("old-copy.jpg", original)
+        first, second = Record.objects.order_by('id')
+        self.assertIsNone(first.original_size)
+        old_path = first.prescription.path
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('compact_records', workers=1, stdout=out)
+        self.assertIn(f'Compacted 1 files from {len(original)} to', out.getvalue())
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual((first.original_size, first.file_name), (len(original), "old.jpeg"))
+        self.assertEqual(self.stored(first)[2], (300, 200))
+        self.assertFalse(os.path.exists(old_path))
+        self.assertEqual(Blob.objects.get().refcount, 2)
+        self.assertEqual(usage.get_ledger(self.patient).bytes_used, 2 * first.file_size)
+
+        out = StringIO()
+        call_command('compact_records', workers=1, stdout=out)
+        self.assertIn('Compacted 0 files', out.getvalue())
+
+
+@override_settings(INGEST_WORKERS=0, DERIVATIVE_WORKERS=0)
+class PurgeTests(MediaRootMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.package = Package.objects.create(name="Basic", price=10.00, max_uploads=10, max_storage_mb=50)
+        self.doctor = User.objects.create_user(username="pdoc", password="x", user_type="doctor", phone_number="1")
+        self.patient = User.objects.create_user(username="ppat", password="x", user_type="patient", phone_number="2",
+                                                package=self.package)
+        self.client.force_authenticate(self.patient)
+
+    def upload(self, content, name="report.pdf"):
+        response = self.client.post('/api/records/upload/', {
+            "patient": self.patient.id, "doctor": self.doctor.id,
+            "prescription": SimpleUploadedFile(name, content, content_type="application/pdf")}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        return Record.objects.get(id=response.data['id'])
+
+    def delete(self, record, days_ago):
+        self.client.post(f'/api/records/{record.id}/delete/')
+        Record.objects.filter(id=record.id).update(deleted_at=timezone.now() - timedelta(days=days_ago))
+
+    def test_purges_due_records_and_files_no_record_uses(self):
+        from hospital import purge, usage
+        old, recent, shared = b"%PDF-" + os.urandom(3000), b"%PDF-" + os.urandom(2000), b"%PDF-" + os.urandom(1000)
+        gone = self.upload(old)
+        kept = self.upload(recent)
+        shared_deleted = self.upload(shared)
+        shared_live = self.upload(shared, name="copy.pdf")
+        SharedLink.objects.create(record=gone, token="t", expires_at=timezone.now() + timedelta(days=1))
+        self.delete(gone, 40)
+        self.delete(kept, 10)
+        self.delete(shared_deleted, 40)
+        self.assertIsNotNone(Record.objects.get(id=kept.id).deleted_at)
+        bytes_used = usage.get_ledger(self.patient).bytes_used
+
+        with self.captureOnCommitCallbacks(execute=True):
+            totals = purge.purge(days=30, pause=0)
+        self.assertEqual(totals, {'records': 2, 'files': 1, 'bytes': len(old), 'batches': 1})
+        self.assertEqual(set(Record.objects.values_list('id', flat=True)), {kept.id, shared_live.id})
+        self.assertFalse(os.path.exists(gone.prescription.path))
+        self.assertTrue(os.path.exists(shared_live.prescription.path))
+        self.assertFalse(SharedLink.objects.exists())
+        self.assertEqual(Blob.objects.get(id=shared_live.blob_id).refcount, 1)
+        self.assertEqual(usage.get_ledger(self.patient).bytes_used, bytes_used)
+
+    def test_command_deletes_in_batches(self):
+        records = [self.upload(b"%PDF-" + os.urandom(500)) for _ in range(5)]
+        for record in records:
+            self.delete(record, 31)
+        # Saved before content-addressed storage: no blob, and the file is removed by name
+        os.makedirs(os.path.join(self.media_root, 'prescriptions'))
+        with open(os.path.join(self.media_root, 'prescriptions', 'legacy.pdf'), 'wb') as f:
+            f.write(b'%PDF-legacy')
+        Record.objects.bulk_create([Record(patient=self.patient, doctor=self.doctor, prescription='prescriptions/legacy.pdf',
+                                           file_size=11, is_deleted=True, deleted_at=timezone.now() - timedelta(days=60))])
+
+        out = StringIO()
+        call_command('purge_records', dry_run=True, stdout=out)
+        self.assertIn('[dry run] 6 records are due for purging, holding up to 2536 bytes', out.getvalue())
+        self.assertEqual(Record.objects.count(), 6)
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('purge_records', batch_size=2, pause=0, max_batches=2, stdout=out)
+        self.assertIn('Purged 4 records in 2 batches', out.getvalue())
+        # Oldest deletion first
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'prescriptions', 'legacy.pdf')))
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('purge_records', batch_size=2, pause=0, stdout=out)
+        self.assertIn('Purged 2 records in 1 batches, reclaiming 1010 bytes (2 files)', out.getvalue())
+        self.assertFalse(Record.objects.exists())
+        self.assertFalse(Blob.objects.exists())
+        self.assertEqual([name for _, _, names in os.walk(self.media_root) for name in names], [])
+
+
+@override_settings(INGEST_WORKERS=0, DERIVATIVE_WORKERS=0)
+class ArchiveTests(MediaRootMixin, APITestCase):
+    def media_settings(self):
+        return {'ARCHIVE_ROOT': os.path.join(self.media_root, 'archive')}
+
+    def setUp(self):
+        super().setUp()
+        self.doctor = User.objects.create_user(username="cdoc", password="x", user_type="doctor", phone_number="1")
+        self.patient = User.objects.create_user(username="cpat", password="x", user_type="patient", phone_number="2")
+        # One entry that compresses well and one that does not
+        self.text = b"%PDF-" + b"Take one tablet twice daily after meals.\n" * 2000
+        self.scan = b"%PDF-" + os.urandom(30000)
+        self.report = self.create(self.text, "report.pdf")
+        self.photo = self.create(self.scan, "scan.pdf")
+        Record.objects.update(upload_date=timezone.now() - timedelta(days=200))
+        self.client.force_authenticate(self.patient)
+
+    def create(self, content, name):
+        return Record.objects.create(patient=self.patient, doctor=self.doctor, prescription=SimpleUploadedFile(name, content))
+
+    def archive(self, **options):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('archive_records', workers=2, stdout=out, **options)
+        return out.getvalue()
+
+    def download(self, record, **headers):
+        response = self.client.get(f'/api/records/{record.id}/download/', headers=headers)
+        return response, b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_archived_files_are_served_from_segments(self):
+        hot_paths = [self.report.prescription.path, self.photo.prescription.path]
+        self.assertIn(f'[dry run] 2 files ({len(self.text) + len(self.scan)} bytes)', self.archive(dry_run=True))
+        self.assertIn(f'Archived 2 files, {len(self.text) + len(self.scan)} bytes packed into', self.archive())
+        self.assertFalse(any(os.path.exists(path) for path in hot_paths))
+        text_blob, scan_blob = Blob.objects.get(pk=self.report.blob_id), Blob.objects.get(pk=self.photo.blob_id)
+        self.assertEqual((text_blob.compressed, scan_blob.compressed), (True, False))
+        self.assertLess(text_blob.segment_length, len(self.text) / 10)
+        self.assertEqual(text_blob.segment_id, scan_blob.segment_id)
+        self.assertIn('Archived 0 files', self.archive())
+
+        for record, content in ((self.report, self.text), (self.photo, self.scan)):
+            response, body = self.download(record)
+            self.assertEqual((response.status_code, body), (200, content))
+            self.assertEqual(response['Content-Length'], str(len(content)))
+            self.assertEqual(self.download(record, If_None_Match=response['ETag'])[0].status_code, 304)
+            response, body = self.download(record, Range='bytes=20000-20999')
+            self.assertEqual((response.status_code, body), (206, content[20000:21000]))
+            response, body = self.download(record, Range='bytes=-100')
+            self.assertEqual(body, content[-100:])
+
+        # Front-server handoff has no file to hand off: the archive is streamed instead
+        with override_settings(FILE_DELIVERY='x-accel-redirect'):
+            response, body = self.download(self.report)
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertEqual(body, self.text)
+
+        link = SharedLink.objects.create(record=self.photo, token=str(uuid.uuid4()), expires_at=timezone.now() + timedelta(days=1))
+        response = self.client.get(f'/api/share/{link.token}/')
+        self.assertEqual(b''.join(response.streaming_content), self.scan)
+
+        preview = self.client.get(f'/api/records/{self.report.id}/preview/')
+        self.assertEqual(preview.data['original_url'], f'http://testserver/api/records/{self.report.id}/download/')
+
+        self.client.force_authenticate(User.objects.create_superuser(username="cadmin", password="x", phone_number="3"))
+        scrape = self.client.get('/api/metrics/').content.decode()
+        self.assertIn('storage_files{tier="archive"} 2', scrape)
+        self.assertIn(f'storage_bytes{{tier="archive"}} {len(self.text) + len(self.scan)}', scrape)
+        self.assertIn('archive_dead_bytes{} 0', scrape)
+
+    def test_recent_uploads_keep_content_hot_and_share_archived_entries(self):
+        again = self.create(self.text, "again.pdf")
+        self.assertIn('Archived 1 files', self.archive())
+        self.assertIsNone(Blob.objects.get(pk=self.report.blob_id).segment_id)
+
+        # Archived content uploaded once more shares the entry rather than writing a hot copy
+        copy = self.create(self.scan, "copy.pdf")
+        self.assertEqual(copy.blob_id, self.photo.blob_id)
+        self.assertFalse(os.path.exists(copy.prescription.path))
+        self.assertEqual(self.download(copy)[1], self.scan)
+        self.assertEqual(Blob.objects.get(pk=copy.blob_id).refcount, 2)
+        self.assertEqual(self.download(again)[1], self.text)
+
+    @override_settings(ARCHIVE_SEGMENT_MB=0)
+    def test_rehydrate_brings_files_back(self):
+        self.archive()
+        # With no room in a segment, each entry starts a new one
+        self.assertEqual(ArchiveSegment.objects.filter(sealed=True).count(), 2)
+        call_command('rebuild_usage', stdout=StringIO())
+        self.assertEqual(UsageLedger.objects.get(user=self.patient).bytes_used, len(self.text) + len(self.scan))
+
+        with self.assertRaises(CommandError):
+            call_command('rehydrate_records', stdout=StringIO())
+        out = StringIO()
+        call_command('rehydrate_records', record=[self.report.id], stdout=out)
+        self.assertIn('Rehydrated 1 files, 0 failed', out.getvalue())
+        blob = Blob.objects.get(pk=self.report.blob_id)
+        self.assertIsNone(blob.segment_id)
+        with open(self.report.prescription.path, 'rb') as f:
+            self.assertEqual(f.read(), self.text)
+        self.assertEqual(self.download(self.report)[1], self.text)
+        self.assertIsNotNone(Blob.objects.get(pk=self.photo.blob_id).segment_id)
+
+        from hospital import archive
+        self.assertIn(f'archive_dead_bytes{{}} {ArchiveSegment.objects.order_by("id").first().size}', archive.render_metrics())
+
+
+@skipUnless(connection.vendor in ('sqlite', 'mysql'), 'Query plan checks need SQLite or MySQL EXPLAIN output')
+class QueryPlanTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.package = Package.objects.create(name="Basic", price=10.00, max_uploads=100, max_storage_mb=100)
+        cls.doctors = [
+            User.objects.create_user(username=f"doc{i}", password="x", user_type="doctor", phone_number="1", package=cls.package)
+            for i in range(3)
+        ]
+        cls.patients = [
+            User.objects.create_user(username=f"pat{i}", password="x", user_type="patient", phone_number="1", package=cls.package)
+            for i in range(10)
+        ]
+        cls.doctors[0].patients.add(*cls.patients)
+        records = [
+            Record(patient=patient, doctor=doctor, prescription=f"prescriptions/p{patient.id}-d{doctor.id}-{n}.jpg",
+                   file_size=1000, is_deleted=n == 0)
+            for patient in cls.patients for doctor in cls.doctors for n in range(3)
+        ]
+        Record.objects.bulk_create(records)
+        now = timezone.now()
+        cls.record = Record.objects.filter(patient=cls.patients[0], doctor=cls.doctors[0], is_deleted=False).first()
+        cls.link = SharedLink.objects.create(record=cls.record, token=str(uuid.uuid4()), expires_at=now + timedelta(hours=1))
+        Reminder.objects.bulk_create([
+            Reminder(title=f"r{n}", date=now - timedelta(seconds=n), next_fire_at=now - timedelta(seconds=n),
+                     patient=cls.patients[n % 10], notified=n % 2 == 0)
+            for n in range(40)
+        ])
+
+    def assertIndexedQueries(self, run):
+        with CaptureQueriesContext(connection) as ctx:
+            run()
+        selects = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT') and ' WHERE ' in q['sql']]
+        self.assertTrue(selects, 'no filtered SELECTs were captured')
+        for sql in selects:
+            scans = full_table_scans(sql)
+            self.assertFalse(scans, f"Full table scan {scans} in:\n{sql}")
+
+    def test_patient_views(self):
+        patient = self.patients[0]
+        self.client.force_authenticate(patient)
+        self.assertIndexedQueries(lambda: self.client.get('/api/records/'))
+        self.assertIndexedQueries(lambda: self.client.get('/api/api/package-details/'))
+        self.assertIndexedQueries(lambda: self.client.get(f'/api/records/{self.record.id}/preview/'))
+        self.assertIndexedQueries(lambda: self.client.post(f'/api/records/{self.record.id}/share/', {'doctor_id': self.doctors[1].id}))
+
+    def test_doctor_views(self):
+        self.client.force_authenticate(self.doctors[0])
+        self.assertIndexedQueries(lambda: self.client.get('/api/records/'))
+        self.assertIndexedQueries(lambda: self.client.get('/api/patients/'))
+        self.assertIndexedQueries(lambda: self.client.get('/api/patients/all/'))
+        self.assertIndexedQueries(lambda: self.client.get('/api/doctors/'))
+        self.assertIndexedQueries(lambda: self.client.get(f'/api/patient/{self.patients[0].id}/records/'))
+        page = self.client.get('/api/records/?page_size=5').data
+        self.assertIndexedQueries(lambda: self.client.get(page['next']))
+
+    def test_shared_link_lookups(self):
+        self.assertIndexedQueries(lambda: self.client.get(f'/api/share/{self.link.token}/'))
+        self.assertIndexedQueries(lambda: list(SharedLink.objects.filter(expires_at__lt=timezone.now())))
+
+    def test_check_reminders(self):
+        self.assertIndexedQueries(lambda: call_command('check_reminders', stdout=StringIO()))
+
+    def test_reminder_calendar(self):
+        window = {'from': (timezone.now() - timedelta(days=1)).isoformat(), 'to': timezone.now().isoformat()}
+        for user in (self.patients[0], self.doctors[0]):
+            self.client.force_authenticate(user)
+            self.assertIndexedQueries(lambda: self.client.get('/api/reminders/', window))
+
+
+class PaginationTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.package = Package.objects.create(name="Basic", price=10.00)
+        cls.doctor = User.objects.create_user(username="drbob", password="x", user_type="doctor", phone_number="1", package=cls.package)
+        cls.patient = User.objects.create_user(username="john", password="x", user_type="patient", phone_number="1", package=cls.package)
+        Record.objects.bulk_create([
+            Record(patient=cls.patient, doctor=cls.doctor, prescription=f"prescriptions/{n}.jpg") for n in range(7)
+        ])
+        # Force ties on upload_date so the id tiebreaker is exercised
+        same_instant = timezone.now()
+        Record.objects.filter(id__in=Record.objects.order_by('id').values_list('id', flat=True)[:4]).update(upload_date=same_instant)
+
+    def setUp(self):
+        self.client.force_authenticate(self.doctor)
+
+    def test_unpaginated_by_default(self):
+        response = self.client.get('/api/records/')
+        self.assertIsInstance(response.data, list)
+        self.assertEqual(len(response.data), 7)
+
+    def test_cursor_walks_every_record_once(self):
+        expected = list(Record.objects.order_by('-upload_date', '-id').values_list('id', flat=True))
+        seen, url = [], '/api/records/?page_size=3'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 3)
+            seen += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(seen, expected)
+
+    @override_settings(API_UNPAGINATED_LISTS=False, API_PAGE_SIZE=2, API_MAX_PAGE_SIZE=4)
+    def test_page_size_default_and_cap(self):
+        self.assertEqual(len(self.client.get('/api/doctors/').data['results']), 1)
+        self.assertEqual(len(self.client.get('/api/records/').data['results']), 2)
+        self.assertEqual(len(self.client.get('/api/records/?page_size=100').data['results']), 4)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/records/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+
+    def test_record_lists_do_not_query_per_row(self):
+        with self.assertNumQueries(1):
+            self.client.get('/api/records/')
+        with self.assertNumQueries(1):
+            self.client.get('/api/records/?page_size=3')
+        record = Record.objects.first()
+        with self.assertNumQueries(1):
+            self.client.get(f'/api/records/{record.id}/')
+        with self.assertNumQueries(1):
+            self.client.get(f'/api/records/{record.id}/preview/')
+
+
+class UserPasswordTests(APITestCase):
+    def setUp(self):
+        self.package = Package.objects.create(name="Basic", price=10.00)
+        self.doctor = User.objects.create_user(username="drbob", password="x", user_type="doctor", phone_number="1", package=self.package)
+        self.admin = User.objects.create_superuser(username="root", password="x", user_type="doctor", phone_number="1")
+
+    def test_passwords_are_hashed_once_where_they_come_in(self):
+        self.client.force_authenticate(self.doctor)
+        response = self.client.post('/api/patients/create/', {
+            'username': 'walkin', 'email': 'walkin@example.com', 'password': 'Walk-In-2025', 'phone_number': '1'})
+        self.assertEqual(response.status_code, 201)
+        patient = User.objects.get(username='walkin')
+        self.assertTrue(patient.check_password('Walk-In-2025'))
+
+        self.client.force_authenticate(self.admin)
+        self.assertEqual(self.client.put(f'/api/users/{patient.id}/', {'password': 'Changed-2025'}).status_code, 200)
+        patient.refresh_from_db()
+        self.assertTrue(patient.check_password('Changed-2025'))
+
+    def test_saving_keeps_unusable_and_other_hashers_passwords(self):
+        self.doctor.set_unusable_password()
+        self.doctor.save()
+        self.doctor.refresh_from_db()
+        self.assertFalse(self.doctor.has_usable_password())
+
+        hashed = make_password('x', hasher='pbkdf2_sha1')
+        self.doctor.password = hashed
+        self.doctor.save()
+        self.doctor.refresh_from_db()
+        self.assertEqual(self.doctor.password, hashed)
+
+
+class FastPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    # The regular hasher minus the deliberate slowness, so the budgets
+    # measure our code rather than hashing.
+    iterations = 1
+
+
+def normalize_sql(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    return re.sub(r'\((?:\?, )+\?\)', '(?, ...)', sql)
+
+
+def sql_budget_diff(queries, budget):
+    """
+    Render executed SQL against a query budget: statements within the budget
+    are prefixed with a space, the ones over it with '+', and every distinct
+    statement shape is listed with its repeat count to make N+1 loops obvious.
+    """
+    lines = [f'--- budget: {budget} queries', f'+++ executed: {len(queries)} queries']
+    for i, query in enumerate(queries):
+        lines.append(f"{' ' if i < budget else '+'} {query['sql']}")
+    repeats = Counter(normalize_sql(query['sql']) for query in queries)
+    lines.append('@@ statement shapes @@')
+    lines += [f'  {count:>4} x {shape}' for shape, count in repeats.most_common()]
+    return '\n'.join(lines)
+
+
+# route name -> (max queries, max wall-clock ms). Requests are made with
+# force_authenticate, so auth lookups are not part of the budget. Slow CI
+# machines can scale the time budgets with ENDPOINT_BUDGET_TIME_FACTOR.
+ENDPOINT_BUDGET_TIME_FACTOR = float(os.environ.get('ENDPOINT_BUDGET_TIME_FACTOR', '1'))
+ENDPOINT_BUDGETS = {
+    'api_register': (4, 250),
+    'login': (9, 150),
+    'logout': (0, 50),
+    'get_csrf_token': (4, 50),
+    'users_list_create': (1, 100),
+    'user_update_delete': (12, 100),
+    'user_info': (0, 50),
+    'profile': (0, 50),
+    'update_profile': (1, 50),
+    'manage_packages': (1, 50),
+    'update_delete_package': (2, 50),
+    'list_doctors': (1, 100),
+    'list_patients': (1, 100),
+    'list_all_patients': (1, 100),
+    'create_patient': (3, 100),
+    'update_patient': (2, 50),
+    'delete_patient': (2, 50),
+    'assign_patient': (2, 50),
+    'remove_patient': (2, 50),
+    'patient_records': (2, 100),
+    'list_records': (1, 100),
+    'upload_record': (16, 200),
+    'share_record': (10, 100),
+    'delete_record': (7, 100),
+    'generate_share_link': (4, 50),
+    'download_record': (1, 100),
+    'view_shared_record': (2, 100),
+    'upload_session_create': (5, 100),
+    'upload_session': (2, 100),
+    'upload_session_finalize': (19, 200),
+    'reminders_list_create': (2, 100),
+    'reminder_occurrences': (1, 100),
+    'reminder_stream': (0, 50),
+    'token_refresh': (1, 50),
+    'record-list': (1, 100),
+    'record-detail': (1, 50),
+    'record-preview': (1, 50),
+    'api-root': (1, 100),
+    'get_package_details': (2, 50),
+    # Outbox depth, then blobs by tier and archive segments (hospital/archive.py)
+    'metrics': (3, 50),
+    'profile_report': (0, 50),
+}
+
+
+@override_settings(PASSWORD_HASHERS=['hospital.tests.FastPBKDF2PasswordHasher'])
+class EndpointBudgetTests(APITestCase):
+    """Every route in hospital/urls.py against a realistic dataset, with a query and latency budget each."""
+    DOCTORS = 40
+    PATIENTS = 3000
+    RECORDS_PER_PATIENT = 3
+    PAGE = '?page_size=50'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.media_root = tempfile.mkdtemp()
+        password = make_password('Budget-Pass-2025')
+        cls.packages = Package.objects.bulk_create([
+            Package(name=name, price=price, max_uploads=1000, max_storage_mb=1000, max_shares=50)
+            for name, price in (('Basic', 10), ('Plus', 20), ('Pro', 50))
+        ])
+        User.objects.bulk_create(
+            [User(username=f'doctor{i}', email=f'doctor{i}@example.com', password=password, user_type='doctor',
+                  phone_number='1234567890', package=cls.packages[i % 3]) for i in range(cls.DOCTORS)]
+            + [User(username=f'patient{i}', email=f'patient{i}@example.com', password=password, user_type='patient',
+                    phone_number='9876543210', package=cls.packages[i % 3]) for i in range(cls.PATIENTS)],
+            batch_size=500,
+        )
+        cls.admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='Budget-Pass-2025')
+        doctors = list(User.objects.filter(user_type='doctor').order_by('id'))
+        patients = list(User.objects.filter(user_type='patient').order_by('id'))
+        cls.doctor, cls.patient = doctors[0], patients[0]
+
+        Through = User.patients.through
+        Through.objects.bulk_create([
+            Through(from_user_id=doctors[i % cls.DOCTORS].id, to_user_id=patient.id) for i, patient in enumerate(patients)
+        ], batch_size=1000)
+        Record.objects.bulk_create([
+            Record(patient=patient, doctor=doctors[(i + n) % cls.DOCTORS], prescription=f'prescriptions/seed-{patient.id}-{n}.jpg',
+                   file_size=2048, description=f'Scan {n}')
+            for i, patient in enumerate(patients) for n in range(cls.RECORDS_PER_PATIENT)
+        ], batch_size=1000)
+        records = list(Record.objects.order_by('id')[:500])
+        SharedWith = Record.shared_with.through
+        SharedWith.objects.bulk_create([
+            SharedWith(record_id=record.id, user_id=doctors[(i + 7) % cls.DOCTORS].id) for i, record in enumerate(records)
+        ], batch_size=1000)
+        now = timezone.now()
+        SharedLink.objects.bulk_create([
+            SharedLink(record=record, token=str(uuid.uuid4()), expires_at=now + timedelta(hours=1 - i % 2 * 48))
+            for i, record in enumerate(records[1:])
+        ], batch_size=1000)
+        Reminder.objects.bulk_create([
+            Reminder(title=f'Dose {i}', date=now + timedelta(minutes=i - 1000), next_fire_at=now + timedelta(minutes=i - 1000),
+                     patient=patients[i % cls.PATIENTS], notified=i < 1000)
+            for i in range(5000)
+        ], batch_size=1000)
+
+        Reminder.objects.create(title='Three times daily', date=now - timedelta(days=30), patient=patients[0],
+                                freq='daily', byhour='8,14,20', until=now + timedelta(days=60))
+
+        # A real file for the endpoints that stream one back
+        cls.own_record = records[0]
+        os.makedirs(os.path.join(cls.media_root, 'prescriptions'), exist_ok=True)
+        with open(os.path.join(cls.media_root, cls.own_record.prescription.name), 'wb') as f:
+            f.write(b'\xff\xd8\xff' + b'0' * 2045)
+        cls.link = SharedLink.objects.create(record=cls.own_record, token=str(uuid.uuid4()), expires_at=now + timedelta(hours=1))
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root,
+                                                   UPLOAD_SESSION_DIR=os.path.join(self.media_root, 'upload_sessions'))
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def scenarios(self):
+        """(route name, method, path, user, payload, expected status), reads before writes."""
+        other_patient = User.objects.filter(user_type='patient').exclude(assigned_doctors=self.doctor).first()
+        spare_package = Package.objects.create(name='Spare', price=1)
+        victim = User.objects.create_user(username='victim', password='x', user_type='patient', phone_number='1')
+        refresh = str(RefreshToken.for_user(self.patient))
+        upload = SimpleUploadedFile('budget-upload.jpg', b'\xff\xd8\xff' + b'1' * 4096, content_type='image/jpeg')
+        scan = b'%PDF-' + b'2' * 8192
+        session = UploadSession.objects.create(owner=self.patient, patient=self.patient, doctor=self.doctor, file_name='scan.pdf',
+                                               size=len(scan), chunk_size=4096, expires_at=timezone.now() + timedelta(hours=1))
+        return [
+            ('get_csrf_token', 'get', '/api/csrf/', None, None, 200),
+            ('api-root', 'get', '/api/', self.doctor, None, 200),
+            ('login', 'post', '/api/login/', None, {'username': self.patient.username, 'password': 'Budget-Pass-2025'}, 200),
+            ('token_refresh', 'post', '/api/api/token/refresh/', None, {'refresh': refresh}, 200),
+            ('user_info', 'get', '/api/me/', self.patient, None, 200),
+            ('profile', 'get', '/api/profile/', self.patient, None, 200),
+            ('get_package_details', 'get', '/api/api/package-details/', self.patient, None, 200),
+            ('manage_packages', 'get', '/api/packages/' + self.PAGE, None, None, 200),
+            ('list_doctors', 'get', '/api/doctors/' + self.PAGE, None, None, 200),
+            ('list_patients', 'get', '/api/patients/' + self.PAGE, self.doctor, None, 200),
+            ('list_all_patients', 'get', '/api/patients/all/' + self.PAGE, self.doctor, None, 200),
+            ('users_list_create', 'get', '/api/users/' + self.PAGE, self.admin, None, 200),
+            ('user_update_delete', 'get', f'/api/users/{self.patient.id}/', self.admin, None, 200),
+            ('patient_records', 'get', f'/api/patient/{self.patient.id}/records/' + self.PAGE, self.doctor, None, 200),
+            ('list_records', 'get', '/api/records/' + self.PAGE, self.doctor, None, 200),
+            ('record-list', 'get', '/api/records/' + self.PAGE, self.patient, None, 200),
+            ('record-detail', 'get', f'/api/records/{self.own_record.id}/', self.patient, None, 200),
+            ('record-preview', 'get', f'/api/records/{self.own_record.id}/preview/', self.patient, None, 200),
+            ('download_record', 'get', f'/api/records/{self.own_record.id}/download/', self.patient, None, 200),
+            ('view_shared_record', 'get', f'/api/share/{self.link.token}/', None, None, 200),
+            ('reminder_occurrences', 'get', '/api/reminders/occurrences/', self.patient, {
+                'from': timezone.now().isoformat(), 'to': (timezone.now() + timedelta(days=31)).isoformat()}, 200),
+            ('reminders_list_create', 'get', '/api/reminders/', self.patient, {
+                'from': (timezone.now() - timedelta(days=30)).isoformat(), 'to': timezone.now().isoformat(), 'page_size': 50}, 200),
+            ('reminder_stream', 'get', '/api/reminders/stream/', None, None, 401),
+            ('metrics', 'get', '/api/metrics/', self.admin, None, 200),
+            ('profile_report', 'get', f'/api/profiles/{uuid.UUID(int=0).hex}/', self.admin, None, 404),
+            ('upload_session', 'get', f'/api/uploads/{session.id}/', self.patient, None, 200),
+            ('upload_session_create', 'post', '/api/uploads/', self.patient, {
+                'file_name': 'scan.pdf', 'size': 3 * 1024 * 1024, 'patient': self.patient.id, 'doctor': self.doctor.id}, 201),
+            ('upload_session', 'put', f'/api/uploads/{session.id}/?offset=0', self.patient, scan[:4096], 200),
+            ('upload_session', 'put', f'/api/uploads/{session.id}/?offset=4096', self.patient, scan[4096:8192], 200),
+            ('upload_session', 'put', f'/api/uploads/{session.id}/?offset=8192', self.patient, scan[8192:], 200),
+            ('upload_session_finalize', 'post', f'/api/uploads/{session.id}/finalize/', self.patient, None, 201),
+            ('upload_session', 'delete', f'/api/uploads/{session.id}/', self.patient, None, 204),
+            ('api_register', 'post', '/api/register/', None, {
+                'username': 'newpatient', 'email': 'new@example.com', 'password': 'Budget-Pass-2025',
+                'user_type': 'patient', 'phone_number': '5555555555', 'package': self.packages[0].id}, 201),
+            ('update_profile', 'put', '/api/profile/update/', self.patient, {'email': 'changed@example.com'}, 200),
+            ('update_delete_package', 'put', f'/api/packages/{spare_package.id}/', self.admin, {'price': '2.00'}, 200),
+            ('create_patient', 'post', '/api/patients/create/', self.doctor, {
+                'username': 'walkin', 'email': 'walkin@example.com', 'password': 'Budget-Pass-2025', 'phone_number': '1'}, 201),
+            ('assign_patient', 'post', f'/api/patients/{other_patient.id}/assign/', self.doctor, None, 200),
+            ('update_patient', 'put', f'/api/patients/{other_patient.id}/update/', self.doctor, {'phone_number': '2'}, 200),
+            ('remove_patient', 'post', f'/api/patients/{other_patient.id}/remove/', self.doctor, None, 200),
+            ('delete_patient', 'delete', f'/api/patients/{self.patient.id}/delete/', self.doctor, None, 200),
+            ('reminders_list_create', 'post', '/api/reminders/', self.patient, {
+                'title': 'Follow-up', 'date': (timezone.now() + timedelta(days=1)).isoformat(), 'patient': self.patient.id}, 201),
+            ('upload_record', 'post', '/api/records/upload/', self.patient, {
+                'patient': self.patient.id, 'doctor': self.doctor.id, 'prescription': upload}, 201),
+            ('share_record', 'post', f'/api/records/{self.own_record.id}/share/', self.patient, {'doctor_id': self.doctor.id}, 200),
+            ('generate_share_link', 'post', f'/api/records/{self.own_record.id}/generate-link/', self.patient, None, 201),
+            ('delete_record', 'post', f'/api/records/{self.own_record.id}/delete/', self.patient, None, 200),
+            ('logout', 'post', '/api/logout/', self.patient, {'refresh': refresh}, 400),
+            ('user_update_delete', 'delete', f'/api/users/{victim.id}/', self.admin, None, 204),
+        ]
+
+    def test_every_route_has_a_budget(self):
+        def names(patterns):
+            for pattern in patterns:
+                if isinstance(pattern, URLResolver):
+                    yield from names(pattern.url_patterns)
+                elif pattern.name:
+                    yield pattern.name
+        routes = set(names(hospital_urls.urlpatterns))
+        self.assertEqual(sorted(routes - set(ENDPOINT_BUDGETS)), [], 'routes without a budget')
+        covered = {scenario[0] for scenario in self.scenarios()}
+        self.assertEqual(sorted(routes - covered), [], 'routes the budget suite does not exercise')
+
+    def test_endpoint_budgets(self):
+        failures = []
+        for name, method, path, user, payload, expected_status in self.scenarios():
+            cache.clear()
+            self.client.force_authenticate(user)
+            fmt = 'multipart' if name == 'upload_record' else 'json'
+            with CaptureQueriesContext(connection) as ctx:
+                started = time.perf_counter()
+                if isinstance(payload, bytes):
+                    response = getattr(self.client, method)(path, payload, content_type='application/offset+octet-stream')
+                else:
+                    response = getattr(self.client, method)(path, payload, format=fmt)
+                if getattr(response, 'streaming', False):
+                    b''.join(response.streaming_content)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+            self.assertEqual(response.status_code, expected_status, f'{method.upper()} {path}: {getattr(response, "data", "")}')
+            max_queries, max_ms = ENDPOINT_BUDGETS[name]
+            max_ms *= ENDPOINT_BUDGET_TIME_FACTOR
+            if len(ctx.captured_queries) > max_queries:
+                failures.append(f'{method.upper()} {path} [{name}] ran {len(ctx.captured_queries)} queries '
+                                f'(budget {max_queries})\n' + sql_budget_diff(ctx.captured_queries, max_queries))
+            if elapsed_ms > max_ms:
+                failures.append(f'{method.upper()} {path} [{name}] took {elapsed_ms:.0f}ms (budget {max_ms:.0f}ms)')
+        self.client.force_authenticate(None)
+        if failures:
+            self.fail('Endpoint budgets exceeded:\n\n' + '\n\n'.join(failures))
+
+
+class SeedHospitalCommandTests(MediaRootMixin, TestCase):
+    def seed(self, prefix, *extra):
+        call_command('seed_hospital', '--prefix', prefix, '--seed', '7', '--doctors', '3', '--patients', '12',
+                     '--batch-size', '5', '--anchor', '2025-01-01T00:00:00+00:00', *extra, stdout=StringIO())
+        records = Record.objects.filter(patient__username__startswith=f'{prefix}-').order_by('id')
+        return [(r.description, r.file_size, r.prescription.name.rsplit('/', 1)[1]) for r in records]
+
+    def test_seed_is_deterministic_and_writes_files(self):
+        first = self.seed('a')
+        self.assertTrue(first)
+        self.assertEqual(first, self.seed('b', '--workers', '2'))
+        for record in Record.objects.filter(patient__username__startswith='a-'):
+            self.assertEqual(os.path.getsize(record.prescription.path), record.file_size)
+        ledger = UsageLedger.objects.filter(user__username__startswith='a-').order_by('user_id').first()
+        live = Record.objects.filter(patient_id=ledger.user_id)
+        self.assertEqual(ledger.upload_count, live.count())
+        self.assertEqual(ledger.bytes_used, sum(live.values_list('file_size', flat=True)))
+
+
+@override_settings(PASSWORD_HASHERS=['hospital.tests.FastPBKDF2PasswordHasher'])
+class BenchmarkTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        from benchmarks.runner import Bench
+        super().setUp()
+        self.bench = Bench(prefix='bench', seed=3)
+        self.assertTrue(self.bench.prepare(doctors=3, patients=16))
+
+    def test_every_scenario_runs_cleanly(self):
+        from benchmarks.runner import run
+        from benchmarks.scenarios import SCENARIOS
+        records_before = Record.objects.count()
+        report = run(self.bench, list(SCENARIOS), requests=6, warmup=1)
+        self.assertEqual(set(report['scenarios']), set(SCENARIOS))
+        for name, result in report['scenarios'].items():
+            self.assertEqual(result['requests'], 6, name)
+            self.assertEqual(result['errors'], 0, (name, result['status_codes']))
+            self.assertGreater(result['queries_per_request']['mean'], 0, name)
+            self.assertLessEqual(result['latency_ms']['p50'], result['latency_ms']['p99'], name)
+            self.assertTrue(result['peak_rss_mb'], name)
+        # Dispatch only fills the outbox; nothing is sent
+        self.assertEqual(len(mail.outbox), 0)
+        # Uploads, due reminders and their emails are cleaned up after their scenario
+        self.assertEqual(Record.objects.count(), records_before)
+        self.assertFalse(Reminder.objects.filter(title='benchmark reminder').exists())
+        self.assertFalse(OutboundEmail.objects.filter(body__contains='benchmark reminder').exists())
+        # Slow async downloads outnumber the threads, so none of them holds one while it waits
+        burst = report['scenarios']['asgi_download_burst']
+        self.assertEqual(burst['peak_in_flight'], burst['burst'])
+        self.assertGreater(burst['peak_in_flight'], min(32, (os.cpu_count() or 1) + 4))
+
+    def test_compare_flags_regressions_beyond_tolerance(self):
+        from benchmarks.report import compare
+        baseline = {'scenarios': {'doctor_dashboard': {
+            'errors': 0, 'latency_ms': {'p50': 10, 'p95': 20, 'p99': 30},
+            'throughput_rps': 100, 'queries_per_request': {'mean': 3}, 'peak_rss_mb': 80,
+        }}}
+        current = {'scenarios': {'doctor_dashboard': {
+            'errors': 2, 'latency_ms': {'p50': 10.5, 'p95': 30, 'p99': 20},
+            'throughput_rps': 80, 'queries_per_request': {'mean': 3}, 'peak_rss_mb': 80,
+        }}}
+        verdicts = {row['metric']: row['verdict'] for row in compare(current, baseline, tolerance=0.1)}
+        self.assertEqual(verdicts, {
+            'latency_ms.p50': 'unchanged', 'latency_ms.p95': 'regressed', 'latency_ms.p99': 'improved',
+            'throughput_rps': 'regressed', 'queries_per_request.mean': 'unchanged', 'peak_rss_mb': 'unchanged',
+            'errors': 'regressed',
+        })
+
+
+class MetricsTests(MediaRootMixin, APITestCase):
+    def setUp(self):
+        from hospital.metrics import registry
+        cache.clear()
+        self.registry = registry
+        registry.reset()
+        super().setUp()
+        self.doctor = User.objects.create_user(username='mdoc', password='x', user_type='doctor', phone_number='1')
+        self.patient = User.objects.create_user(username='mpat', password='x', user_type='patient', phone_number='2')
+        self.admin = User.objects.create_superuser(username='madmin', email='madmin@example.com', password='x')
+        os.makedirs(os.path.join(self.media_root, 'prescriptions'))
+        with open(os.path.join(self.media_root, 'prescriptions', 'm.jpg'), 'wb') as f:
+            f.write(b'\xff\xd8\xff' + b'0' * 997)
+        self.record = Record.objects.create(patient=self.patient, doctor=self.doctor, prescription='prescriptions/m.jpg')
+
+    def scrape(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        samples = {}
+        for line in response.content.decode().splitlines():
+            if line and not line.startswith('#'):
+                series, value = line.rsplit(' ', 1)
+                samples[re.sub(r',pid="\d+"', '', series)] = float(value)
+        return samples
+
+    def test_records_route_latency_sql_size_and_file_bytes(self):
+        self.client.force_authenticate(self.patient)
+        self.assertEqual(self.client.get('/api/records/?page_size=10').status_code, 200)
+        download = self.client.get(f'/api/records/{self.record.id}/download/')
+        self.assertEqual(b''.join(download.streaming_content)[:3], b'\xff\xd8\xff')
+        self.client.get('/api/no-such-route/')
+
+        samples = self.scrape()
+        self.assertEqual(samples['http_requests_total{route="list_records",method="GET",status="200"}'], 1)
+        self.assertEqual(samples['http_requests_total{route="unmatched",method="GET",status="404"}'], 1)
+        self.assertEqual(samples['http_request_duration_seconds_count{route="list_records",method="GET"}'], 1)
+        self.assertEqual(samples['http_request_duration_seconds_bucket{route="list_records",method="GET",le="+Inf"}'], 1)
+        # Authentication is forced, so the list is one query
+        self.assertEqual(samples['http_request_db_queries_sum{route="list_records"}'], 1)
+        self.assertGreater(samples['http_request_db_seconds_total{route="list_records"}'], 0)
+        self.assertEqual(samples['file_bytes_streamed_total{route="download_record"}'], 1000)
+        self.assertNotIn('file_bytes_streamed_total{route="list_records"}', samples)
+        self.assertGreater(samples['http_response_size_bytes_sum{route="list_records"}'], 0)
+
+    def test_endpoint_is_staff_only(self):
+        self.client.force_authenticate(self.doctor)
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        self.client.force_authenticate(None)
+        self.assertIn(self.client.get('/api/metrics/').status_code, (401, 403))
+
+
+class ProfilingTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.profile_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(PROFILE_DIR=self.profile_dir)
+        self.settings_override.enable()
+        self.doctor = User.objects.create_user(username='pdoc', password='x', user_type='doctor', phone_number='1')
+        self.patient = User.objects.create_user(username='ppat', password='x', user_type='patient', phone_number='2')
+        self.admin = User.objects.create_superuser(username='padmin', email='padmin@example.com', password='x')
+        self.doctor.patients.add(self.patient)
+        self.path = f'/api/patient/{self.patient.id}/records/'
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+    def as_user(self, user):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+
+    def test_staff_request_is_profiled_and_retrievable(self):
+        import pstats
+        self.as_user(self.admin)
+        response = self.client.get('/api/users/', HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        profile_id = response['X-Profile-Id']
+
+        report = self.client.get(f'/api/profiles/{profile_id}/')
+        self.assertEqual(report.status_code, 200)
+        self.assertEqual(report.data['path'], '/api/users/')
+        self.assertEqual(report.data['user'], 'padmin')
+        self.assertEqual(report.data['query_count'], len(report.data['queries']))
+        self.assertTrue(any('hospital_user' in query['sql'] for query in report.data['queries']))
+        self.assertFalse(any('params' in query for query in report.data['queries']))
+        self.assertIn('cumulative', report.data['stats'])
+
+        raw = self.client.get(f'/api/profiles/{profile_id}/?download=prof')
+        path = os.path.join(self.profile_dir, 'raw.prof')
+        with open(path, 'wb') as f:
+            f.write(b''.join(raw.streaming_content))
+        self.assertGreater(pstats.Stats(path).total_calls, 0)
+
+    def test_inline_mode_returns_the_report_as_an_attachment(self):
+        self.as_user(self.admin)
+        response = self.client.get(self.path + '?__profile=inline')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertEqual(response.json()['status'], 403)  # admin is not a doctor
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_non_staff_cannot_profile_or_read_profiles(self):
+        self.as_user(self.doctor)
+        response = self.client.get(self.path, HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+        self.assertEqual(self.client.get(f'/api/profiles/{uuid.uuid4().hex}/').status_code, 403)
+        self.client.credentials()
+        self.assertNotIn('X-Profile-Id', self.client.get('/api/csrf/?__profile=1'))
+
+
+class CountingEmailBackend(LocmemEmailBackend):
+    """locmem backend that counts connections and can refuse chosen recipients."""
+    opened = 0
+    refuse = set()
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return super().open()
+
+    def send_messages(self, messages):
+        for message in messages:
+            if set(message.to) & self.refuse:
+                raise ConnectionError('refused')
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='hospital.tests.CountingEmailBackend', REMINDER_LOOKBACK_MINUTES=24 * 60, OUTBOX_WORKERS=1)
+class ReminderDispatchTests(TestCase):
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+        CountingEmailBackend.refuse = set()
+        self.allowed = Package.objects.create(name='Remind', price=1, can_set_reminders=True)
+        self.denied = Package.objects.create(name='Quiet', price=1, can_set_reminders=False)
+        self.patients = [User.objects.create_user(username=f'rp{i}', email=f'rp{i}@example.com', password='x',
+                                                  user_type='patient', phone_number='1', package=self.allowed) for i in range(5)]
+        self.quiet = User.objects.create_user(username='rq', email='rq@example.com', password='x', user_type='patient',
+                                              phone_number='1', package=self.denied)
+        self.now = timezone.now()
+
+    def remind(self, patient, minutes_ago):
+        return Reminder.objects.create(title=f'Dose for {patient.username}', date=self.now - timedelta(minutes=minutes_ago), patient=patient)
+
+    def test_catches_up_within_lookback_over_one_connection(self):
+        late = [self.remind(patient, 180) for patient in self.patients]  # missed while nothing ran
+        on_time = self.remind(self.patients[0], 0)
+        too_old = self.remind(self.patients[1], 25 * 60)
+        future = self.remind(self.patients[2], -10)
+        call_command('check_reminders', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(set(Reminder.objects.filter(notified=True)), set(late + [on_time]))
+        self.assertFalse(Reminder.objects.filter(id__in=[too_old.id, future.id], notified=True).exists())
+        self.assertEqual(mail.outbox[0].subject, f'[Pixeltre Medical] Reminder: {late[0].title}')
+
+    def test_query_count_does_not_grow_with_batch(self):
+        from hospital import reminders
+        for i in range(40):
+            self.remind(self.patients[i % 5], i)
+        with CaptureQueriesContext(connection) as ctx:
+            totals = reminders.dispatch_due(now=self.now, batch_size=100)
+        self.assertEqual(totals, {'queued': 40, 'skipped': 0})
+        statements = [q['sql'].split()[0] for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]
+        # One claim (with users and packages joined in), one outbox and one event insert, one bulk update
+        self.assertEqual(statements, ['SELECT', 'INSERT', 'INSERT', 'UPDATE'])
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboundEmail.objects.filter(kind='reminder', status=OutboundEmail.PENDING).count(), 40)
+
+    def test_unsendable_reminders_are_closed_and_failures_retried(self):
+        from hospital import outbox, reminders
+        skipped = self.remind(self.quiet, 5)
+        failing = self.remind(self.patients[3], 5)
+        sent = self.remind(self.patients[4], 5)
+        CountingEmailBackend.refuse = {'rp3@example.com'}
+        self.assertEqual(reminders.dispatch_due(now=self.now, batch_size=2), {'queued': 2, 'skipped': 1})
+        self.assertEqual(set(Reminder.objects.filter(notified=True)), {skipped, failing, sent})
+        totals = outbox.drain()
+        self.assertEqual((totals['sent'], totals['failed'], totals['dead']), (1, 1, 0))
+        self.assertEqual([m.to for m in mail.outbox], [['rp4@example.com']])
+
+        # The failed message waits out its backoff, then goes through
+        CountingEmailBackend.refuse = set()
+        self.assertEqual(outbox.drain()['sent'], 0)
+        self.assertEqual(outbox.drain(now=timezone.now() + timedelta(minutes=5))['sent'], 1)
+        self.assertEqual(mail.outbox[-1].to, ['rp3@example.com'])
+
+    def test_enqueue_only_leaves_sending_to_the_outbox_worker(self):
+        self.remind(self.patients[0], 1)
+        call_command('check_reminders', '--enqueue-only', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 0)
+        call_command('send_outbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_a_failed_send_reconnects_once_for_the_rest(self):
+        from hospital import outbox
+        rows = [outbox.build(f'rp{i}@example.com', 'Dose', 'Take it.') for i in (3, 0, 1)]
+        for message_id, row in enumerate(rows, 1):
+            row.id = message_id
+        CountingEmailBackend.refuse = {'rp3@example.com'}
+        results = outbox.send_chunk(rows)
+        self.assertEqual([error is None for _, error, _ in results], [False, True, True])
+        self.assertEqual(CountingEmailBackend.opened, 2)
+        self.assertEqual([m.to for m in mail.outbox], [['rp0@example.com'], ['rp1@example.com']])
+
+    @skipUnless(connection.features.has_select_for_update_skip_locked, 'backend has no SKIP LOCKED')
+    def test_claim_skips_rows_locked_by_other_workers(self):
+        from hospital import reminders
+        self.remind(self.patients[0], 1)
+        with CaptureQueriesContext(connection) as ctx:
+            reminders.dispatch_due(now=self.now)
+        self.assertTrue(any('SKIP LOCKED' in q['sql'] for q in ctx.captured_queries))
+
+    def test_daemon_sleeps_until_next_due_reminder(self):
+        from hospital import reminders
+        self.assertEqual(reminders.seconds_until_next(self.now, 60), 60)
+        self.remind(self.patients[0], -0.5)
+        self.assertAlmostEqual(reminders.seconds_until_next(self.now, 60), 30, delta=0.01)
+        self.remind(self.patients[0], -600)
+        self.assertAlmostEqual(reminders.seconds_until_next(self.now, 60), 30, delta=0.01)
+
+
+@override_settings(EMAIL_BACKEND='hospital.tests.CountingEmailBackend', REMINDER_LOOKBACK_MINUTES=24 * 60, OUTBOX_WORKERS=1)
+class RecurringReminderTests(APITestCase):
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+        CountingEmailBackend.refuse = set()
+        self.package = Package.objects.create(name='Remind', price=1, can_set_reminders=True)
+        self.patient = User.objects.create_user(username='rr', email='rr@example.com', password='x', user_type='patient',
+                                                phone_number='1', package=self.package)
+        self.other = User.objects.create_user(username='ro', email='ro@example.com', password='x', user_type='patient',
+                                              phone_number='1', package=self.package)
+        self.start = datetime(2026, 1, 5, 7, 0, tzinfo=dt_timezone.utc)  # a Monday
+
+    def series(self, **rule):
+        rule.setdefault('date', self.start)
+        return Reminder.objects.create(title='Metformin', patient=self.patient, **rule)
+
+    def test_moving_an_unfired_reminder_moves_its_next_occurrence(self):
+        reminder = self.series(date=self.start + timedelta(days=1))
+        reminder = Reminder.objects.get(pk=reminder.pk)
+        reminder.date = self.start + timedelta(days=10)
+        reminder.save()
+        reminder.refresh_from_db()
+        self.assertEqual(reminder.next_fire_at, self.start + timedelta(days=10))
+
+        reminder.title = 'Renamed'
+        reminder.fired_count = 1
+        reminder.next_fire_at = self.start + timedelta(days=11)
+        reminder.save()
+        self.assertEqual(Reminder.objects.get(pk=reminder.pk).next_fire_at, self.start + timedelta(days=11))
+
+    def test_expands_by_hour_and_by_day(self):
+        from hospital import recurrence
+        daily = self.series(freq='daily', byhour='8,14,20')
+        self.assertEqual(daily.next_fire_at, self.start.replace(hour=8))
+        window = recurrence.occurrences(daily, self.start, self.start + timedelta(days=2))
+        self.assertEqual([at.hour for at in window], [8, 14, 20, 8, 14, 20])
+
+        weekly = self.series(freq='weekly', interval=2, byday='MO,WE', count=5)
+        self.assertEqual([at.day for at in recurrence.occurrences(weekly, self.start, self.start + timedelta(days=90))],
+                         [5, 7, 19, 21, 2])
+        until = self.series(freq='hourly', interval=6, until=self.start + timedelta(hours=18))
+        self.assertEqual(len(list(recurrence.iter_occurrences(until))), 4)
+
+    def test_next_occurrence_jumps_without_walking_the_series(self):
+        from hospital import recurrence
+        reminder = self.series(freq='hourly', date=self.start - timedelta(days=3650))
+        after = self.start + timedelta(minutes=30)
+        self.assertEqual(recurrence.next_occurrence(reminder, after), self.start + timedelta(hours=1))
+        once = self.series()
+        self.assertIsNone(recurrence.next_occurrence(once, self.start))
+
+    @override_settings(TIME_ZONE='Europe/London')
+    def test_wall_clock_is_kept_across_dst(self):
+        from hospital import recurrence
+        reminder = self.series(freq='daily', date=datetime(2026, 3, 27, 8, 0, tzinfo=dt_timezone.utc))
+        local = [timezone.localtime(at) for at in recurrence.occurrences(
+            reminder, reminder.date, reminder.date + timedelta(days=4))]
+        self.assertEqual([at.hour for at in local], [8] * 5)
+        self.assertEqual(local[-1].utcoffset(), timedelta(hours=1))
+
+    def test_dispatcher_advances_one_row_per_series(self):
+        from hospital import reminders
+        reminder = self.series(freq='daily', byhour='8,20', count=3)
+        now = self.start + timedelta(hours=12)  # 08:00 is due, 20:00 is not
+        self.assertEqual(reminders.dispatch_due(now=now), {'queued': 1, 'skipped': 0})
+        reminder.refresh_from_db()
+        self.assertEqual((reminder.next_fire_at, reminder.fired_count, reminder.notified),
+                         (self.start.replace(hour=20), 1, False))
+        self.assertEqual(Reminder.objects.count(), 1)
+
+        # Two occurrences missed while nothing ran go out as one email; the series then ends
+        self.assertEqual(reminders.dispatch_due(now=self.start + timedelta(days=1, hours=2)), {'queued': 1, 'skipped': 0})
+        reminder.refresh_from_db()
+        self.assertEqual((reminder.fired_count, reminder.notified), (2, True))
+        self.assertEqual(OutboundEmail.objects.filter(kind='reminder').count(), 2)
+        self.assertIn('Scheduled at: 2026-01-05 20:00', OutboundEmail.objects.order_by('id').last().body)
+
+    def test_series_older_than_lookback_resumes(self):
+        from hospital import reminders
+        reminder = self.series(freq='daily', date=self.start - timedelta(days=10))
+        now = self.start + timedelta(hours=1)
+        self.assertEqual(reminders.dispatch_due(now=now), {'queued': 0, 'skipped': 0})
+        self.assertEqual(reminders.resume_stale_series(now=now), 1)
+        self.assertEqual(reminders.dispatch_due(now=now), {'queued': 1, 'skipped': 0})
+        reminder.refresh_from_db()
+        self.assertEqual(reminder.next_fire_at, self.start + timedelta(days=1))
+
+    def test_create_validates_rule(self):
+        self.client.force_authenticate(self.patient)
+        payload = {'title': 'Dose', 'date': self.start.isoformat(), 'patient': self.patient.id}
+        self.assertEqual(self.client.post('/api/reminders/', {**payload, 'byhour': '8'}, format='json').status_code, 400)
+        self.assertEqual(self.client.post('/api/reminders/', {**payload, 'freq': 'daily', 'byday': 'XX'}, format='json').status_code, 400)
+        self.assertEqual(self.client.post('/api/reminders/', {**payload, 'freq': 'daily', 'byhour': '25'}, format='json').status_code, 400)
+        response = self.client.post('/api/reminders/', {**payload, 'freq': 'weekly', 'byday': 'fr,mo'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['byday'], 'MO,FR')
+        self.assertEqual(response.data['next_fire_at'], '2026-01-05T07:00:00Z')
+
+    def test_occurrences_endpoint(self):
+        self.series(freq='daily', byhour='8,14,20')
+        self.series(date=self.start + timedelta(days=1, hours=3))
+        Reminder.objects.create(title='Not mine', date=self.start, patient=self.other, freq='hourly')
+        self.client.force_authenticate(self.patient)
+        response = self.client.get('/api/reminders/occurrences/', {
+            'from': self.start.isoformat(), 'to': (self.start + timedelta(days=2)).isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 7)
+        self.assertFalse(response.data['truncated'])
+        self.assertEqual(response.data['results'][3]['at'], self.start + timedelta(days=1, hours=1))
+        self.assertEqual(response.data['results'][4]['at'], self.start + timedelta(days=1, hours=3))
+        self.assertEqual(self.client.get('/api/reminders/occurrences/', {'from': 'soon'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/reminders/occurrences/', {
+            'from': self.start.isoformat(), 'to': (self.start + timedelta(days=400)).isoformat()}).status_code, 400)
+
+
+@override_settings(EMAIL_BACKEND='hospital.tests.CountingEmailBackend', REMINDER_LOOKBACK_MINUTES=24 * 60, OUTBOX_WORKERS=1)
+class ReminderDigestTests(TestCase):
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+        CountingEmailBackend.refuse = set()
+        self.digest = Package.objects.create(name='Digest', price=1, can_set_reminders=True, reminder_digest_minutes=10)
+        self.doctor = User.objects.create_user(username='dd', email='dd@example.com', password='x', user_type='doctor',
+                                               phone_number='1', package=self.digest)
+        self.now = timezone.now()
+
+    def remind(self, minutes_from_now, **fields):
+        fields.setdefault('doctor', self.doctor)
+        return Reminder.objects.create(title=f'Patient at {minutes_from_now}', date=self.now + timedelta(minutes=minutes_from_now), **fields)
+
+    def test_due_and_upcoming_reminders_share_one_email(self):
+        from hospital import reminders
+        due = [self.remind(-i) for i in range(40)]
+        upcoming = self.remind(5)
+        later = self.remind(30)
+        with CaptureQueriesContext(connection) as ctx:
+            totals = reminders.dispatch_due(now=self.now, batch_size=100)
+        self.assertEqual(totals, {'queued': 41, 'skipped': 0})
+        statements = [q['sql'].split()[0] for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']]
+        # Claim, digest lookahead, outbox and event inserts, one UPDATE marking all 41
+        self.assertEqual(statements, ['SELECT', 'SELECT', 'INSERT', 'INSERT', 'UPDATE'])
+        self.assertEqual(set(Reminder.objects.filter(notified=True)), set(due + [upcoming]))
+        self.assertFalse(Reminder.objects.get(id=later.id).notified)
+        message = OutboundEmail.objects.get()
+        self.assertEqual((message.kind, message.subject), ('reminder_digest', '[Pixeltre Medical] 41 reminders'))
+        self.assertIn(upcoming.title, message.body)
+
+    def test_digest_spans_claim_batches_and_advances_series(self):
+        from hospital import reminders
+        for i in range(5):
+            self.remind(-i)
+        series = self.remind(-1, freq='hourly')
+        self.assertEqual(reminders.dispatch_due(now=self.now, batch_size=2), {'queued': 6, 'skipped': 0})
+        self.assertEqual(OutboundEmail.objects.count(), 1)
+        series.refresh_from_db()
+        self.assertEqual((series.notified, series.fired_count), (False, 1))
+        self.assertGreater(series.next_fire_at, self.now)
+
+    def test_packages_without_digests_or_reminders(self):
+        from hospital import reminders
+        plain = Package.objects.create(name='Plain', price=1, can_set_reminders=True)
+        gated = Package.objects.create(name='Gated', price=1, can_set_reminders=False, reminder_digest_minutes=10)
+        separate = User.objects.create_user(username='ds', email='ds@example.com', password='x', user_type='doctor',
+                                            phone_number='1', package=plain)
+        quiet = User.objects.create_user(username='dq', email='dq@example.com', password='x', user_type='doctor',
+                                         phone_number='1', package=gated)
+        for i in range(3):
+            self.remind(-i, doctor=separate)
+            self.remind(-i, doctor=quiet)
+        self.assertEqual(reminders.dispatch_due(now=self.now), {'queued': 3, 'skipped': 3})
+        self.assertEqual(list(OutboundEmail.objects.values_list('kind', flat=True)), ['reminder'] * 3)
+
+
+@override_settings(EMAIL_BACKEND='hospital.tests.CountingEmailBackend', OUTBOX_WORKERS=1, REMINDER_STREAM_POLL_SECONDS=0.01,
+                   REMINDER_STREAM_HEARTBEAT_SECONDS=0.05)
+class ReminderStreamTests(TestCase):
+    def setUp(self):
+        package = Package.objects.create(name='Remind', price=1, can_set_reminders=True)
+        self.patient = User.objects.create_user(username='sp', email='sp@example.com', password='x', user_type='patient',
+                                                phone_number='1', package=package)
+        self.other = User.objects.create_user(username='so', email='so@example.com', password='x', user_type='patient',
+                                              phone_number='1', package=package)
+        self.token = str(AccessToken.for_user(self.patient))
+
+    async def next_chunk(self, chunks):
+        return (await asyncio.wait_for(anext(chunks), 5)).decode()
+
+    async def read_until(self, chunks, marker):
+        while True:
+            chunk = await self.next_chunk(chunks)
+            if marker in chunk:
+                return chunk
+
+    async def test_pushes_reminders_as_the_dispatcher_queues_them(self):
+        from hospital import events, reminders
+        response = await self.async_client.get('/api/reminders/stream/', {'token': self.token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = aiter(response.streaming_content)
+        try:
+            self.assertTrue((await self.next_chunk(chunks)).startswith('retry:'))
+            await self.read_until(chunks, ': keep-alive')
+            self.assertEqual(events.broker.connections, 1)
+            await Reminder.objects.acreate(title='Not mine', date=timezone.now(), patient=self.other)
+            await Reminder.objects.acreate(title='Insulin', date=timezone.now(), patient=self.patient)
+            await sync_to_async(reminders.dispatch_due)()
+            chunk = await self.read_until(chunks, 'event: reminder')
+            self.assertIn('"title": "Insulin"', chunk)
+            self.assertNotIn('Not mine', chunk)
+        finally:
+            await chunks.aclose()
+
+    @override_settings(REMINDER_STREAM_MAX_SECONDS=0.2)
+    async def test_stream_ends_after_its_lifetime(self):
+        from hospital import events
+        response = await self.async_client.get('/api/reminders/stream/', {'token': self.token})
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertTrue(chunks[0].startswith(b'retry:'))
+        self.assertIn(b': keep-alive\n\n', chunks)
+        self.assertEqual(events.broker.connections, 0)
+
+    async def test_last_event_id_replays_missed_events(self):
+        from hospital import events
+        await sync_to_async(events.publish)([
+            Reminder(id=None, title=f'Dose {i}', patient=user, next_fire_at=timezone.now())
+            for i, user in enumerate([self.patient, self.other, self.patient, self.patient])
+        ])
+        first = await ReminderEvent.objects.filter(user_id=self.patient.id).order_by('id').afirst()
+        response = await self.async_client.get('/api/reminders/stream/', headers={
+            'Authorization': f'Bearer {self.token}', 'Last-Event-ID': str(first.id)})
+        chunks = aiter(response.streaming_content)
+        try:
+            await self.next_chunk(chunks)
+            replayed = [await self.next_chunk(chunks), await self.next_chunk(chunks)]
+        finally:
+            await chunks.aclose()
+        self.assertEqual([chunk.split('\n')[0] for chunk in replayed], [f'id: {first.id + 2}', f'id: {first.id + 3}'])
+
+    async def test_rejects_missing_or_bad_credentials(self):
+        self.assertEqual((await self.async_client.get('/api/reminders/stream/')).status_code, 401)
+        self.assertEqual((await self.async_client.get('/api/reminders/stream/', {'token': 'nope'})).status_code, 401)
+        response = await self.async_client.get('/api/reminders/stream/', {'token': self.token, 'last_event_id': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_one_poll_fans_out_to_every_connection(self):
+        from hospital import events
+        broker = events.Broker()
+        queues = {user.id: [broker.subscribe(user.id) for _ in range(100)] for user in (self.patient, self.other)}
+        broker.task.cancel()
+        await broker.poll()
+        await sync_to_async(events.publish)([Reminder(title='Dose', patient=self.patient, next_fire_at=timezone.now())])
+        await broker.poll()
+        self.assertTrue(all(queue.qsize() == 1 for queue in queues[self.patient.id]))
+        self.assertTrue(all(queue.empty() for queue in queues[self.other.id]))
+
+    async def test_events_committed_out_of_order_are_still_delivered(self):
+        from hospital import events
+        broker = events.Broker()
+        queue = broker.subscribe(self.patient.id)
+        broker.task.cancel()
+        await broker.poll()
+        start = broker.last_id
+        scheduled = timezone.now()
+        # A second dispatcher commits its later id first
+        await ReminderEvent.objects.acreate(id=start + 2, user_id=self.patient.id, title='Later', scheduled_at=scheduled)
+        await broker.poll()
+        await ReminderEvent.objects.acreate(id=start + 1, user_id=self.patient.id, title='Earlier', scheduled_at=scheduled)
+        await broker.poll()
+        self.assertEqual([queue.get_nowait()['title'] for _ in range(queue.qsize())], ['Later', 'Earlier'])
+        self.assertEqual(broker.gaps, {})
+
+    def test_publishes_reminders_for_users_without_email(self):
+        from hospital import reminders
+        self.patient.email = ''
+        self.patient.save()
+        Reminder.objects.create(title='Dose', date=timezone.now() - timedelta(minutes=1), patient=self.patient)
+        self.assertEqual(reminders.dispatch_due(), {'queued': 0, 'skipped': 1})
+        self.assertEqual(list(ReminderEvent.objects.values_list('user_id', 'title')), [(self.patient.id, 'Dose')])
+
+
+class ReminderCalendarTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        package = Package.objects.create(name='Remind', price=1, can_set_reminders=True)
+        cls.doctor = User.objects.create_user(username='cd', password='x', user_type='doctor', phone_number='1', package=package)
+        cls.patient = User.objects.create_user(username='cp', password='x', user_type='patient', phone_number='1', package=package)
+        cls.start = datetime(2026, 3, 1, tzinfo=dt_timezone.utc)
+        cls.mine = [Reminder.objects.create(title=f'Day {day}', date=cls.start + timedelta(days=day), patient=cls.patient)
+                    for day in (3, 1, 2, 1, 20)]
+        Reminder.objects.create(title='Doctor day 1', date=cls.start + timedelta(days=1), doctor=cls.doctor)
+
+    def setUp(self):
+        self.client.force_authenticate(self.patient)
+        self.window = {'from': self.start.isoformat(), 'to': (self.start + timedelta(days=7)).isoformat()}
+
+    def test_lists_own_range_in_date_order_across_pages(self):
+        seen, response = [], self.client.get('/api/reminders/', {**self.window, 'page_size': 2})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            seen += [row['title'] for row in response.data['results']]
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(seen, ['Day 1', 'Day 1', 'Day 2', 'Day 3'])
+        self.client.force_authenticate(self.doctor)
+        self.assertEqual([row['title'] for row in self.client.get('/api/reminders/', self.window).data], ['Doctor day 1'])
+        self.assertEqual(self.client.get('/api/reminders/', {'from': 'tomorrow'}).status_code, 400)
+
+    def test_conditional_get(self):
+        first = self.client.get('/api/reminders/', self.window)
+        etag = first['ETag']
+        with self.assertNumQueries(1):
+            cached = self.client.get('/api/reminders/', self.window, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(cached.status_code, 304)
+
+        # Changes outside the window keep the validator; inside it, any change breaks it
+        Reminder.objects.create(title='Later', date=self.start + timedelta(days=30), patient=self.patient)
+        self.assertEqual(self.client.get('/api/reminders/', self.window, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        from hospital import reminders
+        reminders.dispatch_due(now=self.start + timedelta(days=1, hours=1), since=self.start)
+        changed = self.client.get('/api/reminders/', self.window, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], etag)
+        Reminder.objects.filter(title='Day 3').delete()
+        self.assertNotEqual(self.client.get('/api/reminders/', self.window)['ETag'], changed['ETag'])
+
+
+try:
+    from aiosmtpd.controller import Controller as SMTPController
+except ImportError:
+    SMTPController = None
+
+
+@override_settings(EMAIL_BACKEND='hospital.tests.CountingEmailBackend', OUTBOX_WORKERS=3, OUTBOX_BACKOFF_SECONDS=10,
+                   OUTBOX_MAX_ATTEMPTS=3, OUTBOX_RECIPIENT_LIMIT=2, OUTBOX_RECIPIENT_WINDOW_SECONDS=600)
+class OutboxTests(TestCase):
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+        CountingEmailBackend.refuse = set()
+
+    def test_drains_concurrently_with_one_connection_per_worker(self):
+        from hospital import outbox
+        outbox.enqueue_many([outbox.build(f'user{i}@example.com', f'Hello {i}', 'Body') for i in range(12)])
+        totals = outbox.drain()
+        self.assertEqual(totals['sent'], 12)
+        self.assertEqual(len(totals['latencies']), 12)
+        self.assertEqual(CountingEmailBackend.opened, 3)
+        self.assertEqual(sorted(m.subject for m in mail.outbox), sorted(f'Hello {i}' for i in range(12)))
+        self.assertFalse(OutboundEmail.objects.exclude(status=OutboundEmail.SENT).exists())
+
+    def test_backoff_then_dead_letter(self):
+        from hospital import outbox
+        message = outbox.enqueue('bounce@example.com', 'Hi', 'Body')
+        CountingEmailBackend.refuse = {'bounce@example.com'}
+        later = timezone.now()
+        delays = []
+        for attempt in range(3):
+            outbox.drain(now=later)
+            message.refresh_from_db()
+            self.assertEqual(message.attempts, attempt + 1)
+            delays.append((message.next_attempt_at - timezone.now()).total_seconds())
+            later = message.next_attempt_at + timedelta(seconds=1)
+        self.assertEqual(message.status, OutboundEmail.DEAD)
+        self.assertIn('refused', message.last_error)
+        self.assertAlmostEqual(delays[1] / delays[0], 2, delta=0.8)
+        self.assertEqual(outbox.drain(now=later + timedelta(days=1))['sent'], 0)
+
+    def test_recipient_rate_limit_defers_instead_of_failing(self):
+        from hospital import outbox
+        outbox.enqueue_many([outbox.build('busy@example.com', f'Note {i}', 'Body') for i in range(5)]
+                            + [outbox.build('quiet@example.com', 'Note', 'Body')])
+        self.assertEqual(outbox.drain()['sent'], 3)
+        deferred = OutboundEmail.objects.filter(status=OutboundEmail.PENDING)
+        self.assertEqual(deferred.count(), 3)
+        self.assertTrue(all(m.attempts == 0 and m.next_attempt_at > timezone.now() for m in deferred))
+
+    def test_expired_lease_is_reclaimed(self):
+        from hospital import outbox
+        message = outbox.enqueue('slow@example.com', 'Hi', 'Body')
+        self.assertEqual(outbox.claim(timezone.now(), 10), [message])
+        self.assertEqual(outbox.claim(timezone.now(), 10), [])
+        self.assertEqual(outbox.drain(now=timezone.now() + timedelta(minutes=10))['sent'], 1)
+
+    def test_queue_depth_is_exported(self):
+        from hospital import outbox
+        outbox.enqueue('a@example.com', 'Hi', 'Body')
+        admin = User.objects.create_superuser(username='oadmin', email='oadmin@example.com', password='x')
+        client = APIClient()
+        client.force_authenticate(admin)
+        body = client.get('/api/metrics/').content.decode()
+        self.assertIn('outbox_messages{status="pending"} 1', body)
+        self.assertIn('outbox_messages{status="dead"} 0', body)
+
+    @skipUnless(SMTPController, 'aiosmtpd is not installed')
+    def test_delivers_to_a_real_smtp_server(self):
+        from hospital import outbox
+
+        class Collect:
+            def __init__(self):
+                self.envelopes = []
+
+            async def handle_DATA(self, server, session, envelope):
+                self.envelopes.append(envelope)
+                return '250 OK'
+
+        import socket
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        handler = Collect()
+        controller = SMTPController(handler, hostname='127.0.0.1', port=port)
+        controller.start()
+        self.addCleanup(controller.stop)
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1',
+                               EMAIL_PORT=port, EMAIL_USE_TLS=False, EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD=''):
+            outbox.enqueue_many([outbox.build(f'smtp{i}@example.com', 'Hi', 'Body') for i in range(6)])
+            totals = outbox.drain()
+        self.assertEqual(totals['sent'], 6)
+        self.assertEqual(sorted(e.rcpt_tos[0] for e in handler.envelopes), sorted(f'smtp{i}@example.com' for i in range(6)))
+
+
+@override_settings(UPLOAD_SESSION_CHUNK_SIZE=1024)
+class ResumableUploadTests(MediaRootMixin, APITestCase):
+    def media_settings(self):
+        return {'UPLOAD_SESSION_DIR': os.path.join(self.media_root, 'sessions')}
+
+    def setUp(self):
+        super().setUp()
+        self.create_users(max_uploads=3, max_storage_mb=1)
+        self.client.force_authenticate(self.patient)
+        self.content = b"%PDF-" + os.urandom(3000)
+
+    def start(self, size=None, name="scan.pdf"):
+        response = self.client.post('/api/uploads/', {
+            "file_name": name, "size": len(self.content) if size is None else size,
+            "patient": self.patient.id, "doctor": self.doctor.id, "description": "MRI"}, format='json')
+        return response
+
+    def put(self, session_id, offset, data):
+        return self.client.put(f'/api/uploads/{session_id}/', data, content_type='application/offset+octet-stream',
+                               HTTP_UPLOAD_OFFSET=str(offset))
+
+    def send_all(self, session_id, order=(2, 0, 1)):
+        for index in order:
+            response = self.put(session_id, index * 1024, self.content[index * 1024:(index + 1) * 1024])
+            self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_chunks_in_any_order_finalize_into_a_record(self):
+        import hashlib
+        created = self.start()
+        self.assertEqual(created.status_code, 201)
+        self.assertEqual(created.data['chunk_size'], 1024)
+        session_id = created.data['id']
+
+        self.put(session_id, 2048, self.content[2048:])
+        status = self.client.get(f'/api/uploads/{session_id}/')
+        self.assertEqual((status.data['received'], status.data['offset'], status.data['complete']), ([2], 0, False))
+        status = self.send_all(session_id, order=(0, 1))
+        self.assertEqual((status.data['offset'], status.data['complete']), (len(self.content), True))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/api/uploads/{session_id}/finalize/')
+        self.assertEqual(response.status_code, 201)
+        record = Record.objects.get(patient=self.patient)
+        self.assertEqual((record.description, record.sha256), ("MRI", hashlib.sha256(self.content).hexdigest()))
+        with open(record.prescription.path, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        ledger = UsageLedger.objects.get(user=self.patient)
+        self.assertEqual((ledger.upload_count, ledger.bytes_used), (1, len(self.content)))
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'sessions', session_id)))
+
+        # A retry after a lost response gets the same record rather than a second one
+        retry = self.client.post(f'/api/uploads/{session_id}/finalize/')
+        self.assertEqual((retry.status_code, retry.data['id']), (200, record.id))
+        self.assertEqual(Record.objects.count(), 1)
+
+    def test_resent_chunk_is_accepted_and_a_conflicting_one_refused(self):
+        session_id = self.start().data['id']
+        self.assertEqual(self.put(session_id, 0, self.content[:1024]).status_code, 200)
+        self.assertEqual(self.put(session_id, 0, self.content[:1024]).status_code, 200)
+        self.assertEqual(self.put(session_id, 0, b"x" * 1024).status_code, 409)
+        # Only the first copy is kept, and no temporary file is left behind
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'sessions', session_id))), 1)
+        self.assertEqual(self.put(session_id, 10, self.content[:1024]).status_code, 400)
+        self.assertEqual(self.put(session_id, 1024, self.content[1024:1500]).status_code, 400)
+
+    def test_finalize_needs_every_chunk(self):
+        session_id = self.start().data['id']
+        self.send_all(session_id, order=(0, 2))
+        response = self.client.post(f'/api/uploads/{session_id}/finalize/')
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Record.objects.exists())
+
+    def test_package_limits_apply(self):
+        self.assertEqual(self.start(size=2 * 1024 * 1024).status_code, 403)
+        self.assertEqual(self.start(name="scan.exe").status_code, 400)
+        self.assertEqual(self.start(size=11 * 1024 * 1024).status_code, 413)
+
+        session_id = self.start().data['id']
+        self.send_all(session_id)
+        # Storage used up by another upload between create and finalize
+        UsageLedger.objects.filter(user=self.patient).update(bytes_used=1024 * 1024 - 100)
+        response = self.client.post(f'/api/uploads/{session_id}/finalize/')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Record.objects.exists())
+
+    def test_only_the_owner_sees_a_session(self):
+        session_id = self.start().data['id']
+        self.client.force_authenticate(self.doctor)
+        self.assertEqual(self.client.get(f'/api/uploads/{session_id}/').status_code, 404)
+
+    def test_expired_sessions_are_removed(self):
+        expired_id = self.start().data['id']
+        self.send_all(expired_id, order=(0,))
+        live_id = self.start().data['id']
+        self.send_all(live_id, order=(0,))
+        UploadSession.objects.filter(id=expired_id).update(expires_at=timezone.now() - timedelta(minutes=1))
+        orphan = os.path.join(self.media_root, 'sessions', str(uuid.uuid4()))
+        os.makedirs(orphan)
+
+        self.assertEqual(self.put(expired_id, 1024, self.content[1024:2048]).status_code, 410)
+        out = StringIO()
+        call_command('expire_upload_sessions', stdout=out)
+        self.assertIn('Expired 1 upload sessions, removed 1 orphaned', out.getvalue())
+        self.assertEqual(sorted(os.listdir(os.path.join(self.media_root, 'sessions'))), [live_id])
+        self.assertEqual(list(UploadSession.objects.values_list('id', flat=True)), [uuid.UUID(live_id)])
@@ -0,0 +1,214 @@
+"""
+Single-pass inspection of uploaded record files.
+
+upload_record installs ``InspectingUploadHandler`` before it touches
+request.data, so the multipart body streams to a temporary file in
+UPLOAD_CHUNK_SIZE pieces while, in the same pass, the type is sniffed from the
+magic bytes, the SHA-256 computed and the size counted against the per-file cap
+and the patient's remaining storage. An upload that breaks a limit is abandoned
+at the chunk that crossed it rather than after the whole body has arrived.
+
+The file comes out marked ``inspected`` with its ``sha256`` and ``kind``, so
+Record.save() reuses them instead of reading it again, and FileSystemStorage
+moves the temporary file into MEDIA_ROOT rather than copying it.
+"""
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from rest_framework import status
+from rest_framework.exceptions import APIException
+import hashlib
+import os
+
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+# Multipart boundaries and the other form fields, on top of the file itself
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+EXTENSION_KINDS = {'.pdf': 'pdf', '.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png'}
+MAGIC = (
+    ('pdf', b'%PDF-'),
+    ('jpeg', b'\xff\xd8\xff'),
+    ('png', b'\x89PNG\r\n\x1a\n'),
+)
+SNIFF_BYTES = max(len(magic) for _, magic in MAGIC)
+
+
+class UploadRejected(APIException):
+    status_code = status.HTTP_400_BAD_REQUEST
+
+    def __init__(self, message):
+        # Same {'error': ...} shape as the rest of the upload view's refusals
+        super().__init__({'error': message})
+
+
+class FileTooLarge(UploadRejected):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+    def __init__(self):
+        super().__init__('The maximum file size that can be uploaded is 10MB')
+
+
+class QuotaExceeded(UploadRejected):
+    status_code = status.HTTP_403_FORBIDDEN
+
+    def __init__(self):
+        super().__init__('You have exceeded your storage limit.')
+
+
+def unsupported():
+    return UploadRejected('Unsupported file type. Please upload PDF, JPG, JPEG, or PNG files.')
+
+
+def chunk_size():
+    return getattr(settings, 'UPLOAD_CHUNK_SIZE', 64 * 1024)
+
+
+def expected_kind(file_name):
+    kind = EXTENSION_KINDS.get(os.path.splitext(file_name or '')[1].lower())
+    if kind is None:
+        raise unsupported()
+    return kind
+
+
+def sniff(head):
+    """The kind named by ``head``'s magic bytes, or None."""
+    for kind, magic in MAGIC:
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+def is_inspected(upload):
+    return getattr(upload, 'inspected', False)
+
+
+def mark(upload, sha256, kind):
+    upload.sha256 = sha256
+    upload.kind = kind
+    upload.inspected = True
+
+
+class Inspection:
+    """Running checks over one file's chunks."""
+
+    def __init__(self, file_name, max_size, quota):
+        self.expected = expected_kind(file_name)
+        self.max_size = max_size
+        self.quota = quota
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.kind = None
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise FileTooLarge()
+        if self.quota is not None and self.size > self.quota:
+            raise QuotaExceeded()
+        if self.kind is None:
+            self.head += chunk[:SNIFF_BYTES - len(self.head)]
+            if len(self.head) >= SNIFF_BYTES:
+                self.check_kind()
+        self.digest.update(chunk)
+
+    def check_kind(self):
+        if sniff(self.head) != self.expected:
+            raise unsupported()
+        self.kind = self.expected
+
+    def finish(self):
+        if self.kind is None:
+            self.check_kind()
+        return self.digest.hexdigest(), self.kind
+
+
+def inspect(upload, max_size=MAX_UPLOAD_BYTES, quota=None):
+    """
+    Inspect an upload that did not come through the handler (its body was
+    parsed before the view ran, e.g. by the CSRF check). Reads it once.
+    """
+    if is_inspected(upload):
+        return upload
+    inspection = Inspection(upload.name, max_size, quota)
+    upload.seek(0)
+    for chunk in upload.chunks(chunk_size()):
+        inspection.feed(chunk)
+    upload.seek(0)
+    mark(upload, *inspection.finish())
+    return upload
+
+
+def digest(upload):
+    """SHA-256 of a file, reusing the handler's result when there is one."""
+    if is_inspected(upload):
+        return upload.sha256
+    sha = hashlib.sha256()
+    upload.seek(0)
+    for chunk in upload.chunks(chunk_size()):
+        sha.update(chunk)
+    upload.seek(0)
+    return sha.hexdigest()
+
+
+def install(request, handler):
+    """
+    Route ``request``'s body through ``handler``. Returns False when the body
+    has already been parsed, in which case the caller falls back to ``inspect``.
+    """
+    django_request = getattr(request, '_request', request)
+    try:
+        django_request.upload_handlers = [handler]
+    except AttributeError:
+        return False
+    return True
+
+
+class InspectingUploadHandler(FileUploadHandler):
+    """
+    Streams every file in the request to disk while inspecting it. ``quota``
+    is the patient's remaining storage in bytes, or None for no limit; it is
+    shared by all files in the request.
+    """
+
+    def __init__(self, request=None, max_size=MAX_UPLOAD_BYTES, quota=None):
+        super().__init__(request)
+        self.chunk_size = chunk_size()
+        self.max_size = max_size
+        self.quota = quota
+        self.inspection = None
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # Refuse an obviously oversized body before reading any of it
+        if content_length and content_length > self.max_size + FORM_OVERHEAD_BYTES:
+            raise FileTooLarge()
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.inspection = Inspection(file_name, self.max_size, self.quota)
+        self.file = TemporaryUploadedFile(file_name, content_type, 0, charset, content_type_extra)
+
+    def receive_data_chunk(self, raw_data, start):
+        try:
+            self.inspection.feed(raw_data)
+        except UploadRejected:
+            self.file.close()
+            raise
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        try:
+            sha256, kind = self.inspection.finish()
+        except UploadRejected:
+            self.file.close()
+            raise
+        if self.quota is not None:
+            self.quota -= file_size
+        self.file.seek(0)
+        self.file.size = file_size
+        mark(self.file, sha256, kind)
+        return self.file
+
+    def upload_interrupted(self):
+        if getattr(self, 'file', None) is not None:
+            self.file.close()
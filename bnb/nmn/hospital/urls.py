@@ -9,6 +9,22 @@ from .views import RecordViewSet, get_package_details
 router = DefaultRouter()
 router.register(r'records', RecordViewSet, basename='record')
 
+
+def file_routes(async_views=False):
+    """Routes that send record files; the async views are for ASGI deployments (ASYNC_FILE_VIEWS)."""
+    if async_views:
+        return [
+            path('records/<int:record_id>/download/', views.download_record_async, name='download_record'),
+            path('share/<uuid:token>/', views.view_shared_record_async, name='view_shared_record'),
+            # Ahead of the router's preview action, which it replaces
+            path('records/<int:pk>/preview/', views.preview_record_async, name='record-preview'),
+        ]
+    return [
+        path('records/<int:record_id>/download/', views.download_record, name='download_record'),
+        path('share/<uuid:token>/', views.view_shared_record, name='view_shared_record'),
+    ]
+
+
 urlpatterns = [
     # Authentication endpoints
     path('register/', views.register, name='api_register'),
@@ -44,12 +60,22 @@ urlpatterns = [
     path('records/<int:record_id>/share/', views.share_record, name='share_record'),
     path('records/<int:record_id>/delete/', views.delete_record, name='delete_record'),
     path('records/<int:record_id>/generate-link/', views.generate_share_link, name='generate_share_link'),
-    path('records/<int:record_id>/download/', views.download_record, name='download_record'),
-    path('share/<uuid:token>/', views.view_shared_record, name='view_shared_record'),
+    *file_routes(getattr(settings, 'ASYNC_FILE_VIEWS', False)),
+
+    # Resumable uploads
+    path('uploads/', views.upload_session_create, name='upload_session_create'),
+    path('uploads/<uuid:session_id>/', views.upload_session, name='upload_session'),
+    path('uploads/<uuid:session_id>/finalize/', views.upload_session_finalize, name='upload_session_finalize'),
     
     # Reminders
-    path('reminders/', views.create_reminder, name='create_reminder'),
+    path('reminders/', views.reminders_list_create, name='reminders_list_create'),
+    path('reminders/occurrences/', views.reminder_occurrences, name='reminder_occurrences'),
+    path('reminders/stream/', views.reminder_stream, name='reminder_stream'),
     
+    # Monitoring
+    path('metrics/', views.export_metrics, name='metrics'),
+    path('profiles/<str:profile_id>/', views.profile_report, name='profile_report'),
+
     # Token endpoints
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('', include(router.urls)),
@@ -0,0 +1,140 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+from .models import Record, UsageLedger
+from . import blobs
+import logging
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+SharedWith = Record.shared_with.through
+
+
+def stat_size(record):
+    """Size of the record's file on disk, or 0 if it is missing."""
+    if record.blob_id is not None and record.blob.archived:
+        # Its blob knows the size; what is on disk is a compressed segment entry
+        return record.blob.size
+    try:
+        return record.prescription.size if record.prescription else 0
+    except (FileNotFoundError, OSError, ValueError):
+        return 0
+
+
+def compute_usage(user_ids, stat_files=False):
+    """
+    Recompute usage totals for the given patients from the record table.
+
+    Live records whose size was never captured are stat'ed once and the size is
+    persisted. With ``stat_files`` every live record is re-stat'ed, which is how
+    the ledger is reconciled against what is actually on disk.
+    Returns ``({user_id: {'bytes_used', 'upload_count', 'share_count'}}, resized)``.
+    """
+    totals = {user_id: {'bytes_used': 0, 'upload_count': 0, 'share_count': 0} for user_id in user_ids}
+    resized = []
+    records = (Record.objects.filter(patient_id__in=user_ids, is_deleted=False).select_related('blob')
+               .only('id', 'patient_id', 'prescription', 'file_size', 'blob__size', 'blob__segment'))
+    for record in records.iterator(chunk_size=2000):
+        if stat_files or not record.file_size:
+            size = stat_size(record)
+            if size != record.file_size:
+                record.file_size = size
+                resized.append(record)
+        totals[record.patient_id]['bytes_used'] += record.file_size
+        totals[record.patient_id]['upload_count'] += 1
+    if resized:
+        Record.objects.bulk_update(resized, ['file_size'], batch_size=500)
+    shares = (
+        SharedWith.objects.filter(record__patient_id__in=user_ids, record__is_deleted=False)
+        .values('record__patient_id')
+        .annotate(n=Count('id'))
+    )
+    for row in shares:
+        totals[row['record__patient_id']]['share_count'] = row['n']
+    return totals, len(resized)
+
+
+def get_ledger(user, lock=False):
+    """
+    Return the usage ledger for ``user`` as a single-row read.
+
+    A missing ledger is built from the record table on first access; after that
+    the row is kept current by the record_* helpers below.
+    """
+    queryset = UsageLedger.objects.select_for_update() if lock else UsageLedger.objects.all()
+    try:
+        return queryset.get(user_id=user.pk)
+    except UsageLedger.DoesNotExist:
+        pass
+    totals, _ = compute_usage([user.pk])
+    try:
+        with transaction.atomic():
+            UsageLedger.objects.create(user_id=user.pk, **totals[user.pk])
+    except IntegrityError:
+        # Another request built it first
+        pass
+    return queryset.get(user_id=user.pk)
+
+
+def _apply(user_id, bytes_delta=0, uploads_delta=0, shares_delta=0):
+    # No ledger yet means nothing to adjust: it is built from the current
+    # record table the first time it is read.
+    UsageLedger.objects.filter(user_id=user_id).update(
+        bytes_used=F('bytes_used') + bytes_delta,
+        upload_count=F('upload_count') + uploads_delta,
+        share_count=F('share_count') + shares_delta,
+        updated_at=timezone.now(),
+    )
+
+
+def record_added(record):
+    """Account for a newly stored (or restored) live record."""
+    _apply(record.patient_id, record.file_size, 1, record.shared_with.count())
+
+
+def record_removed(record):
+    """Account for a live record being soft-deleted or purged."""
+    _apply(record.patient_id, -record.file_size, -1, -record.shared_with.count())
+
+
+def bytes_changed(user_id, delta):
+    """Account for a patient's live files shrinking or growing in place, as when they are recompressed."""
+    _apply(user_id, bytes_delta=delta)
+
+
+def shares_added(record, count=1):
+    _apply(record.patient_id, shares_delta=count)
+
+
+def soft_delete(record):
+    """Mark ``record`` deleted and release its usage. Returns False if it was already deleted."""
+    with transaction.atomic():
+        deleted_at = timezone.now()
+        updated = Record.objects.filter(pk=record.pk, is_deleted=False).update(is_deleted=True, deleted_at=deleted_at)
+        if updated:
+            record.is_deleted = True
+            record.deleted_at = deleted_at
+            record_removed(record)
+            blobs.release(record)
+    return bool(updated)
+
+
+def package_summary(user):
+    """The ``package_info`` payload shown to patients on login and on the dashboard."""
+    package = user.package
+    ledger = get_ledger(user)
+    max_uploads = package.max_uploads
+    max_storage_mb = package.max_storage_mb
+    current_uploads = ledger.upload_count
+    used_storage_mb = ledger.bytes_used / MB
+    return {
+        'max_uploads': max_uploads,
+        'max_storage_mb': max_storage_mb,
+        'current_uploads': current_uploads,
+        'current_shares': ledger.share_count,
+        'used_storage_mb': used_storage_mb,
+        'available_uploads': max_uploads - current_uploads if max_uploads > 0 else 'Unlimited',
+        'available_storage_mb': max_storage_mb - used_storage_mb if max_storage_mb > 0 else 'Unlimited'
+    }
@@ -1,21 +1,39 @@
 from django.contrib.auth import authenticate, get_user_model
+from django.contrib.auth.models import AnonymousUser
 from django.db import models
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
+from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from datetime import timedelta
-from .models import User, Package, Record, Reminder, SharedLink
-from .serializers import UserSerializer, PackageSerializer, RecordSerializer, ReminderSerializer, SharedLinkSerializer
-from django.http import FileResponse
+from .models import User, Package, Record, Reminder, SharedLink, UploadSession
+from .serializers import UserSerializer, PackageSerializer, RecordSerializer, ReminderSerializer, SharedLinkSerializer, UploadSessionSerializer
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_safe
 from django.core.mail import send_mail
 from django.conf import settings
 from django.middleware.csrf import get_token
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.db import transaction
+from . import archive, blobs, delivery, derivatives, events, ingest, metrics, outbox, profiling, recurrence, resumable, uploads, usage
+from .pagination import paginate, shape_queryset, RECORD_ORDERING, REMINDER_ORDERING, ID_ORDERING
+from asgiref.sync import sync_to_async
+import asyncio
+import hashlib
+import json
 import logging
+import math
 import mimetypes
 import os
 
@@ -33,8 +51,7 @@ def get_csrf_token(request):
 def manage_packages(request):
     if request.method == 'GET':
         packages = Package.objects.all()
-        serializer = PackageSerializer(packages, many=True)
-        return Response(serializer.data)
+        return paginate(request, packages, PackageSerializer, ID_ORDERING)
     elif request.method == 'POST':
         if not request.user.is_authenticated or not request.user.is_staff:
             return Response({'error': 'Admin only'}, status=403)
@@ -67,8 +84,7 @@ def update_delete_package(request, package_id):
 @permission_classes([AllowAny])
 def list_doctors(request):
     doctors = User.objects.filter(user_type='doctor')
-    serializer = UserSerializer(doctors, many=True)
-    return Response(serializer.data)
+    return paginate(request, doctors, UserSerializer, ID_ORDERING)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
@@ -76,8 +92,7 @@ def list_patients(request):
     if request.user.user_type != 'doctor':
         return Response({'error': 'Doctors only'}, status=403)
     patients = request.user.patients.all()
-    serializer = UserSerializer(patients, many=True)
-    return Response(serializer.data)
+    return paginate(request, patients, UserSerializer, ID_ORDERING)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
@@ -87,8 +102,7 @@ def patient_records(request, patient_id):
     try:
         patient = User.objects.get(id=patient_id, user_type='patient')
         records = Record.objects.filter(patient=patient, doctor=request.user, is_deleted=False)
-        serializer = RecordSerializer(records, many=True)
-        return Response(serializer.data)
+        return paginate(request, records, RecordSerializer, RECORD_ORDERING)
     except User.DoesNotExist:
         return Response({'error': 'Patient not found'}, status=404)
 
@@ -133,27 +147,7 @@ def login_user(request):
             user_type = 'admin'
         package_info = None
         if user.user_type == 'patient' and user.package:
-            package = user.package
-            max_uploads = package.max_uploads
-            max_storage_mb = package.max_storage_mb
-            current_uploads = Record.objects.filter(patient=user, is_deleted=False).count()
-            try:
-                total_storage = sum([
-                    rec.prescription.size for rec in Record.objects.filter(patient=user, is_deleted=False)
-                    if rec.prescription and os.path.exists(rec.prescription.path)
-                ]) / (1024 * 1024)
-            except Exception as e:
-                logger.warning(f"Error during storage calculation: {e}")
-                total_storage = 0
-
-            package_info = {
-                'max_uploads': max_uploads,
-                'max_storage_mb': max_storage_mb,
-                'current_uploads': current_uploads,
-                'used_storage_mb': total_storage,
-                'available_uploads': max_uploads - current_uploads if max_uploads > 0 else 'Unlimited',
-                'available_storage_mb': max_storage_mb - total_storage if max_storage_mb > 0 else 'Unlimited'
-            }
+            package_info = usage.package_summary(user)
 
         return Response({
             'access': str(refresh.access_token),
@@ -193,47 +187,217 @@ def update_profile(request):
         return Response(serializer.data)
     return Response(serializer.errors, status=400)
 
+def _upload_allowance(user):
+    """
+    Unlocked pre-check of a patient's package before any file is read.
+    Returns (refusal response or None, bytes of storage left or None for no limit).
+    """
+    if user.user_type != 'patient':
+        return None, None
+    package = user.package
+    if package.max_uploads == 0:
+        return Response({'error': 'Your package does not allow uploads.'}, status=403), None
+    if package.max_uploads <= 0 and package.max_storage_mb <= 0:
+        return None, None
+    ledger = usage.get_ledger(user)
+    if package.max_uploads > 0 and ledger.upload_count >= package.max_uploads:
+        return Response({'error': 'You have reached your upload limit.'}, status=403), None
+    if package.max_storage_mb > 0:
+        return None, package.max_storage_mb * usage.MB - ledger.bytes_used
+    return None, None
+
+def _locked_upload_limits(user, size):
+    """The authoritative package check for storing ``size`` more bytes; call inside the saving transaction."""
+    if user.user_type != 'patient':
+        return None
+    package = user.package
+    # Locking the ledger row serialises concurrent uploads by the same patient
+    ledger = usage.get_ledger(user, lock=True)
+
+    # Validate package upload limits
+    max_uploads = package.max_uploads
+    if max_uploads > 0 and ledger.upload_count >= max_uploads:
+        return Response({'error': 'You have reached your upload limit.'}, status=403)
+
+    # Validate package storage limits
+    max_storage_mb = package.max_storage_mb
+    if max_storage_mb > 0 and size and ledger.bytes_used + size > max_storage_mb * usage.MB:
+        return Response({'error': 'You have exceeded your storage limit.'}, status=403)
+    return None
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def upload_record(request):
     user = request.user
-    data = request.data.copy()
-
-    if user.user_type == 'patient':
-        package = user.package
-        if not package:
-            return Response({'error': 'No package assigned.'}, status=403)
-
-        # Validate package upload limits
-        max_uploads = package.max_uploads
-        current_uploads = Record.objects.filter(patient=user, is_deleted=False).count()
-        if max_uploads == 0:
-            return Response({'error': 'Your package does not allow uploads.'}, status=403)
-        if max_uploads > 0 and current_uploads >= max_uploads:
-            return Response({'error': 'You have reached your upload limit.'}, status=403)
-
-        # Validate package storage limits
-        max_storage_mb = package.max_storage_mb
-        if max_storage_mb > 0:
-            try:
-                total_storage = sum([
-                    rec.prescription.size for rec in Record.objects.filter(patient=user, is_deleted=False)
-                    if rec.prescription and os.path.exists(rec.prescription.path)
-                ]) / (1024 * 1024)
-            except FileNotFoundError as e:
-                logger.warning(f"File not found during storage calculation: {e}")
-                total_storage = 0
-
-            upload_file = request.FILES.get('prescription')
-            if upload_file and (total_storage + upload_file.size / (1024 * 1024)) > max_storage_mb:
-                return Response({'error': 'You have exceeded your storage limit.'}, status=403)
-
-    serializer = RecordSerializer(data=data)
-    if serializer.is_valid():
-        serializer.save()
-        return Response(serializer.data, status=201)
+    if user.user_type == 'patient' and not user.package:
+        return Response({'error': 'No package assigned.'}, status=403)
+
+    # Refuse before reading the body where the answer is already known, and
+    # give the upload handler the storage left so it can stop mid-stream
+    refusal, quota = _upload_allowance(user)
+    if refusal is not None:
+        return refusal
+    if not uploads.install(request, uploads.InspectingUploadHandler(request, quota=quota)):
+        upload_file = request.FILES.get('prescription')
+        if upload_file:
+            uploads.inspect(upload_file, quota=quota)
+    # Not copied: that would deep-copy the uploaded file
+    data = request.data
+    upload_file = request.FILES.get('prescription')
+    if upload_file:
+        # Before the ledger lock, so other uploads by the patient never wait on it
+        ingest.ingest(upload_file)
+
+    with transaction.atomic():
+        refusal = _locked_upload_limits(user, upload_file.size if upload_file else 0)
+        if refusal is not None:
+            return refusal
+
+        serializer = RecordSerializer(data=data)
+        if serializer.is_valid():
+            record = serializer.save()
+            usage.record_added(record)
+            return Response(serializer.data, status=201)
     return Response(serializer.errors, status=400)
 
+def _session_status(session):
+    received = resumable.received(session)
+    offset = resumable.contiguous_bytes(session, received)
+    response = Response({
+        'id': str(session.id),
+        'file_name': session.file_name,
+        'size': session.size,
+        'chunk_size': session.chunk_size,
+        'chunk_count': session.chunk_count,
+        'received': received,
+        'offset': offset,
+        'complete': len(received) == session.chunk_count,
+        'record': session.record_id,
+        'expires_at': session.expires_at,
+    })
+    response['Upload-Offset'] = str(offset)
+    response['Upload-Length'] = str(session.size)
+    return response
+
+def _open_session(request, session_id, allow_expired=False):
+    """The caller's session, or a 404/410 response."""
+    session = UploadSession.objects.filter(id=session_id, owner=request.user).first()
+    if session is None:
+        return None, Response({'error': 'Upload not found.'}, status=404)
+    if not allow_expired and session.record_id is None and session.expires_at <= timezone.now():
+        return None, Response({'error': 'This upload has expired.'}, status=410)
+    return session, None
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def upload_session_create(request):
+    """
+    Start a resumable upload: declare file_name, size, doctor, patient and
+    optionally description, then PUT the chunks to the returned session.
+    """
+    user = request.user
+    if user.user_type == 'patient' and not user.package:
+        return Response({'error': 'No package assigned.'}, status=403)
+    refusal, quota = _upload_allowance(user)
+    if refusal is not None:
+        return refusal
+    serializer = UploadSessionSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=400)
+    if quota is not None and serializer.validated_data['size'] > quota:
+        return Response({'error': 'You have exceeded your storage limit.'}, status=403)
+    session = serializer.save(owner=user, chunk_size=resumable.default_chunk_size(), expires_at=resumable.expiry())
+    response = Response(UploadSessionSerializer(session).data, status=201)
+    response['Location'] = request.build_absolute_uri(f'{session.id}/')
+    return response
+
+@api_view(['GET', 'PUT', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def upload_session(request, session_id):
+    """
+    GET: which chunks have arrived. PUT: one chunk as the raw body, at the
+    byte offset given by the Upload-Offset header or ?offset=; chunks may be
+    sent in any order and in parallel, and resending one is harmless.
+    DELETE: abandon the upload.
+    """
+    session, refusal = _open_session(request, session_id, allow_expired=request.method == 'DELETE')
+    if refusal is not None:
+        return refusal
+    if request.method == 'GET':
+        return _session_status(session)
+    if request.method == 'DELETE':
+        session.delete()
+        transaction.on_commit(lambda: resumable.discard(session))
+        return Response(status=204)
+
+    if session.record_id is not None:
+        return Response({'error': 'This upload is already finalized.'}, status=409)
+    offset = request.headers.get('Upload-Offset', request.query_params.get('offset'))
+    if offset is None or not offset.isdigit():
+        return Response({'error': 'Send the chunk\'s byte offset as Upload-Offset.'}, status=400)
+    try:
+        index = resumable.chunk_index(session, int(offset))
+        # Refuse a wrong-sized chunk before reading its body
+        length = request.headers.get('Content-Length')
+        if length and int(length) != session.chunk_length(index):
+            raise ValueError(f'Chunk {index} must be {session.chunk_length(index)} bytes, got {length}.')
+        resumable.write_chunk(session, index, request.body)
+    except FileExistsError as e:
+        return Response({'error': str(e)}, status=409)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=400)
+    return _session_status(session)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def upload_session_finalize(request, session_id):
+    """
+    Turn a complete upload into a Record, under the same package checks as
+    records/upload/. Retrying after a lost response returns the same record.
+    """
+    user = request.user
+    session, refusal = _open_session(request, session_id)
+    if refusal is not None:
+        return refusal
+    if session.record_id is not None:
+        return Response(RecordSerializer(session.record).data)
+    if user.user_type == 'patient' and not user.package:
+        return Response({'error': 'No package assigned.'}, status=403)
+    refusal, quota = _upload_allowance(user)
+    if refusal is not None:
+        return refusal
+    try:
+        upload_file = resumable.assemble(session, quota=quota)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=409)
+
+    try:
+        ingest.ingest(upload_file)
+        with transaction.atomic():
+            # Serialises finalize retries racing each other
+            session = UploadSession.objects.select_for_update().get(id=session.id)
+            if session.record_id is not None:
+                return Response(RecordSerializer(session.record).data)
+            refusal = _locked_upload_limits(user, upload_file.size)
+            if refusal is not None:
+                return refusal
+            serializer = RecordSerializer(data={
+                'doctor': session.doctor_id,
+                'patient': session.patient_id,
+                'description': session.description,
+                'prescription': upload_file,
+            })
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=400)
+            record = serializer.save()
+            usage.record_added(record)
+            session.record = record
+            session.save(update_fields=['record'])
+            transaction.on_commit(lambda: resumable.discard(session))
+    finally:
+        upload_file.close()
+    return Response(serializer.data, status=201)
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def list_records(request):
@@ -245,12 +409,56 @@ def list_records(request):
         records = Record.objects.filter(doctor=request.user, is_deleted=False)
     else:
         records = Record.objects.none()
-    serializer = RecordSerializer(records, many=True)
-    return Response(serializer.data)
+    return paginate(request, records, RecordSerializer, RECORD_ORDERING)
+
+def _reminder_range(request):
+    """The caller's reminders starting in [from, to), either bound optional; raises ValueError on bad input."""
+    if request.user.user_type == 'doctor':
+        reminders = Reminder.objects.filter(doctor=request.user)
+    elif request.user.user_type == 'patient':
+        reminders = Reminder.objects.filter(patient=request.user)
+    else:
+        return Reminder.objects.none()
+    start = _window_bound(request, 'from', None)
+    end = _window_bound(request, 'to', None)
+    if start is not None:
+        reminders = reminders.filter(date__gte=start)
+    if end is not None:
+        reminders = reminders.filter(date__lt=end)
+    return reminders
+
+def _reminder_etag(request, reminders):
+    """
+    A validator for one page of the calendar: any insert, edit or delete in
+    the range changes the row count, the newest updated_at or the highest id.
+    Served from the (owner, date, updated_at) index alone.
+    """
+    state = reminders.aggregate(count=models.Count('id'), updated=models.Max('updated_at'), last=models.Max('id'))
+    raw = f"{request.user.id}:{request.get_full_path()}:{state['count']}:{state['updated']}:{state['last']}"
+    return hashlib.sha1(raw.encode()).hexdigest()
 
-@api_view(['POST'])
+@api_view(['GET', 'POST'])
 @permission_classes([IsAuthenticated])
-def create_reminder(request):
+def reminders_list_create(request):
+    """
+    GET: the caller's reminders starting in [from, to), oldest first, keyset
+    paginated. Send the returned ETag back as If-None-Match to get a 304 when
+    nothing in the range changed. Recurring reminders are listed once, at
+    their first occurrence; /api/reminders/occurrences/ expands them.
+    """
+    if request.method == 'GET':
+        try:
+            reminders = _reminder_range(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        etag = _reminder_etag(request, reminders)
+        not_modified = get_conditional_response(request, etag=quote_etag(etag))
+        if not_modified is not None:
+            return not_modified
+        response = paginate(request, reminders.order_by(*REMINDER_ORDERING), ReminderSerializer, REMINDER_ORDERING)
+        response['ETag'] = quote_etag(etag)
+        response['Cache-Control'] = 'private, no-cache'
+        return response
     data = request.data.copy()
     # Convert empty string doctor/patient to None
     if data.get('doctor', '') == '':
@@ -267,6 +475,118 @@ def create_reminder(request):
         return Response(serializer.data, status=201)
     return Response(serializer.errors, status=400)
 
+def _window_bound(request, name, default):
+    value = request.query_params.get(name)
+    if not value:
+        return default
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"'{name}' must be an ISO 8601 datetime.")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def reminder_occurrences(request):
+    """
+    Occurrences of the caller's reminders in [from, to), expanded from their
+    recurrence rules on the fly. Defaults to the coming week.
+    """
+    max_days = getattr(settings, 'REMINDER_OCCURRENCE_MAX_DAYS', 92)
+    try:
+        start = _window_bound(request, 'from', timezone.now())
+        end = _window_bound(request, 'to', start + timedelta(days=7))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=400)
+    if end <= start:
+        return Response({'error': "'to' must be after 'from'."}, status=400)
+    if end - start > timedelta(days=max_days):
+        return Response({'error': f'The window may span at most {max_days} days.'}, status=400)
+    # Only series that start before the window ends and have not ended before it begins
+    in_window = (models.Q(freq='', date__gte=start, date__lt=end)
+                 | (~models.Q(freq='') & models.Q(date__lt=end) & (models.Q(until__isnull=True) | models.Q(until__gte=start))))
+    reminders = Reminder.objects.filter(models.Q(doctor=request.user) | models.Q(patient=request.user)).filter(in_window)
+    limit = getattr(settings, 'REMINDER_OCCURRENCE_LIMIT', 2000)
+    occurrences = []
+    for reminder in reminders.order_by('id'):
+        for at in recurrence.occurrences(reminder, start, end, limit=limit):
+            occurrences.append({'reminder': reminder.id, 'title': reminder.title, 'at': at,
+                                'doctor': reminder.doctor_id, 'patient': reminder.patient_id})
+    occurrences.sort(key=lambda occurrence: (occurrence['at'], occurrence['reminder']))
+    truncated = len(occurrences) > limit
+    return Response({'from': start, 'to': end, 'truncated': truncated, 'results': occurrences[:limit]})
+
+def _request_user(request, user, query_token=False):
+    """
+    For plain (async) views: the session user, else the user of a Bearer
+    header, or with ``query_token`` of a ?token= access token (EventSource can't send headers).
+    """
+    if user.is_authenticated:
+        return user
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw = authentication.get_raw_token(header) if header else None
+    if raw is None and query_token:
+        raw = request.GET.get('token', '').encode()
+    if not raw:
+        return None
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw))
+    except (InvalidToken, TokenError):
+        return None
+
+async def reminder_stream(request):
+    """
+    Server-sent events: one ``reminder`` event per reminder of the caller's
+    that falls due. Reconnecting with Last-Event-ID replays what was missed.
+    Comment lines keep idle connections alive through proxies, and streams
+    end after REMINDER_STREAM_MAX_SECONDS so clients reconnect with a fresh token.
+    """
+    user = await sync_to_async(_request_user)(request, await request.auser(), query_token=True)
+    if user is None or not user.is_active:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    last_event = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    try:
+        last_event = int(last_event) if last_event else None
+    except ValueError:
+        return JsonResponse({'error': 'Last-Event-ID must be an integer.'}, status=400)
+    heartbeat = getattr(settings, 'REMINDER_STREAM_HEARTBEAT_SECONDS', 15)
+    lifetime = getattr(settings, 'REMINDER_STREAM_MAX_SECONDS', 30 * 60)
+
+    async def stream():
+        # Subscribe before replaying so nothing published in between is lost
+        queue = events.broker.subscribe(user.id)
+        try:
+            yield f"retry: {getattr(settings, 'REMINDER_STREAM_RETRY_MS', 5000)}\n\n"
+            replayed = set()
+            if last_event is not None:
+                replay = await sync_to_async(events.user_events_after)(
+                    user.id, last_event, getattr(settings, 'REMINDER_STREAM_FETCH_LIMIT', 1000))
+                for event in replay:
+                    replayed.add(event['id'])
+                    yield events.format_event(event)
+            deadline = asyncio.get_running_loop().time() + lifetime
+            while True:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    return
+                try:
+                    event = await asyncio.wait_for(queue.get(), min(heartbeat, remaining))
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+                if event['id'] not in replayed:
+                    yield events.format_event(event)
+        finally:
+            events.broker.unsubscribe(user.id, queue)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def share_record(request, record_id):
@@ -282,7 +602,10 @@ def share_record(request, record_id):
         if not doctor_id:
             return Response({'error': 'Doctor ID required'}, status=400)
         doctor = User.objects.get(id=doctor_id, user_type='doctor')
-        record.shared_with.add(doctor)
+        with transaction.atomic():
+            if not record.shared_with.filter(pk=doctor.pk).exists():
+                record.shared_with.add(doctor)
+                usage.shares_added(record)
         return Response({'message': 'Record shared'}, status=200)
     except Record.DoesNotExist:
         return Response({'error': 'Record not found'}, status=404)
@@ -300,8 +623,7 @@ def delete_record(request, record_id):
         # Allow patient to delete if they are the owner
         if request.user.user_type == 'patient' and record.patient != request.user:
             return Response({'error': 'Only the owner patient can delete'}, status=403)
-        record.is_deleted = True
-        record.save()
+        usage.soft_delete(record)
         return Response({'message': 'Record deleted'}, status=200)
     except Record.DoesNotExist:
         return Response({'error': 'Record not found'}, status=404)
@@ -359,7 +681,7 @@ def generate_share_link(request, record_id):
 @permission_classes([AllowAny])
 def view_shared_record(request, token):
     try:
-        link = SharedLink.objects.get(token=token)
+        link = SharedLink.objects.select_related('record__blob__segment').get(token=token)
         if hasattr(link, 'is_valid'):
             if not link.is_valid():
                 return Response({'error': 'Link expired'}, status=410)
@@ -368,12 +690,11 @@ def view_shared_record(request, token):
         prescription = link.record.prescription
         if not prescription:
             return Response({'error': 'No file found'}, status=404)
-        # Check if the file exists before attempting to open it
-        if not os.path.exists(prescription.path):
+        try:
+            return delivery.serve(request, link.record)
+        except FileNotFoundError:
             logger.error(f"File not found: {prescription.path}")
             return Response({'error': 'File not found'}, status=404)
-        response = FileResponse(prescription.open('rb'), as_attachment=True, filename=prescription.name.split('/')[-1])
-        return response
     except SharedLink.DoesNotExist:
         return Response({'error': 'Invalid link'}, status=404)
     except Exception as e:
@@ -412,8 +733,7 @@ def list_all_patients(request):
     if request.user.user_type != 'doctor':
         return Response({'error': 'Doctors only'}, status=403)
     patients = User.objects.filter(user_type='patient')
-    serializer = UserSerializer(patients, many=True)
-    return Response(serializer.data)
+    return paginate(request, patients, UserSerializer, ID_ORDERING)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -464,8 +784,7 @@ def users_list_create(request):
         
     if request.method == 'GET':
         users = User.objects.all()
-        serializer = UserSerializer(users, many=True)
-        return Response(serializer.data)
+        return paginate(request, users, UserSerializer, ID_ORDERING)
     elif request.method == 'POST':
         serializer = UserSerializer(data=request.data)
         if serializer.is_valid():
@@ -486,8 +805,6 @@ def user_update_delete(request, user_id):
     elif request.method == 'PUT':
         serializer = UserSerializer(user, data=request.data, partial=True)
         if serializer.is_valid():
-            if 'password' in request.data and request.data['password']:
-                user.set_password(request.data['password'])
             serializer.save()
             return Response(serializer.data)
         return Response(serializer.errors, status=400)
@@ -505,42 +822,154 @@ def user_info(request):
 @permission_classes([IsAuthenticated])
 def download_record(request, record_id):
     try:
-        record = Record.objects.get(id=record_id, is_deleted=False)
+        # The blob and its segment come along, for files in the archive tier
+        record = Record.objects.select_related('blob__segment').get(id=record_id, is_deleted=False)
         prescription = record.prescription
         if not prescription:
             return Response({'error': 'No file found'}, status=404)
-        if not os.path.exists(prescription.path):
+        try:
+            return delivery.serve(request, record)
+        except FileNotFoundError:
             logger.error(f"File not found: {prescription.path}")
             return Response({'error': 'File not found'}, status=404)
-        response = FileResponse(prescription.open('rb'), as_attachment=True, filename=prescription.name.split('/')[-1])
-        return response
     except Record.DoesNotExist:
         return Response({'error': 'Record not found'}, status=404)
     except Exception as e:
         logger.error(f"Download error for record {record_id}: {str(e)}")
         return Response({'error': str(e)}, status=500)
 
+def _async_gate(request, user, anonymous=False):
+    """
+    What @api_view does before a view runs, for the async file views:
+    authenticate and apply the default throttles. Returns (user, refusal).
+    """
+    user = _request_user(request, user)
+    if not anonymous and (user is None or not user.is_active):
+        return None, JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    drf_request = Request(request)
+    drf_request.user = user or AnonymousUser()
+    for throttle_class in api_settings.DEFAULT_THROTTLE_CLASSES:
+        throttle = throttle_class()
+        if not throttle.allow_request(drf_request, None):
+            refusal = JsonResponse({'detail': 'Request was throttled.'}, status=429)
+            wait = throttle.wait()
+            if wait is not None:
+                refusal['Retry-After'] = str(math.ceil(wait))
+            return None, refusal
+    return user, None
+
+async def _deliver_async(request, record):
+    try:
+        return await delivery.aserve(request, record)
+    except FileNotFoundError:
+        logger.error(f"File not found: {record.prescription.name}")
+        return JsonResponse({'error': 'File not found'}, status=404)
+
+@require_safe
+async def download_record_async(request, record_id):
+    """download_record for ASGI: no worker thread is held while the file is sent."""
+    user, refusal = await sync_to_async(_async_gate)(request, await request.auser())
+    if refusal is not None:
+        return refusal
+    record = await Record.objects.select_related('blob__segment').filter(id=record_id, is_deleted=False).afirst()
+    if record is None:
+        return JsonResponse({'error': 'Record not found'}, status=404)
+    if not record.prescription:
+        return JsonResponse({'error': 'No file found'}, status=404)
+    return await _deliver_async(request, record)
+
+@require_safe
+async def view_shared_record_async(request, token):
+    """view_shared_record for ASGI."""
+    user, refusal = await sync_to_async(_async_gate)(request, await request.auser(), anonymous=True)
+    if refusal is not None:
+        return refusal
+    link = await SharedLink.objects.select_related('record__blob__segment').filter(token=token).afirst()
+    if link is None:
+        return JsonResponse({'error': 'Invalid link'}, status=404)
+    if link.expires_at and timezone.now() > link.expires_at:
+        return JsonResponse({'error': 'Link expired'}, status=410)
+    if not link.record.prescription:
+        return JsonResponse({'error': 'No file found'}, status=404)
+    return await _deliver_async(request, link.record)
+
+def _preview_payload(request, record):
+    """The preview endpoint's body: derivative URLs where they are rendered, the original otherwise."""
+    archived = record.blob_id is not None and record.blob.archived
+    if archived:
+        # No longer under MEDIA_ROOT: the download view streams it from the archive tier
+        original = request.build_absolute_uri(reverse('download_record', args=[record.id]))
+    else:
+        original = request.build_absolute_uri(record.prescription.url)
+    found = derivatives.lookup(record, render=not archived)
+    return {
+        "record_id": record.id,
+        "patient": record.patient_id,
+        "doctor": record.doctor_id,
+        "description": record.description,
+        "preview_url": request.build_absolute_uri(found['preview']) if 'preview' in found else original,
+        "thumbnail_url": request.build_absolute_uri(found['thumbnail']) if 'thumbnail' in found else None,
+        "original_url": original,
+    }
+
+@require_safe
+async def preview_record_async(request, pk):
+    """RecordViewSet.preview for ASGI."""
+    user, refusal = await sync_to_async(_async_gate)(request, await request.auser())
+    if refusal is not None:
+        return refusal
+    record = await Record.objects.select_related('blob').filter(pk=pk, is_deleted=False).afirst()
+    if record is None:
+        return JsonResponse({'detail': 'No Record matches the given query.'}, status=404)
+    if user.id not in (record.patient_id, record.doctor_id):
+        return JsonResponse({'error': 'Access denied'}, status=403)
+    return JsonResponse(await sync_to_async(_preview_payload, thread_sensitive=False)(request, record))
+
 class RecordViewSet(viewsets.ModelViewSet):
     queryset = Record.objects.all()
     serializer_class = RecordSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        return shape_queryset(super().get_queryset(), self.get_serializer_class())
+
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            record = serializer.save()
+            if not record.is_deleted:
+                usage.record_added(record)
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            previous = Record.objects.select_for_update().get(pk=serializer.instance.pk)
+            if not previous.is_deleted:
+                usage.record_removed(previous)
+            replaced = 'prescription' in serializer.validated_data
+            record = serializer.save()
+            if not record.is_deleted:
+                usage.record_added(record)
+            if replaced and record.blob_id != previous.blob_id:
+                # A new file: the old blob loses this record's reference, and goes if it was the last
+                blobs.forget(previous, was_live=not previous.is_deleted)
+            elif replaced:
+                # The same content again: Record.save took a reference for it, so the old one goes
+                if not previous.is_deleted:
+                    blobs.release(previous)
+            elif record.is_deleted and not previous.is_deleted:
+                blobs.release(previous)
+            elif previous.is_deleted and not record.is_deleted:
+                blobs.retain(record)
+
     @action(detail=True, methods=['get'], url_path='preview')
     def preview(self, request, pk=None):
-        record = get_object_or_404(Record, pk=pk, is_deleted=False)
+        record = get_object_or_404(Record.objects.select_related('blob'), pk=pk, is_deleted=False)
 
-        # Access Control: Only the patient or doctor can view
-        if request.user != record.patient and request.user != record.doctor:
+        # Access Control: Only the patient or doctor can view.
+        # Compare ids so neither user row is fetched.
+        if request.user.id not in (record.patient_id, record.doctor_id):
             return Response({'error': 'Access denied'}, status=status.HTTP_403_FORBIDDEN)
 
-        preview_url = request.build_absolute_uri(record.prescription.url)
-        return Response({
-            "record_id": record.id,
-            "patient": record.patient.id,
-            "doctor": record.doctor.id,
-            "description": record.description,
-            "preview_url": preview_url
-        })
+        return Response(_preview_payload(request, record))
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
@@ -549,24 +978,24 @@ def get_package_details(request):
     if user.user_type == 'doctor':
         return Response({})  # Doctors do not have package details
     if user.user_type == 'patient' and user.package:
-        package = user.package
-        max_uploads = package.max_uploads
-        max_storage_mb = package.max_storage_mb
-        current_uploads = Record.objects.filter(patient=user, is_deleted=False).count()
-        try:
-            total_storage = sum([
-                rec.prescription.size for rec in Record.objects.filter(patient=user, is_deleted=False)
-                if rec.prescription and os.path.exists(rec.prescription.path)
-            ]) / (1024 * 1024)
-        except FileNotFoundError:
-            total_storage = 0
+        return Response(usage.package_summary(user))
+    return Response({})  # Default empty response for users without a package
 
-        return Response({
-            'max_uploads': max_uploads,
-            'max_storage_mb': max_storage_mb,
-            'current_uploads': current_uploads,
-            'used_storage_mb': total_storage,
-            'available_uploads': max_uploads - current_uploads if max_uploads > 0 else 'Unlimited',
-            'available_storage_mb': max_storage_mb - total_storage if max_storage_mb > 0 else 'Unlimited'
-        })
-    return Response({})  # Default empty response for users without a package
\ No newline at end of file
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def export_metrics(request):
+    """Request metrics for this process, plus email outbox depth and storage per tier, in the Prometheus text format."""
+    return HttpResponse(metrics.registry.render() + outbox.render_metrics() + archive.render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def profile_report(request, profile_id):
+    """A saved request profile; ``?download=prof`` returns the raw pstats dump."""
+    paths = profiling.report_paths(profile_id)
+    if paths is None or not os.path.exists(paths[0]):
+        return Response({'error': 'Profile not found'}, status=404)
+    json_path, prof_path = paths
+    if request.query_params.get('download') == 'prof':
+        return FileResponse(open(prof_path, 'rb'), as_attachment=True, filename=f'{profile_id}.prof')
+    with open(json_path) as f:
+        return Response(json.load(f))